@@ -38,6 +38,11 @@ class Assign(Framework):
         Framework.__init__(self, applicationName, applicationVersion, commandLineArguments)
         # self.components.add('Assignment')
 
+        # compile the backbone scoring kernels in the background so that the first match is not delayed
+        from ccpn.AnalysisAssign.lib.scoring import warmUpScoring
+
+        warmUpScoring(background=True)
+
     def setupMenus(self):
         super().setupMenus()
         menuSpec = ('Assign', [("Set up NmrResidues", self.showSetupNmrResiduesPopup, [('shortcut', 'sn')]),
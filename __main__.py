@@ -22,13 +22,22 @@ __date__ = "$Date: 2017-04-07 10:28:40 +0000 (Fri, April 07, 2017) $"
 # Start of code
 #=========================================================================================
 
-from PyQt5 import QtGui
-from ccpn.framework import Framework
-from ccpn.AnalysisAssign.AnalysisAssign import Assign as Application
-from ccpn.framework.Version import applicationVersion
+import sys
 
 
 if __name__ == '__main__':
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'match':
+        # headless backbone matching; does not start the user interface
+        from ccpn.AnalysisAssign.lib.backboneMatching import main
+
+        sys.exit(main(sys.argv[2:]))
+
+    from PyQt5 import QtGui
+    from ccpn.framework import Framework
+    from ccpn.AnalysisAssign.AnalysisAssign import Assign as Application
+    from ccpn.framework.Version import applicationVersion
+
     # from ccpn.util.GitTools import getAllRepositoriesGitCommit
     # applicationVersion = 'development: {AnalysisAssign:.8s}'.format(**getAllRepositoriesGitCommit())
 
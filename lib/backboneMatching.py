@@ -0,0 +1,181 @@
+"""
+Headless backbone matching.
+
+Matches the 13C shifts of every NmrResidue in a project against all other NmrResidues, as the
+Backbone Assignment module does for a single NmrResidue, and streams the ranked candidates
+as csv or json-lines, without starting the user interface.
+
+usage:
+    python -m ccpn.AnalysisAssign match <projectPath> [--chemicalShiftList default] [--format csv] [--output matches.csv]
+"""
+#=========================================================================================
+# Licence, Reference and Credits
+#=========================================================================================
+__copyright__ = "Copyright (C) CCPN project (http://www.ccpn.ac.uk) 2014 - 2020"
+__credits__ = ("Ed Brooksbank, Luca Mureddu, Timothy J Ragan & Geerten W Vuister")
+__licence__ = ("CCPN licence. See http://www.ccpn.ac.uk/v3-software/downloads/license")
+__reference__ = ("Skinner, S.P., Fogh, R.H., Boucher, W., Ragan, T.J., Mureddu, L.G., & Vuister, G.W.",
+                 "CcpNmr AnalysisAssign: a flexible platform for integrated NMR analysis",
+                 "J.Biomol.Nmr (2016), 66, 111-124, http://doi.org/10.1007/s10858-016-0060-y")
+#=========================================================================================
+# Last code modification
+#=========================================================================================
+__modifiedBy__ = "$modifiedBy: CCPN $"
+__dateModified__ = "$dateModified: 2020-03-17 00:13:56 +0000 (Tue, March 17, 2020) $"
+__version__ = "$Revision: 3.0.1 $"
+#=========================================================================================
+# Created
+#=========================================================================================
+__author__ = "$Author: CCPN $"
+__date__ = "$Date: 2020-03-17 00:13:56 +0000 (Tue, March 17, 2020) $"
+#=========================================================================================
+# Start of code
+#=========================================================================================
+
+import sys
+import csv
+import json
+import argparse
+from collections import OrderedDict
+from ccpn.AnalysisAssign.lib.scoring import ShiftMatrix, getAllNmrResidueMatches, createMatchingPool, scoringMethods, \
+    MAXMATCHES
+
+
+BATCHSIZE = 500  # number of query NmrResidues matched before their results are written
+CSVCOLUMNS = ('query', 'rank', 'match', 'score')
+
+
+def getShiftsDict(nmrResidues, chemicalShiftList):
+    """Return a dict of {nmrResidue: [chemicalShift, ...]} of the shifts in chemicalShiftList
+    for the nmrAtoms of nmrResidues, as used by the Backbone Assignment module
+    """
+    shiftsDict = OrderedDict()
+    for nmrResidue in nmrResidues:
+        shiftsDict[nmrResidue] = [chemicalShiftList.getChemicalShift(atom.id) for atom in nmrResidue.nmrAtoms]
+    return shiftsDict
+
+
+def iterNmrResidueMatches(shiftMatrix, scoringMethod='averageQScore', maxMatches=MAXMATCHES,
+                          tolerances=None, processes=None, batchSize=BATCHSIZE):
+    """Match every nmrResidue of shiftMatrix against the others, in batches of batchSize queries.
+    Yields (queryNmrResidue, [(score, nmrResidue, {atomName: delta}), ...]) in the order of the shiftMatrix.
+    If processes is not None, a single pool of processes is used for all the batches; shiftMatrix
+    must not change while iterating.
+    """
+    if processes is None:
+        yield from _iterBatchMatches(shiftMatrix, scoringMethod, maxMatches, tolerances, batchSize)
+    else:
+        # the matrix is copied to the processes once, only the query rows are sent with each batch
+        with createMatchingPool(shiftMatrix, processes) as executor:
+            yield from _iterBatchMatches(shiftMatrix, scoringMethod, maxMatches, tolerances, batchSize,
+                                         executor=executor)
+
+
+def _iterBatchMatches(shiftMatrix, scoringMethod, maxMatches, tolerances, batchSize, executor=None):
+    nmrResidues = list(shiftMatrix.nmrResidues)
+    for ii in range(0, len(nmrResidues), batchSize):
+        queryNmrResidues = nmrResidues[ii:ii + batchSize]
+        matches = getAllNmrResidueMatches(shiftMatrix, scoringMethod, maxMatches, queryNmrResidues=queryNmrResidues,
+                                          tolerances=tolerances, executor=executor)
+        for queryNmrResidue in queryNmrResidues:
+            yield queryNmrResidue, matches[queryNmrResidue]
+
+
+def writeMatches(matches, fp, atomNames, fileFormat='csv'):
+    """Write the (queryNmrResidue, matches) items of matches to the open file fp, one line per candidate.
+    fileFormat is 'csv', with a delta column for each of atomNames, or 'json' for json-lines.
+    Returns the number of candidates written.
+    """
+    count = 0
+    if fileFormat == 'csv':
+        writer = csv.writer(fp)
+        writer.writerow(CSVCOLUMNS + tuple('delta_%s' % atomName for atomName in atomNames))
+        for queryNmrResidue, queryMatches in matches:
+            for rank, (score, nmrResidue, deltas) in enumerate(queryMatches):
+                writer.writerow([queryNmrResidue.pid, rank + 1, nmrResidue.pid, score] +
+                                [deltas.get(atomName, '') for atomName in atomNames])
+                count += 1
+
+    elif fileFormat == 'json':
+        for queryNmrResidue, queryMatches in matches:
+            for rank, (score, nmrResidue, deltas) in enumerate(queryMatches):
+                fp.write(json.dumps(OrderedDict((('query', queryNmrResidue.pid),
+                                                 ('rank', rank + 1),
+                                                 ('match', nmrResidue.pid),
+                                                 ('score', score),
+                                                 ('deltas', deltas)))))
+                fp.write('\n')
+                count += 1
+
+    else:
+        raise ValueError('Unknown file format %r; should be csv or json' % fileFormat)
+
+    return count
+
+
+def matchProject(project, chemicalShiftList=None, fp=None, fileFormat='csv', scoringMethod='averageQScore',
+                 maxMatches=MAXMATCHES, tolerances=None, processes=None):
+    """Match all the NmrResidues of project using the shifts of chemicalShiftList (pid, name or object;
+    default the first chemicalShiftList) and write the ranked candidates to fp (default stdout).
+    Returns the number of candidates written.
+    """
+    if chemicalShiftList is None:
+        if not project.chemicalShiftLists:
+            raise ValueError('Project %s has no chemicalShiftLists' % project.name)
+        chemicalShiftList = project.chemicalShiftLists[0]
+
+    elif isinstance(chemicalShiftList, str):
+        name = chemicalShiftList
+        chemicalShiftList = project.getByPid(name) or project.getByPid('CL:%s' % name)
+        if chemicalShiftList is None:
+            raise ValueError('ChemicalShiftList %r not found' % name)
+
+    shiftMatrix = ShiftMatrix.fromShiftsDict(getShiftsDict(project.nmrResidues, chemicalShiftList))
+    matches = iterNmrResidueMatches(shiftMatrix, scoringMethod, maxMatches, tolerances=tolerances, processes=processes)
+    return writeMatches(matches, fp or sys.stdout, shiftMatrix.atomNames, fileFormat=fileFormat)
+
+
+def defineArguments():
+    parser = argparse.ArgumentParser(prog='python -m ccpn.AnalysisAssign match',
+                                     description='Match the NmrResidues of a project for backbone assignment, '
+                                                 'without starting the user interface')
+    parser.add_argument('projectPath', help='project to match')
+    parser.add_argument('--chemicalShiftList', default=None,
+                        help='pid or name of the chemicalShiftList; default is the first')
+    parser.add_argument('--method', default='averageQScore', choices=list(scoringMethods.keys()),
+                        help='scoring method')
+    parser.add_argument('--maxMatches', type=int, default=MAXMATCHES,
+                        help='number of candidates to write for each NmrResidue')
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help='CA, CB and C tolerance (ppm) to pre-filter the candidates')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of processes to spread the scoring over; 0 for the number of cpus')
+    parser.add_argument('--format', dest='fileFormat', default='csv', choices=('csv', 'json'),
+                        help='output format; json is written as one object per line')
+    parser.add_argument('--output', default=None,
+                        help='output file; default is stdout')
+    return parser
+
+
+def main(argv=None):
+    """Run the headless backbone matching from the command line arguments argv
+    """
+    args = defineArguments().parse_args(argv)
+
+    from ccpn.framework.Framework import createFramework
+    from ccpn.util.Logging import getLogger
+
+    application = createFramework(projectPath=args.projectPath)
+    project = application.project
+    tolerances = None if args.tolerance is None else {atomName: args.tolerance for atomName in ('CA', 'CB', 'C')}
+
+    if args.output:
+        with open(args.output, 'w', newline='') as fp:
+            count = matchProject(project, args.chemicalShiftList, fp, args.fileFormat, args.method,
+                                 args.maxMatches, tolerances, args.processes)
+    else:
+        count = matchProject(project, args.chemicalShiftList, sys.stdout, args.fileFormat, args.method,
+                             args.maxMatches, tolerances, args.processes)
+
+    getLogger().info('Backbone matching: %i candidates written for %s' % (count, project.name))
+    return 0
@@ -0,0 +1,243 @@
+"""Ordered list of unique items with constant-time membership and blocked index lookup.
+
+Used by the SequenceGraph to hold the displayed nmrResidues of each nmrChain.
+"""
+#=========================================================================================
+# Licence, Reference and Credits
+#=========================================================================================
+__copyright__ = "Copyright (C) CCPN project (http://www.ccpn.ac.uk) 2014 - 2019"
+__credits__ = ("Ed Brooksbank, Luca Mureddu, Timothy J Ragan & Geerten W Vuister")
+__licence__ = ("CCPN licence. See http://www.ccpn.ac.uk/v3-software/downloads/license")
+__reference__ = ("Skinner, S.P., Fogh, R.H., Boucher, W., Ragan, T.J., Mureddu, L.G., & Vuister, G.W.",
+                 "CcpNmr AnalysisAssign: a flexible platform for integrated NMR analysis",
+                 "J.Biomol.Nmr (2016), 66, 111-124, http://doi.org/10.1007/s10858-016-0060-y")
+#=========================================================================================
+# Last code modification
+#=========================================================================================
+__modifiedBy__ = "$modifiedBy: CCPN $"
+__dateModified__ = "$dateModified: 2017-07-07 16:32:21 +0100 (Fri, July 07, 2017) $"
+__version__ = "$Revision: 3.0.0 $"
+#=========================================================================================
+# Created
+#=========================================================================================
+__author__ = "$Author: CCPN $"
+__date__ = "$Date: 2016-05-23 10:02:47 +0100 (Mon, 23 May 2016) $"
+#=========================================================================================
+# Start of code
+#=========================================================================================
+
+from bisect import bisect_right
+from itertools import chain
+from collections.abc import MutableSequence
+
+
+BLOCKSIZE = 256  # blocks are split when they reach twice this size
+
+
+class _Block(object):
+    """A run of consecutive items of an IndexedList and its position in the list of blocks.
+    """
+    __slots__ = ('items', 'position')
+
+    def __init__(self, items, position):
+        self.items = items
+        self.position = position
+
+
+class IndexedList(MutableSequence):
+    """
+    List of unique items with a map of item -> block, held as a list of blocks of at most 2 * BLOCKSIZE items.
+
+    Membership is a dict lookup. An index lookup finds the block of the item from the map, its position
+    in the block with a C-level scan of at most 2 * BLOCKSIZE items, and adds the start of the block.
+    Inserting/removing an item only shifts the items of one block and the starts of the following blocks,
+    so index lookups, inserts and removes are O(BLOCKSIZE + n / BLOCKSIZE), rather than the O(n) of
+    a list; splitting a full block is O(BLOCKSIZE + n / BLOCKSIZE), amortised over BLOCKSIZE inserts.
+
+    Adding an item that is already in the list moves it to the new position.
+    """
+
+    __slots__ = ('_blocks', '_starts', '_blockOf', '_length')
+
+    def __init__(self, items=()):
+        self._blocks = []  # list of _Blocks
+        self._starts = []  # index of the first item of each block
+        self._blockOf = {}  # referenced by item -> _Block
+        self._length = 0
+        self.extend(items)
+
+    def _locate(self, index):
+        """Return the (block, offset) of the item at the index, which must be valid and positive.
+        """
+        position = bisect_right(self._starts, index) - 1
+        return self._blocks[position], index - self._starts[position]
+
+    def _shiftStarts(self, position, delta):
+        """Add delta to the starts of the blocks after position.
+        """
+        starts = self._starts
+        for ii in range(position + 1, len(starts)):
+            starts[ii] += delta
+
+    def _renumberBlocks(self, position):
+        """Set the positions of the blocks from position onwards.
+        """
+        for ii in range(position, len(self._blocks)):
+            self._blocks[ii].position = ii
+
+    def _splitBlock(self, block):
+        """Split the block in two, moving the second half into a new block.
+        """
+        position = block.position
+        newBlock = _Block(block.items[BLOCKSIZE:], position + 1)
+        del block.items[BLOCKSIZE:]
+
+        self._blocks.insert(position + 1, newBlock)
+        self._starts.insert(position + 1, self._starts[position] + BLOCKSIZE)
+        self._renumberBlocks(position + 2)
+        for item in newBlock.items:
+            self._blockOf[item] = newBlock
+
+    def _removeBlock(self, block):
+        """Remove an empty block.
+        """
+        position = block.position
+        del self._blocks[position]
+        del self._starts[position]
+        self._renumberBlocks(position)
+
+    def __contains__(self, item):
+        try:
+            return item in self._blockOf
+        except TypeError:
+            # unhashable items cannot be in the list
+            return False
+
+    def index(self, item, *args):
+        """Return the index of item, raise ValueError if not in the list.
+        """
+        if item not in self:
+            raise ValueError('%s is not in list' % str(item))
+
+        block = self._blockOf[item]
+        ii = self._starts[block.position] + block.items.index(item)
+
+        if args and not (args[0] <= ii < (args[1] if len(args) > 1 else self._length)):
+            raise ValueError('%s is not in list' % str(item))
+        return ii
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return chain.from_iterable(block.items for block in self._blocks)
+
+    def __reversed__(self):
+        return chain.from_iterable(reversed(block.items) for block in reversed(self._blocks))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('list index out of range')
+        block, offset = self._locate(index)
+        return block.items[offset]
+
+    def __setitem__(self, index, item):
+        if isinstance(index, slice):
+            raise TypeError('%s does not support slice assignment' % self.__class__.__name__)
+
+        old = self[index]
+        if item == old:
+            return
+        if item in self:
+            # move the item to replace the old item
+            self.remove(item)
+        block = self._blockOf.pop(old)
+        block.items[block.items.index(old)] = item
+        self._blockOf[item] = block
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            items = list(self)
+            del items[index]
+            self.clear()
+            self.extend(items)
+            return
+
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('list assignment index out of range')
+
+        block, offset = self._locate(index)
+        del self._blockOf[block.items.pop(offset)]
+        self._length -= 1
+        self._shiftStarts(block.position, -1)
+        if not block.items:
+            self._removeBlock(block)
+
+    def insert(self, index, item):
+        """Insert item before index, moving the item if it is already in the list.
+        """
+        if item in self._blockOf:
+            oldIndex = self.index(item)
+            del self[oldIndex]
+            if oldIndex < index:
+                index -= 1
+
+        length = self._length
+        index = max(0, min(index + length if index < 0 else index, length))
+        if not self._blocks:
+            self._blocks.append(_Block([], 0))
+            self._starts.append(0)
+
+        if index == length:
+            # appending adds to the last block
+            block = self._blocks[-1]
+            offset = len(block.items)
+        else:
+            block, offset = self._locate(index)
+
+        block.items.insert(offset, item)
+        self._blockOf[item] = block
+        self._length += 1
+        self._shiftStarts(block.position, 1)
+        if len(block.items) >= 2 * BLOCKSIZE:
+            self._splitBlock(block)
+
+    def append(self, item):
+        self.insert(self._length, item)
+
+    def remove(self, item):
+        """Remove item, raise ValueError if not in the list.
+        """
+        del self[self.index(item)]
+
+    def clear(self):
+        self._blocks = []
+        self._starts = []
+        self._blockOf = {}
+        self._length = 0
+
+    def copy(self):
+        return self.__class__(self)
+
+    def __eq__(self, other):
+        if isinstance(other, IndexedList):
+            return list(self) == list(other)
+        if isinstance(other, (list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, list(self))
@@ -0,0 +1,165 @@
+"""Symmetric counts between pairs of integer ids held in two sorted arrays.
+
+Used by the SequenceGraph to hold the number of assignment lines between pairs of guiNmrAtoms,
+from which the displacement of each line is calculated.
+"""
+#=========================================================================================
+# Licence, Reference and Credits
+#=========================================================================================
+__copyright__ = "Copyright (C) CCPN project (http://www.ccpn.ac.uk) 2014 - 2019"
+__credits__ = ("Ed Brooksbank, Luca Mureddu, Timothy J Ragan & Geerten W Vuister")
+__licence__ = ("CCPN licence. See http://www.ccpn.ac.uk/v3-software/downloads/license")
+__reference__ = ("Skinner, S.P., Fogh, R.H., Boucher, W., Ragan, T.J., Mureddu, L.G., & Vuister, G.W.",
+                 "CcpNmr AnalysisAssign: a flexible platform for integrated NMR analysis",
+                 "J.Biomol.Nmr (2016), 66, 111-124, http://doi.org/10.1007/s10858-016-0060-y")
+#=========================================================================================
+# Last code modification
+#=========================================================================================
+__modifiedBy__ = "$modifiedBy: CCPN $"
+__dateModified__ = "$dateModified: 2017-07-07 16:32:21 +0100 (Fri, July 07, 2017) $"
+__version__ = "$Revision: 3.0.0 $"
+#=========================================================================================
+# Created
+#=========================================================================================
+__author__ = "$Author: CCPN $"
+__date__ = "$Date: 2016-05-23 10:02:47 +0100 (Mon, 23 May 2016) $"
+#=========================================================================================
+# Start of code
+#=========================================================================================
+
+import numpy as np
+
+
+IDBITS = 32
+IDMASK = (1 << IDBITS) - 1
+MINMERGESIZE = 1024  # new pairs are merged into the arrays in batches of at least this size
+
+
+class PairCounts(object):
+    """
+    Counts between pairs of non-negative integer ids below 2**32, the count of (id1, id2) is the count of (id2, id1).
+
+    Each pair is held as a single int64 key, (lowId << 32) | highId, in a sorted array with an int32 array of
+    the counts, 12 bytes per pair and no per-item storage. New pairs are collected in a small dict and merged
+    into the arrays in batches, so building many pairs stays O(n log n).
+    clear(ids) and discard(ids) scan all the keys with array operations, so should be called with many ids at once.
+    """
+
+    __slots__ = ('_keys', '_counts', '_pending')
+
+    def __init__(self):
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._counts = np.zeros(0, dtype=np.int32)
+        self._pending = {}  # referenced by key -> count, the pairs not yet merged into the arrays
+
+    @staticmethod
+    def _key(id1, id2):
+        return (id1 << IDBITS) | id2 if id1 <= id2 else (id2 << IDBITS) | id1
+
+    def _index(self, key):
+        """Return the index of key in the arrays, or None if not present.
+        """
+        index = int(np.searchsorted(self._keys, key))
+        if index < len(self._keys) and self._keys[index] == key:
+            return index
+
+    def _merge(self):
+        """Merge the pending pairs into the sorted arrays.
+        """
+        if not self._pending:
+            return
+
+        keys = np.concatenate((self._keys, np.fromiter(self._pending.keys(), dtype=np.int64, count=len(self._pending))))
+        counts = np.concatenate((self._counts, np.fromiter(self._pending.values(), dtype=np.int32, count=len(self._pending))))
+        order = np.argsort(keys, kind='stable')
+        self._keys = keys[order]
+        self._counts = counts[order]
+        self._pending.clear()
+
+    def _matchIds(self, ids):
+        """Return the mask of the pairs in the arrays containing any of ids, and the set of ids.
+        """
+        ids = set(ids)
+        idArray = np.fromiter(ids, dtype=np.int64, count=len(ids))
+        mask = np.isin(self._keys >> IDBITS, idArray)
+        mask |= np.isin(self._keys & IDMASK, idArray)
+        return mask, ids
+
+    def __len__(self):
+        return len(self._keys) + len(self._pending)
+
+    def __contains__(self, pair):
+        key = self._key(*pair)
+        return key in self._pending or self._index(key) is not None
+
+    def get(self, id1, id2):
+        """Return the count between id1 and id2, 0 if not connected.
+        """
+        key = self._key(id1, id2)
+        count = self._pending.get(key)
+        if count is not None:
+            return count
+
+        index = self._index(key)
+        return 0 if index is None else int(self._counts[index])
+
+    def increment(self, id1, id2):
+        """Add one to the count between id1 and id2 and return the new count.
+        """
+        key = self._key(id1, id2)
+        index = None if key in self._pending else self._index(key)
+        if index is not None:
+            self._counts[index] += 1
+            return int(self._counts[index])
+
+        count = self._pending[key] = self._pending.get(key, 0) + 1
+        if len(self._pending) >= max(MINMERGESIZE, len(self._keys) // 8):
+            self._merge()
+        return count
+
+    def decrement(self, id1, id2):
+        """Subtract one from the count between id1 and id2 and return the new count.
+        Raise KeyError if the ids are not connected.
+        """
+        key = self._key(id1, id2)
+        if key in self._pending:
+            self._pending[key] -= 1
+            return self._pending[key]
+
+        index = self._index(key)
+        if index is None:
+            raise KeyError((id1, id2))
+        self._counts[index] -= 1
+        return int(self._counts[index])
+
+    def clear(self, ids=None):
+        """Set the counts of all the pairs containing any of ids to 0, or all the counts if ids is None.
+        The pairs are kept.
+        """
+        if ids is None:
+            self._counts[:] = 0
+            self._pending = dict.fromkeys(self._pending, 0)
+            return
+
+        mask, ids = self._matchIds(ids)
+        self._counts[mask] = 0
+        for key in self._pending:
+            if key >> IDBITS in ids or key & IDMASK in ids:
+                self._pending[key] = 0
+
+    def discard(self, ids):
+        """Remove all the pairs containing any of ids.
+        """
+        mask, ids = self._matchIds(ids)
+        if mask.any():
+            self._keys = self._keys[~mask]
+            self._counts = self._counts[~mask]
+        for key in [key for key in self._pending if key >> IDBITS in ids or key & IDMASK in ids]:
+            del self._pending[key]
+
+    def reset(self):
+        """Remove all the pairs.
+        """
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._counts = np.zeros(0, dtype=np.int32)
+        self._pending.clear()
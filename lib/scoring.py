@@ -26,9 +26,21 @@ __date__ = "$Date: 2016-05-23 10:02:47 +0100 (Mon, 23 May 2016) $"
 #=========================================================================================
 
 import math
-from numba import jit
+import time
+import threading
+import numpy as np
+from importlib.util import find_spec
+from functools import partial
+from collections import OrderedDict
+from ccpn.util.Logging import getLogger
+
+
+# numba is only imported when the kernels are compiled, see ScoringMethod.compile
+HAVE_NUMBA = find_spec('numba') is not None
+
+MAXMATCHES = 7  # number of matches shown by the Backbone Assignment module and written by the match command
+
 
-@jit(nopython = True)
 def qScore(value1: float, value2: float):
     if value1 + value2 == 0: return 0 # otherwise is a ZeroDivision error.
     return math.sqrt(((value1 - value2) ** 2) / ((value1 + value2) ** 2))
@@ -47,29 +59,976 @@ def euclidean(valueList):
     return math.sqrt(score)
 
 
-functionDict = {
-    'averageQScore': averageQScore,
-    'euclidean': euclidean,
-    }
+#=========================================================================================
+# Scoring kernels
+#
+# A kernel scores every row of matchValues (matches x atoms) against every row of
+# queryValues (queries x atoms) and returns a (queries x matches) array of scores;
+# atoms that are NaN in either are ignored. scales is a per-atom array of weights
+# that kernels may use, e.g. as per-atom tolerances.
+#
+# The ...Compiled kernels are plain python, compiled by numba on demand.
+#=========================================================================================
+
+def averageQScoreArray(matchValues, queryValues, scales=None):
+    """NumPy averageQScore kernel.
+    Normalised as averageQScore, i.e. by the length of a (match, query) pair.
+    """
+    matchValues = matchValues[np.newaxis, :, :]
+    queryValues = queryValues[:, np.newaxis, :]
+    total = matchValues + queryValues
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.abs(matchValues - queryValues) / np.abs(total)
+    scores[total == 0] = 0
+    return np.nansum(scores, axis=-1) / 2
+
 
+def euclideanArray(matchValues, queryValues, scales=None):
+    """NumPy euclidean kernel.
+    """
+    deltas = matchValues[np.newaxis, :, :] - queryValues[:, np.newaxis, :]
+    return np.sqrt(np.nansum(deltas ** 2, axis=-1))
 
-def getNmrResidueMatches(queryShifts, matchNmrResiduesDict, scoringMethod, isotopeCode='13C'):
-    scoringMatrix = {}
-    for res, mShifts in matchNmrResiduesDict.items():
 
-        if res.isDeleted or res._flaggedForDelete:
+def mahalanobisArray(matchValues, queryValues, scales):
+    """NumPy kernel for the mahalanobis distance with a diagonal covariance,
+    i.e. the euclidean distance with each atom scaled by its tolerance in scales.
+    """
+    deltas = (matchValues[np.newaxis, :, :] - queryValues[:, np.newaxis, :]) / scales
+    return np.sqrt(np.nansum(deltas ** 2, axis=-1))
+
+
+def averageQScoreCompiled(matchValues, queryValues, scales):
+    """Compiled averageQScore kernel.
+    """
+    scores = np.zeros((queryValues.shape[0], matchValues.shape[0]))
+    for ii in range(queryValues.shape[0]):
+        for jj in range(matchValues.shape[0]):
+            score = 0.0
+            for kk in range(queryValues.shape[1]):
+                value1 = matchValues[jj, kk]
+                value2 = queryValues[ii, kk]
+                total = value1 + value2
+                if not np.isnan(total) and total != 0:
+                    score += abs(value1 - value2) / abs(total)
+            scores[ii, jj] = score / 2
+    return scores
+
+
+def euclideanCompiled(matchValues, queryValues, scales):
+    """Compiled euclidean kernel.
+    """
+    scores = np.zeros((queryValues.shape[0], matchValues.shape[0]))
+    for ii in range(queryValues.shape[0]):
+        for jj in range(matchValues.shape[0]):
+            score = 0.0
+            for kk in range(queryValues.shape[1]):
+                delta = matchValues[jj, kk] - queryValues[ii, kk]
+                if not np.isnan(delta):
+                    score += delta * delta
+            scores[ii, jj] = math.sqrt(score)
+    return scores
+
+
+def mahalanobisCompiled(matchValues, queryValues, scales):
+    """Compiled mahalanobis kernel.
+    """
+    scores = np.zeros((queryValues.shape[0], matchValues.shape[0]))
+    for ii in range(queryValues.shape[0]):
+        for jj in range(matchValues.shape[0]):
+            score = 0.0
+            for kk in range(queryValues.shape[1]):
+                delta = (matchValues[jj, kk] - queryValues[ii, kk]) / scales[kk]
+                if not np.isnan(delta):
+                    score += delta * delta
+            scores[ii, jj] = math.sqrt(score)
+    return scores
+
+
+#=========================================================================================
+# Scoring method registry
+#=========================================================================================
+
+class ScoringMethod(object):
+    """
+    A named scoring method, defined by a NumPy kernel and optionally a kernel with the same signature
+    that is compiled by numba in nopython mode; the compiled kernel is used when it is available.
+
+    Compilation is lazy: the first call to getKernel starts compiling in a background thread and
+    the NumPy kernel is used until it has finished, so that no call waits for the compiler.
+    Compiled kernels are cached on disk by numba, so later sessions only load them.
+
+    atomScales is a dict of {atomName: scale} passed to the kernels as a per-atom array,
+    with defaultScale for atoms not in the dict.
+    Setting useCompiled to False forces the NumPy kernel.
+    Calling the method scores a list of (matchValue, queryValue) pairs, as the functions in functionDict.
+    """
+
+    def __init__(self, name, kernel, compiledKernel=None, atomScales=None, defaultScale=1.0):
+        self.name = name
+        self.kernel = kernel
+        self.compiledKernel = compiledKernel
+        self.atomScales = atomScales or {}
+        self.defaultScale = defaultScale
+        self.useCompiled = True
+
+        self._compiled = None
+        self._compileFailed = not HAVE_NUMBA or compiledKernel is None
+        self._compileStarted = False
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<ScoringMethod: %s>' % self.name
+
+    @property
+    def isCompiled(self):
+        """True if the compiled kernel is available
+        """
+        return self._compiled is not None
+
+    def compile(self):
+        """Compile the kernel with numba, waiting until it has finished.
+        Returns True if the compiled kernel is available.
+        """
+        with self._lock:
+            if self._compiled is None and not self._compileFailed:
+                try:
+                    from numba import jit
+
+                    compiled = jit(nopython=True, cache=True)(self.compiledKernel)
+                    # compile for the types used in score
+                    values = np.zeros((1, 1), dtype=float)
+                    compiled(values, values, np.ones(1, dtype=float))
+                    self._compiled = compiled
+
+                except Exception as es:
+                    getLogger().warning('Scoring method %s: compiling failed, using NumPy kernel - %s' % (self.name, es))
+                    self._compileFailed = True
+
+        return self._compiled is not None
+
+    def compileInBackground(self):
+        """Start compiling the kernel in a background thread, if not already started
+        """
+        # not locked, as compile may hold the lock for some time; compile is safe to start twice
+        if self._compileStarted or self._compileFailed:
+            return
+        self._compileStarted = True
+
+        threading.Thread(target=self.compile, name='compile %s' % self.name, daemon=True).start()
+
+    def getKernel(self):
+        """Return the kernel to use for scoring
+        """
+        if not self.useCompiled:
+            return self.kernel
+        if self._compiled is not None:
+            return self._compiled
+        self.compileInBackground()
+        return self.kernel
+
+    def getScales(self, atomNames):
+        """Return the array of scales for atomNames
+        """
+        return np.array([self.atomScales.get(atomName, self.defaultScale) for atomName in atomNames], dtype=float)
+
+    def score(self, matchValues, queryValues, atomNames):
+        """Score every row of matchValues (matches x atoms) against every row of queryValues (queries x atoms),
+        where the atom columns are named by atomNames; returns a (queries x matches) array.
+        """
+        matchValues = np.ascontiguousarray(matchValues, dtype=float)
+        queryValues = np.ascontiguousarray(queryValues, dtype=float)
+        return self.getKernel()(matchValues, queryValues, self.getScales(atomNames))
+
+    def __call__(self, valueList, atomNames=None):
+        if not valueList:
+            return 0
+        values = np.array(valueList, dtype=float)
+        return self.score(values[np.newaxis, :, 0], values[np.newaxis, :, 1], atomNames or [None] * len(values))[0, 0].item()
+
+    def __getstate__(self):
+        # compiled kernels and locks are not passed to other processes
+        state = self.__dict__.copy()
+        state.update(_compiled=None, _compileStarted=False, _lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+scoringMethods = OrderedDict()
+
+# the scoring functions on lists of (matchValue, queryValue) pairs, by name
+functionDict = {}
+
+
+def registerScoringMethod(scoringMethod: ScoringMethod, function=None):
+    """Register scoringMethod by its name; function is an optional replacement for scoring
+    lists of (matchValue, queryValue) pairs in functionDict.
+    """
+    scoringMethods[scoringMethod.name] = scoringMethod
+    functionDict[scoringMethod.name] = function or scoringMethod
+
+
+def getScoringMethod(name) -> ScoringMethod:
+    """Return the registered ScoringMethod name
+    """
+    if isinstance(name, ScoringMethod):
+        return name
+    if name not in scoringMethods:
+        raise ValueError('Unknown scoring method %r; should be one of %s' % (name, list(scoringMethods.keys())))
+    return scoringMethods[name]
+
+
+registerScoringMethod(ScoringMethod('averageQScore', averageQScoreArray, averageQScoreCompiled),
+                      function=averageQScore)
+registerScoringMethod(ScoringMethod('euclidean', euclideanArray, euclideanCompiled),
+                      function=euclidean)
+registerScoringMethod(ScoringMethod('mahalanobis', mahalanobisArray, mahalanobisCompiled,
+                                    atomScales={'CA': 0.2, 'CB': 0.4, 'C': 0.2}))
+
+
+def warmUpScoring(names=None, background=True):
+    """Compile the kernels of the registered scoring methods, or those in names.
+    If background is True, compile in a background thread and return immediately,
+    otherwise wait until all kernels have been compiled.
+    """
+    methods = [getScoringMethod(name) for name in names] if names else list(scoringMethods.values())
+
+    if background:
+        for method in methods:
+            method.compileInBackground()
+    else:
+        for method in methods:
+            method.compile()
+
+
+class ShiftMatrix(object):
+    """
+    Dense (nmrResidues x atomNames) array of chemical shift values for a single isotopeCode.
+    Missing shifts are stored as NaN.
+
+    Rows can be inserted, replaced and removed in place, so that a matrix can be built once and
+    then kept up-to-date from notifiers; storage grows geometrically and removing a row moves
+    the last row into its place.
+    """
+
+    def __init__(self, isotopeCode='13C'):
+        self.isotopeCode = isotopeCode
+        self.nmrResidues = []
+        self.atomNames = []
+        self._rowIndex = {}
+        self._columnIndex = {}
+        self._values = np.full((0, 0), np.nan, dtype=float)
+        self._shiftIndex = None
+
+        # incremented on every change to the values
+        self.version = 0
+
+    @classmethod
+    def fromShiftsDict(cls, shiftsDict, isotopeCode='13C'):
+        """Create a ShiftMatrix from a dict of {nmrResidue: [chemicalShift, ...]}
+        """
+        self = cls(isotopeCode=isotopeCode)
+        self._resize(len(shiftsDict), 4)
+        for nmrResidue, shifts in shiftsDict.items():
+            self.setShifts(nmrResidue, shifts)
+
+        return self
+
+    def __len__(self):
+        return len(self.nmrResidues)
+
+    def __contains__(self, nmrResidue):
+        return nmrResidue in self._rowIndex
+
+    @property
+    def values(self):
+        """The (nmrResidues x atomNames) view of the shift values
+        """
+        return self._values[:len(self.nmrResidues), :len(self.atomNames)]
+
+    @property
+    def shiftIndex(self):
+        """The ShiftIndex over the values, for tolerance-window queries
+        """
+        if self._shiftIndex is None:
+            self._shiftIndex = ShiftIndex(self)
+        return self._shiftIndex
+
+    def _resize(self, rows, columns):
+        """Reallocate the storage to hold at least rows x columns
+        """
+        rows = max(rows, self._values.shape[0])
+        columns = max(columns, self._values.shape[1])
+        values = np.full((rows, columns), np.nan, dtype=float)
+        oldRows, oldColumns = self._values.shape
+        values[:oldRows, :oldColumns] = self._values
+        self._values = values
+
+    def _getColumn(self, atomName):
+        """Return the column for atomName, adding a new column if required
+        """
+        column = self._columnIndex.get(atomName)
+        if column is None:
+            column = self._columnIndex[atomName] = len(self.atomNames)
+            self.atomNames.append(atomName)
+            if column >= self._values.shape[1]:
+                self._resize(0, max(4, 2 * column))
+        return column
+
+    def setShifts(self, nmrResidue, shifts):
+        """Insert or replace the row of nmrResidue with the values of shifts.
+        Shifts of a different isotopeCode, or with no value, are ignored.
+        """
+        row = self._rowIndex.get(nmrResidue)
+        if row is None:
+            row = self._rowIndex[nmrResidue] = len(self.nmrResidues)
+            self.nmrResidues.append(nmrResidue)
+            if row >= self._values.shape[0]:
+                self._resize(max(16, 2 * row), 0)
+
+        self.version += 1
+        oldValues = self._values[row, :len(self.atomNames)].copy()
+        self._values[row] = np.nan
+        for shift in shifts:
+            if shift and shift.nmrAtom.isotopeCode == self.isotopeCode and shift.value is not None:
+                # _getColumn may reallocate the values, so get the column first
+                column = self._getColumn(shift.nmrAtom.name)
+                self._values[row, column] = shift.value
+
+        if self._shiftIndex is not None:
+            self._shiftIndex._replaceRow(row, oldValues, self._values[row, :len(self.atomNames)])
+
+    def removeNmrResidue(self, nmrResidue):
+        """Remove the row of nmrResidue, if present
+        """
+        row = self._rowIndex.pop(nmrResidue, None)
+        if row is None:
+            return
+
+        self.version += 1
+        last = len(self.nmrResidues) - 1
+        if self._shiftIndex is not None:
+            self._shiftIndex._deleteRow(row, self._values[row, :len(self.atomNames)],
+                                        last, self._values[last, :len(self.atomNames)])
+        if row != last:
+            lastNmrResidue = self.nmrResidues[last]
+            self.nmrResidues[row] = lastNmrResidue
+            self._rowIndex[lastNmrResidue] = row
+            self._values[row] = self._values[last]
+        self.nmrResidues.pop()
+        self._values[last] = np.nan
+
+    def getQueryVector(self, queryShifts):
+        """Return (columns, values) arrays for the queryShifts of the matrix isotopeCode,
+        or None if the query contains atomNames that are not present in the matrix.
+        Only the first shift for any atomName is used.
+        """
+        columns = []
+        values = []
+        for shift in queryShifts:
+            if shift and shift.nmrAtom.isotopeCode == self.isotopeCode:
+                column = self._columnIndex.get(shift.nmrAtom.name)
+                if column is None or shift.value is None:
+                    return None
+                if column not in columns:
+                    columns.append(column)
+                    values.append(shift.value)
+
+        return np.array(columns, dtype=int), np.array(values, dtype=float)
+
+    def scoreQuery(self, queryShifts, scoringMethod, tolerances=None):
+        """Score the queryShifts against every row of the matrix.
+        Returns (rows, scores) arrays containing only those nmrResidues that have shifts for
+        all the query atomNames, excluding the nmrResidue(s) to which the queryShifts belong.
+
+        tolerances is an optional dict of {atomName: tolerance}; if specified, only rows with shifts within
+        tolerance of the query, for every atomName in both the query and tolerances, are scored.
+        """
+        empty = (np.empty(0, dtype=int), np.empty(0, dtype=float))
+
+        query = self.getQueryVector(queryShifts)
+        if query is None or not len(query[0]) or not len(self):
+            return empty
+        columns, queryValues = query
+
+        rows = None
+        if tolerances:
+            atomValues = dict(zip([self.atomNames[column] for column in columns.tolist()], queryValues.tolist()))
+            rows = self.shiftIndex.getCandidates(atomValues, tolerances)
+        if rows is None:
+            rows = np.arange(len(self))
+
+        matchValues = self.values[np.ix_(rows, columns)]
+        valid = ~np.isnan(matchValues).any(axis=1)
+
+        # a shift cannot be matched against itself
+        excludeRows = [self._rowIndex.get(shift.nmrAtom.nmrResidue) for shift in queryShifts if shift]
+        excludeRows = [row for row in excludeRows if row is not None]
+        if excludeRows:
+            valid &= ~np.isin(rows, excludeRows)
+
+        if not valid.any():
+            return empty
+
+        atomNames = [self.atomNames[column] for column in columns.tolist()]
+        scores = getScoringMethod(scoringMethod).score(matchValues[valid], queryValues[np.newaxis, :], atomNames)
+        return rows[valid], scores[0]
+
+
+class ShiftIndex(object):
+    """
+    Sorted-array index over the columns of a ShiftMatrix, returning the rows with shifts inside
+    a tolerance window in O(log n + m) for m matching rows.
+    The index is built on the first query; after that the ShiftMatrix updates it row-by-row as the
+    shifts change, so that an edit costs a binary search and an O(n) array shift per column,
+    rather than a full re-sort.
+    """
+
+    def __init__(self, shiftMatrix):
+        self.shiftMatrix = shiftMatrix
+        self._version = None
+        self._sortedRows = {}
+        self._sortedValues = {}
+
+    def _update(self):
+        """Build the sorted columns if the index has not been built, or is out of step with the ShiftMatrix
+        """
+        if self._version == self.shiftMatrix.version:
+            return
+
+        values = self.shiftMatrix.values
+        self._sortedRows = {}
+        self._sortedValues = {}
+        for column, atomName in enumerate(self.shiftMatrix.atomNames):
+            columnValues = values[:, column]
+            rows = np.flatnonzero(~np.isnan(columnValues))
+            rows = rows[np.argsort(columnValues[rows], kind='stable')]
+            self._sortedRows[atomName] = rows
+            self._sortedValues[atomName] = columnValues[rows]
+        self._version = self.shiftMatrix.version
+
+    def _findRow(self, atomName, value, row):
+        """Return the position of row, with value, in the sorted column of atomName
+        """
+        sortedValues = self._sortedValues[atomName]
+        start = np.searchsorted(sortedValues, value, side='left')
+        end = np.searchsorted(sortedValues, value, side='right')
+        return start + np.flatnonzero(self._sortedRows[atomName][start:end] == row)[0]
+
+    def _isStale(self):
+        """True if the index has not been built, or has missed a change to the ShiftMatrix;
+        called by the ShiftMatrix after incrementing its version for a single change.
+        """
+        return self._version is None or self._version != self.shiftMatrix.version - 1
+
+    def _removeValues(self, row, rowValues):
+        for atomName, value in zip(self.shiftMatrix.atomNames, rowValues.tolist()):
+            if value == value and atomName in self._sortedValues:
+                position = self._findRow(atomName, value, row)
+                self._sortedRows[atomName] = np.delete(self._sortedRows[atomName], position)
+                self._sortedValues[atomName] = np.delete(self._sortedValues[atomName], position)
+
+    def _insertValues(self, row, rowValues):
+        for atomName, value in zip(self.shiftMatrix.atomNames, rowValues.tolist()):
+            if value == value:
+                sortedValues = self._sortedValues.get(atomName, np.empty(0, dtype=float))
+                sortedRows = self._sortedRows.get(atomName, np.empty(0, dtype=int))
+                position = np.searchsorted(sortedValues, value, side='right')
+                self._sortedRows[atomName] = np.insert(sortedRows, position, row)
+                self._sortedValues[atomName] = np.insert(sortedValues, position, value)
+
+    def _replaceRow(self, row, oldValues, newValues):
+        """Replace the values of row, oldValues, with newValues in the sorted columns
+        """
+        if self._isStale():
+            return
+        self._removeValues(row, oldValues)
+        self._insertValues(row, newValues)
+        self._version = self.shiftMatrix.version
+
+    def _deleteRow(self, row, rowValues, lastRow, lastValues):
+        """Remove row, with values rowValues, from the sorted columns, and renumber lastRow,
+        with values lastValues, as row
+        """
+        if self._isStale():
+            return
+        self._removeValues(row, rowValues)
+        if lastRow != row:
+            for atomName, value in zip(self.shiftMatrix.atomNames, lastValues.tolist()):
+                if value == value and atomName in self._sortedValues:
+                    self._sortedRows[atomName][self._findRow(atomName, value, lastRow)] = row
+        self._version = self.shiftMatrix.version
+
+    def getRows(self, atomName, minValue, maxValue):
+        """Return the sorted array of rows with a shift for atomName in the range [minValue, maxValue]
+        """
+        self._update()
+        if atomName not in self._sortedValues:
+            return np.empty(0, dtype=int)
+
+        sortedValues = self._sortedValues[atomName]
+        start = np.searchsorted(sortedValues, minValue, side='left')
+        end = np.searchsorted(sortedValues, maxValue, side='right')
+        return np.sort(self._sortedRows[atomName][start:end])
+
+    def getCandidates(self, atomValues, tolerances):
+        """Return the sorted array of rows whose shifts are within tolerance of atomValues,
+        for every atomName in both atomValues {atomName: value} and tolerances {atomName: tolerance}.
+        Returns None if none of the atomNames have a tolerance, i.e., all rows are candidates.
+        """
+        candidates = None
+        for atomName, value in atomValues.items():
+            tolerance = tolerances.get(atomName)
+            if tolerance is None:
+                continue
+
+            rows = self.getRows(atomName, value - tolerance, value + tolerance)
+            candidates = rows if candidates is None else np.intersect1d(candidates, rows, assume_unique=True)
+            if not len(candidates):
+                break
+
+        return candidates
+
+
+def _asShiftMatrix(matchNmrResiduesDict, isotopeCode):
+    """Return matchNmrResiduesDict as a ShiftMatrix, building one from a dict if required
+    """
+    if isinstance(matchNmrResiduesDict, ShiftMatrix):
+        return matchNmrResiduesDict
+    return ShiftMatrix.fromShiftsDict(matchNmrResiduesDict, isotopeCode=isotopeCode)
+
+
+def _makeMatches(nmrResidues, values, rows, scores, columns, queryValues, atomNames, skipDeleted=True):
+    """Return the list of (score, nmrResidue, {atomName: delta}) for the rows of values,
+    skipping deleted nmrResidues if skipDeleted; the deltas (match - query) of all rows are calculated together.
+    """
+    deltas = (values[np.ix_(rows, columns)] - queryValues).tolist()
+
+    matches = []
+    for row, score, rowDeltas in zip(rows.tolist(), scores.tolist(), deltas):
+        res = nmrResidues[row]
+        if skipDeleted and (res.isDeleted or res._flaggedForDelete):
             continue
+        matches.append((score, res, dict(zip(atomNames, rowDeltas))))
+    return matches
+
+
+def lowestScoreIndices(scores, k=None):
+    """Return the indices of the k lowest scores in increasing order of score; all if k is None.
+    Uses a partition so that the cost is O(n + k log k); tied scores are kept in index order.
+    """
+    if k is None or k >= len(scores):
+        return np.argsort(scores, kind='stable')
+    if k <= 0:
+        return np.empty(0, dtype=int)
+
+    # include every score tied with the kth so that the selection does not depend on the partition
+    kth = np.partition(scores, k - 1)[k - 1]
+    indices = np.flatnonzero(scores <= kth)
+    return indices[np.argsort(scores[indices], kind='stable')][:k]
+
+
+def getNmrResidueMatches(queryShifts, matchNmrResiduesDict, scoringMethod, isotopeCode='13C', tolerances=None):
+    """Score queryShifts against the shifts of every nmrResidue in matchNmrResiduesDict
+    using the registered scoringMethod.
 
-        scoringValues = []
-        mShifts2 = [shift for shift in mShifts if shift and shift.nmrAtom.isotopeCode == isotopeCode]
-        for mShift in mShifts2:
-            qShifts2 = [shift for shift in queryShifts if shift and shift.nmrAtom.isotopeCode == isotopeCode]
-            for qShift in queryShifts:
-                if qShift and mShift and qShift != mShift:
-                    if mShift.nmrAtom.name == qShift.nmrAtom.name:
-                        scoringValues.append((mShift.value, qShift.value))
-        if scoringValues and len(scoringValues) == len(qShifts2):
-            score = functionDict[scoringMethod](scoringValues)
-            scoringMatrix[score] = res
+    matchNmrResiduesDict is either a dict of {nmrResidue: [chemicalShift, ...]} or a prebuilt ShiftMatrix.
+    tolerances is an optional dict of {atomName: tolerance} restricting the candidates before scoring.
+    Returns a dict of {score: nmrResidue}.
+    """
+    shiftMatrix = _asShiftMatrix(matchNmrResiduesDict, isotopeCode)
+    rows, scores = shiftMatrix.scoreQuery(queryShifts, scoringMethod, tolerances=tolerances)
+
+    scoringMatrix = {}
+    for row, score in zip(rows.tolist(), scores.tolist()):
+        res = shiftMatrix.nmrResidues[row]
+        if res.isDeleted or res._flaggedForDelete:
+            continue
+        scoringMatrix[score] = res
 
     return scoringMatrix
+
+
+def getNmrResidueTopMatches(queryShifts, matchNmrResiduesDict, scoringMethod, maxMatches=None, isotopeCode='13C',
+                            tolerances=None):
+    """Score queryShifts against the shifts of every nmrResidue in matchNmrResiduesDict
+    using the registered scoringMethod, and return the best maxMatches; all if maxMatches is None.
+
+    matchNmrResiduesDict is either a dict of {nmrResidue: [chemicalShift, ...]} or a prebuilt ShiftMatrix.
+    tolerances is an optional dict of {atomName: tolerance} restricting the candidates before scoring.
+    Returns a list of (score, nmrResidue, {atomName: delta}) tuples in order of increasing score,
+    where delta is the match shift minus the query shift.
+    Tied scores are all retained, in the order of the nmrResidues in matchNmrResiduesDict.
+    """
+    shiftMatrix = _asShiftMatrix(matchNmrResiduesDict, isotopeCode)
+    rows, scores = shiftMatrix.scoreQuery(queryShifts, scoringMethod, tolerances=tolerances)
+    if not len(rows):
+        return []
+
+    columns, queryValues = shiftMatrix.getQueryVector(queryShifts)
+    atomNames = [shiftMatrix.atomNames[column] for column in columns.tolist()]
+
+    # deleted nmrResidues are only rejected when selected, so widen the selection until enough are found
+    k = maxMatches
+    while True:
+        indices = lowestScoreIndices(scores, k)
+        matches = _makeMatches(shiftMatrix.nmrResidues, shiftMatrix.values, rows[indices], scores[indices],
+                               columns, queryValues, atomNames)
+
+        if k is None or len(matches) >= maxMatches or k >= len(scores):
+            return matches[:maxMatches]
+        k *= 2
+
+
+#=========================================================================================
+# Batch scoring
+#=========================================================================================
+
+MAXCHUNKELEMENTS = 2 ** 22  # bound on the (queries x nmrResidues x atoms) elements scored at once
+
+# values of the ShiftMatrix shared with the worker processes of getAllNmrResidueMatches
+_poolValues = None
+
+
+def _initialisePool(values):
+    global _poolValues
+    _poolValues = values
+
+
+def createMatchingPool(shiftMatrix, processes=None):
+    """Return a ProcessPoolExecutor of processes workers (None or 0 for the cpu count) for
+    getAllNmrResidueMatches; the values of shiftMatrix are copied to each worker once, when it starts.
+    The pool is only valid while shiftMatrix is unchanged.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    return ProcessPoolExecutor(max_workers=processes or None,
+                               initializer=_initialisePool, initargs=(np.array(shiftMatrix.values),))
+
+
+def scoreShiftMatrixRows(values, queryRows, scoringMethod, atomNames, tolerances=None):
+    """Score the rows queryRows of values (nmrResidues x atoms) against every row of values,
+    where the atom columns are named by atomNames.
+    tolerances is an optional dict of {column: tolerance}.
+    Returns a (len(queryRows) x nmrResidues) array of scores, with inf where a row does not match a query;
+    a row matches if it has shifts for all the atoms of the query, within tolerance, and is not the query.
+    """
+    queryRows = np.asarray(queryRows, dtype=int)
+    return scoreShiftValues(values, values[queryRows], scoringMethod, atomNames, tolerances=tolerances,
+                            excludeRows=queryRows)
+
+
+def scoreShiftValues(matchValues, queryValues, scoringMethod, atomNames, tolerances=None, excludeRows=None):
+    """Score every row of queryValues (queries x atoms) against every row of matchValues (matches x atoms),
+    where the atom columns of both are named by atomNames.
+    tolerances is an optional dict of {column: tolerance}; excludeRows is an optional array of the row
+    of matchValues that cannot match each query, -1 for none.
+    Returns a (queries x matches) array of scores, with inf where a row does not match a query.
+    """
+    queryMask = ~np.isnan(queryValues[:, np.newaxis, :])
+    valid = ~(np.isnan(matchValues[np.newaxis, :, :]) & queryMask).any(axis=-1)
+    valid &= queryMask.any(axis=-1)
+    if tolerances:
+        for column, tolerance in tolerances.items():
+            valid &= ~(np.abs(matchValues[np.newaxis, :, column] - queryValues[:, np.newaxis, column]) > tolerance)
+    if excludeRows is not None:
+        excludeRows = np.asarray(excludeRows, dtype=int)
+        queries = np.flatnonzero(excludeRows >= 0)
+        valid[queries, excludeRows[queries]] = False
+
+    scores = getScoringMethod(scoringMethod).score(matchValues, queryValues, atomNames)
+    scores[~valid] = np.inf
+    return scores
+
+
+def _getColumnTolerances(shiftMatrix, tolerances):
+    """Return the dict of {atomName: tolerance} as {column: tolerance} for the columns of shiftMatrix
+    """
+    if not tolerances:
+        return None
+    return {shiftMatrix._columnIndex[atomName]: tolerance for atomName, tolerance in tolerances.items()
+            if atomName in shiftMatrix._columnIndex}
+
+
+def _scoreChunk(queryRows, scoringMethod, atomNames, tolerances, maxMatches, values=None):
+    """Score a chunk of queryRows and return the (indices, scores) of the best maxMatches for each query,
+    as lists of arrays; non-matching rows are removed.
+    """
+    scores = scoreShiftMatrixRows(_poolValues if values is None else values, queryRows, scoringMethod, atomNames,
+                                  tolerances)
+
+    chunkIndices = []
+    chunkScores = []
+    for rowScores in scores:
+        indices = lowestScoreIndices(rowScores, maxMatches)
+        indices = indices[np.isfinite(rowScores[indices])]
+        chunkIndices.append(indices)
+        chunkScores.append(rowScores[indices])
+    return chunkIndices, chunkScores
+
+
+def getAllNmrResidueMatches(shiftMatrix, scoringMethod, maxMatches=None, queryNmrResidues=None,
+                            tolerances=None, chunkSize=None, processes=None, executor=None):
+    """Score every nmrResidue of shiftMatrix, or those in queryNmrResidues, against every other
+    nmrResidue of shiftMatrix using the registered scoringMethod.
+
+    The query shifts are the shifts of the nmrResidue in shiftMatrix, as for getNmrResidueTopMatches.
+    The queries are scored in chunks of chunkSize, by default bounded by MAXCHUNKELEMENTS;
+    if processes is not None the chunks are spread over a pool of that many processes (0 for the cpu count);
+    executor is a pool from createMatchingPool for shiftMatrix, to be reused over several calls, and only
+    the query rows of each chunk are sent to it.
+
+    Returns a dict of {nmrResidue: [(score, nmrResidue, {atomName: delta}), ...]} with the best maxMatches
+    in order of increasing score, as for getNmrResidueTopMatches.
+    """
+    if queryNmrResidues is None:
+        queryNmrResidues = list(shiftMatrix.nmrResidues)
+    queryRows = [shiftMatrix._rowIndex[nmrResidue] for nmrResidue in queryNmrResidues]
+    values = np.array(shiftMatrix.values)
+    if not queryRows or not values.size:
+        return {nmrResidue: [] for nmrResidue in queryNmrResidues}
+
+    tolerances = _getColumnTolerances(shiftMatrix, tolerances)
+    if not chunkSize:
+        chunkSize = max(1, MAXCHUNKELEMENTS // values.size)
+    chunks = [queryRows[ii:ii + chunkSize] for ii in range(0, len(queryRows), chunkSize)]
+
+    # fetch a few extra to allow for deleted nmrResidues
+    k = None if maxMatches is None else maxMatches + 4
+    scoringMethod = getScoringMethod(scoringMethod)
+    atomNames = list(shiftMatrix.atomNames)
+
+    if executor is not None:
+        chunkResults = list(executor.map(partial(_scoreChunk, scoringMethod=scoringMethod, atomNames=atomNames,
+                                                 tolerances=tolerances, maxMatches=k), chunks))
+    elif processes is not None:
+        with createMatchingPool(shiftMatrix, processes) as executor:
+            chunkResults = list(executor.map(partial(_scoreChunk, scoringMethod=scoringMethod, atomNames=atomNames,
+                                                     tolerances=tolerances, maxMatches=k), chunks))
+    else:
+        chunkResults = [_scoreChunk(chunk, scoringMethod, atomNames, tolerances, k, values=values) for chunk in chunks]
+
+    results = {}
+    queries = iter(zip(queryNmrResidues, queryRows))
+    for chunkIndices, chunkScores in chunkResults:
+        for indices, scores in zip(chunkIndices, chunkScores):
+            queryNmrResidue, queryRow = next(queries)
+            columns = np.flatnonzero(~np.isnan(values[queryRow]))
+            queryAtomNames = [atomNames[column] for column in columns.tolist()]
+            matches = _makeMatches(shiftMatrix.nmrResidues, values, indices, scores,
+                                   columns, values[queryRow, columns], queryAtomNames)
+            results[queryNmrResidue] = matches[:maxMatches]
+
+    return results
+
+
+def _getValueMatches(values, nmrResidues, queryRows, scoringMethod, atomNames, tolerances, maxMatches):
+    """Return the list of [(score, nmrResidue, {atomName: delta}), ...] best maxMatches for each of queryRows
+    of values, as getAllNmrResidueMatches, but calculated only from the values array and the nmrResidues list;
+    deleted nmrResidues are not removed, so this may be called from a thread other than the main thread.
+    """
+    chunkSize = max(1, MAXCHUNKELEMENTS // max(1, values.size))
+
+    results = []
+    for ii in range(0, len(queryRows), chunkSize):
+        chunk = queryRows[ii:ii + chunkSize]
+        for queryRow, indices, scores in zip(chunk, *_scoreChunk(chunk, scoringMethod, atomNames, tolerances,
+                                                                 maxMatches, values=values)):
+            columns = np.flatnonzero(~np.isnan(values[queryRow]))
+            queryAtomNames = [atomNames[column] for column in columns.tolist()]
+            results.append(_makeMatches(nmrResidues, values, indices, scores, columns, values[queryRow, columns],
+                                        queryAtomNames, skipDeleted=False))
+
+        # let the main thread run between chunks
+        time.sleep(0)
+
+    return results
+
+
+MATCHCACHEEXTRA = 4  # matches cached beyond maxMatches, to allow for nmrResidues deleted later
+
+
+class MatchCache(object):
+    """
+    Cache of the best matches for the nmrResidues in a ShiftMatrix.
+
+    A query that is not in the cache is scored on its own by getNmrResidueTopMatches, and the missing
+    queries are filled in a background thread from a copy of the shift values, so that no call waits
+    for the all-vs-all scoring.
+
+    When the shifts of an nmrResidue change, invalidate(nmrResidue) discards only its own matches (its row),
+    and the matches of other queries that contain it, or that its new shifts would now enter (its column);
+    these are recalculated by the next background fill.
+    """
+
+    def __init__(self, shiftMatrix, scoringMethod, maxMatches=None, tolerances=None):
+        self.shiftMatrix = shiftMatrix
+        self.scoringMethod = scoringMethod
+        self.maxMatches = maxMatches
+        self.tolerances = tolerances
+
+        # number of matches held for each query
+        self._cacheMatches = None if maxMatches is None else maxMatches + MATCHCACHEEXTRA
+
+        self._matches = {}  # referenced by query nmrResidue -> list(matches)
+        self._queriesFromMatch = {}  # referenced by match nmrResidue -> set(query nmrResidues)
+
+        # background fill; the changed nmrResidues are recorded while the thread is running
+        self._thread = None
+        self._result = None
+        self._changes = []
+
+    def clear(self):
+        """Discard the cached matches; the result of a running background fill is also discarded
+        """
+        self._matches = {}
+        self._queriesFromMatch = {}
+        self._thread = None
+        self._result = None
+        self._changes = []
+
+    def _setMatches(self, nmrResidue, matches):
+        self._popMatches(nmrResidue)
+        self._matches[nmrResidue] = matches
+        for match in matches:
+            self._queriesFromMatch.setdefault(match[1], set()).add(nmrResidue)
+
+    def _popMatches(self, nmrResidue):
+        matches = self._matches.pop(nmrResidue, ())
+        for match in matches:
+            queries = self._queriesFromMatch.get(match[1])
+            if queries is not None:
+                queries.discard(nmrResidue)
+                if not queries:
+                    del self._queriesFromMatch[match[1]]
+
+    def getMatches(self, nmrResidue, queryShifts):
+        """Return the list of (score, nmrResidue, {atomName: delta}) best matches for nmrResidue.
+        If not cached, queryShifts, the shifts of nmrResidue, are scored with getNmrResidueTopMatches
+        and the cache is filled in the background.
+        """
+        if nmrResidue not in self.shiftMatrix:
+            return []
+
+        self._mergeResult()
+        matches = self._matches.get(nmrResidue)
+        if matches is None:
+            matches = getNmrResidueTopMatches(queryShifts, self.shiftMatrix, self.scoringMethod, self._cacheMatches,
+                                              tolerances=self.tolerances)
+            self._setMatches(nmrResidue, matches)
+            self.fillInBackground()
+
+        return [match for match in matches
+                if not (match[1].isDeleted or match[1]._flaggedForDelete)][:self.maxMatches]
+
+    def invalidate(self, nmrResidue):
+        """Discard the cached matches changed by a change to the shifts of nmrResidue in the ShiftMatrix;
+        call after the ShiftMatrix has been updated.
+        """
+        self._mergeResult()
+        if self._thread is not None:
+            self._changes.append(nmrResidue)
+
+        for query in self._getStaleQueries(self._matches, nmrResidue, self._queriesFromMatch.get(nmrResidue, ())):
+            self._popMatches(query)
+
+    def _getStaleQueries(self, entries, nmrResidue, containing):
+        """Return the queries of entries {query: matches} whose matches are changed by a change to nmrResidue;
+        containing are the queries whose matches already contain nmrResidue.
+        """
+        stale = set(containing)
+        if nmrResidue in entries:
+            stale.add(nmrResidue)
+
+        row = self.shiftMatrix._rowIndex.get(nmrResidue)
+        queries = [query for query in entries if query not in stale]
+        if row is None or not queries:
+            # a removed nmrResidue can only change the matches that contain it
+            return stale
+
+        # queries that are no longer in the matrix are recalculated
+        rowIndex = self.shiftMatrix._rowIndex
+        stale.update(query for query in queries if query not in rowIndex)
+        queries = [query for query in queries if query in rowIndex]
+        if not queries:
+            return stale
+
+        # score the new shifts of nmrResidue against all the cached queries together
+        values = self.shiftMatrix.values
+        queryRows = [rowIndex[query] for query in queries]
+        scores = scoreShiftValues(values[row:row + 1], values[queryRows], self.scoringMethod,
+                                  list(self.shiftMatrix.atomNames),
+                                  tolerances=_getColumnTolerances(self.shiftMatrix, self.tolerances))[:, 0]
+
+        # stale if the nmrResidue is now better than the worst cached match
+        for query, score in zip(queries, scores.tolist()):
+            matches = entries[query]
+            if score != np.inf and (self._cacheMatches is None or len(matches) < self._cacheMatches or
+                                    score <= matches[-1][0]):
+                stale.add(query)
+
+        return stale
+
+    def fillInBackground(self):
+        """Start calculating the matches for the nmrResidues that are not cached in a background thread,
+        if not already running.
+        """
+        self._mergeResult()
+        if self._thread is not None:
+            return
+
+        rowIndex = self.shiftMatrix._rowIndex
+        queries = [nmrResidue for nmrResidue in self.shiftMatrix.nmrResidues if nmrResidue not in self._matches]
+        if not queries:
+            return
+
+        # the thread only uses copies of the matrix, which is updated by notifiers on the main thread
+        values = np.array(self.shiftMatrix.values)
+        args = (queries, values, list(self.shiftMatrix.nmrResidues), [rowIndex[query] for query in queries],
+                getScoringMethod(self.scoringMethod), list(self.shiftMatrix.atomNames),
+                _getColumnTolerances(self.shiftMatrix, self.tolerances))
+
+        self._changes = []
+        self._result = None
+        self._thread = threading.Thread(target=self._fill, args=args, name='fill MatchCache', daemon=True)
+        self._thread.start()
+
+    def _fill(self, queries, values, nmrResidues, queryRows, scoringMethod, atomNames, tolerances):
+        """Calculate the matches for queries in the background thread
+        """
+        try:
+            results = _getValueMatches(values, nmrResidues, queryRows, scoringMethod, atomNames, tolerances,
+                                       self._cacheMatches)
+            results = dict(zip(queries, results))
+
+        except Exception as es:
+            getLogger().warning('MatchCache: background matching failed - %s' % es)
+            results = {}
+
+        # tagged with the thread, so that the result of a thread started before clear() is ignored
+        self._result = (threading.current_thread(), results)
+
+    def _mergeResult(self):
+        """Add the result of a finished background fill to the cache, discarding the matches changed
+        since the fill started.
+        """
+        thread = self._thread
+        if thread is None or thread.is_alive():
+            return
+
+        results = self._result[1] if self._result and self._result[0] is thread else {}
+        self._thread = None
+        self._result = None
+        changes, self._changes = self._changes, []
+
+        for nmrResidue in changes:
+            containing = [query for query, matches in results.items() if any(match[1] is nmrResidue for match in matches)]
+            for query in self._getStaleQueries(results, nmrResidue, containing):
+                results.pop(query, None)
+
+        for query, matches in results.items():
+            if query not in self._matches:
+                self._setMatches(query, matches)
@@ -0,0 +1,277 @@
+"""
+Micro-benchmarks for lib/scoring using synthetic shift tables.
+
+Creates synthetic NmrResidues with CA, CB, C (and N) shifts drawn from the average shifts of the
+twenty amino acids, times the scoring functions and the matching of NmrResidues for a range of
+project sizes, and writes the results as json.
+
+usage:
+    python -m ccpn.AnalysisAssign.lib.scoringBenchmark --sizes 100 1000 10000 --output scoringBenchmark.json
+"""
+#=========================================================================================
+# Licence, Reference and Credits
+#=========================================================================================
+__copyright__ = "Copyright (C) CCPN project (http://www.ccpn.ac.uk) 2014 - 2020"
+__credits__ = ("Ed Brooksbank, Luca Mureddu, Timothy J Ragan & Geerten W Vuister")
+__licence__ = ("CCPN licence. See http://www.ccpn.ac.uk/v3-software/downloads/license")
+__reference__ = ("Skinner, S.P., Fogh, R.H., Boucher, W., Ragan, T.J., Mureddu, L.G., & Vuister, G.W.",
+                 "CcpNmr AnalysisAssign: a flexible platform for integrated NMR analysis",
+                 "J.Biomol.Nmr (2016), 66, 111-124, http://doi.org/10.1007/s10858-016-0060-y")
+#=========================================================================================
+# Last code modification
+#=========================================================================================
+__modifiedBy__ = "$modifiedBy: CCPN $"
+__dateModified__ = "$dateModified: 2020-03-17 00:13:56 +0000 (Tue, March 17, 2020) $"
+__version__ = "$Revision: 3.0.1 $"
+#=========================================================================================
+# Created
+#=========================================================================================
+__author__ = "$Author: CCPN $"
+__date__ = "$Date: 2020-03-17 00:13:56 +0000 (Tue, March 17, 2020) $"
+#=========================================================================================
+# Start of code
+#=========================================================================================
+
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+from collections import OrderedDict
+from ccpn.AnalysisAssign.lib import scoring
+
+
+DEFAULTSIZES = (100, 1000, 10000)
+MAXALLVSALLSIZE = 1000  # all-vs-all matching is only timed up to this many NmrResidues
+
+# average (mean, sd) CA, CB, C shifts of the amino acids
+RESIDUESHIFTS = {
+    'ALA': ((53.13, 1.98), (19.01, 1.83), (177.74, 2.13)),
+    'ARG': ((56.79, 2.31), (30.69, 1.82), (176.42, 2.03)),
+    'ASN': ((53.55, 1.87), (38.69, 1.68), (175.27, 1.79)),
+    'ASP': ((54.69, 2.03), (40.88, 1.62), (176.40, 1.75)),
+    'CYS': ((58.00, 3.40), (33.00, 6.40), (174.90, 2.00)),
+    'GLN': ((56.60, 2.13), (29.20, 1.83), (176.37, 1.97)),
+    'GLU': ((57.36, 2.07), (30.00, 1.72), (176.93, 1.94)),
+    'GLY': ((45.37, 1.29), None, (173.88, 1.86)),
+    'HIS': ((56.51, 2.32), (30.23, 2.11), (175.25, 1.97)),
+    'ILE': ((61.65, 2.69), (38.61, 2.01), (175.88, 1.85)),
+    'LEU': ((55.66, 2.12), (42.29, 1.87), (177.00, 1.98)),
+    'LYS': ((56.97, 2.20), (32.78, 1.79), (176.66, 1.98)),
+    'MET': ((56.12, 2.22), (32.99, 2.25), (176.19, 2.07)),
+    'PHE': ((58.13, 2.56), (39.98, 2.06), (175.48, 1.95)),
+    'PRO': ((63.35, 1.53), (31.85, 1.21), (176.73, 1.51)),
+    'SER': ((58.71, 2.07), (63.79, 1.50), (174.64, 1.71)),
+    'THR': ((62.24, 2.60), (69.71, 1.65), (174.58, 1.75)),
+    'TRP': ((57.68, 2.49), (30.09, 2.05), (176.13, 1.97)),
+    'TYR': ((58.14, 2.47), (39.29, 2.17), (175.44, 1.96)),
+    'VAL': ((62.51, 2.88), (32.73, 1.78), (175.65, 1.88)),
+    }
+MISSINGFRACTION = 0.1  # fraction of shifts that are not observed
+
+
+#=========================================================================================
+# Synthetic project objects
+#=========================================================================================
+
+class SyntheticNmrResidue(object):
+    """Minimal stand-in for an NmrResidue, as used by lib/scoring
+    """
+    isDeleted = False
+    _flaggedForDelete = False
+
+    def __init__(self, sequenceCode, residueType):
+        self.sequenceCode = sequenceCode
+        self.residueType = residueType
+
+    def __repr__(self):
+        return '<SyntheticNmrResidue: %s.%s>' % (self.sequenceCode, self.residueType)
+
+
+class SyntheticNmrAtom(object):
+    """Minimal stand-in for an NmrAtom, as used by lib/scoring
+    """
+
+    def __init__(self, nmrResidue, name, isotopeCode):
+        self.nmrResidue = nmrResidue
+        self.name = name
+        self.isotopeCode = isotopeCode
+
+
+class SyntheticChemicalShift(object):
+    """Minimal stand-in for a ChemicalShift, as used by lib/scoring
+    """
+
+    def __init__(self, nmrAtom, value):
+        self.nmrAtom = nmrAtom
+        self.value = value
+
+
+def makeShiftsDict(size, seed=0):
+    """Return a dict of {nmrResidue: [chemicalShift, ...]} for size synthetic NmrResidues,
+    as built by BackboneAssignmentModule._setupShiftDicts
+    """
+    rnd = random.Random(seed)
+    residueTypes = sorted(RESIDUESHIFTS.keys())
+
+    shiftsDict = OrderedDict()
+    for ii in range(size):
+        residueType = rnd.choice(residueTypes)
+        nmrResidue = SyntheticNmrResidue(str(ii + 1), residueType)
+        shifts = [SyntheticChemicalShift(SyntheticNmrAtom(nmrResidue, 'N', '15N'), rnd.gauss(120.0, 4.0))]
+        for name, meanSd in zip(('CA', 'CB', 'C'), RESIDUESHIFTS[residueType]):
+            if meanSd and rnd.random() >= MISSINGFRACTION:
+                shifts.append(SyntheticChemicalShift(SyntheticNmrAtom(nmrResidue, name, '13C'), rnd.gauss(*meanSd)))
+        shiftsDict[nmrResidue] = shifts
+
+    return shiftsDict
+
+
+#=========================================================================================
+# Timing
+#=========================================================================================
+
+def timeFunction(func, minTime=0.2, maxRepeats=1000):
+    """Call func repeatedly for at least minTime seconds (or maxRepeats times) after one warm-up call;
+    func is always timed at least once.
+    Returns a dict with the best and mean time per call in seconds, the number of calls
+    and the peak memory allocated by python during a single call in bytes.
+    """
+    tracemalloc.start()
+    func()
+    _, peakMemory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times = []
+    start = time.perf_counter()
+    while not times or (len(times) < maxRepeats and (time.perf_counter() - start) < minTime):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+
+    return OrderedDict((('best', min(times)),
+                        ('mean', sum(times) / len(times)),
+                        ('calls', len(times)),
+                        ('peakMemory', peakMemory)))
+
+
+def _queryShifts(shiftsDict, nmrResidue):
+    return [shift for shift in shiftsDict[nmrResidue] if shift.nmrAtom.isotopeCode == '13C']
+
+
+def benchmarkFunctions(minTime=0.2):
+    """Time the scoring functions on a single (CA, CB, C) comparison.
+    qScore and the functions of functionDict are plain python; the registered kernels,
+    compiled if available, are timed separately as '<name> kernel'.
+    """
+    pairs = [(56.1, 56.4), (30.2, 30.9), (176.3, 176.1)]
+    atomNames = ['CA', 'CB', 'C']
+    matchValues = np.array([[pair[0] for pair in pairs]])
+    queryValues = np.array([[pair[1] for pair in pairs]])
+
+    results = OrderedDict()
+    results['qScore (python)'] = timeFunction(lambda: scoring.qScore(56.1, 56.4), minTime=minTime)
+    for name in ('averageQScore', 'euclidean'):
+        func = scoring.functionDict[name]
+        results['%s (python)' % name] = timeFunction(lambda: func(pairs), minTime=minTime)
+
+        method = scoring.getScoringMethod(name)
+        results['%s kernel' % name] = timeFunction(lambda: method.score(matchValues, queryValues, atomNames),
+                                                   minTime=minTime)
+
+    for result in results.values():
+        result['throughput'] = 1.0 / result['best']
+    return results
+
+
+def benchmarkMatches(size, scoringMethod='averageQScore', maxMatches=7, tolerances=None, minTime=0.2):
+    """Time the matching of a single NmrResidue against a synthetic project of size NmrResidues.
+    Throughput is in NmrResidues scored per second.
+    """
+    shiftsDict = makeShiftsDict(size)
+    nmrResidues = list(shiftsDict.keys())
+    queryShifts = _queryShifts(shiftsDict, nmrResidues[0])
+
+    results = OrderedDict()
+    results['ShiftMatrix.fromShiftsDict'] = timeFunction(lambda: scoring.ShiftMatrix.fromShiftsDict(shiftsDict),
+                                                         minTime=minTime)
+    shiftMatrix = scoring.ShiftMatrix.fromShiftsDict(shiftsDict)
+
+    results['getNmrResidueMatches'] = timeFunction(
+            lambda: scoring.getNmrResidueMatches(queryShifts, shiftsDict, scoringMethod), minTime=minTime)
+    results['getNmrResidueMatches(ShiftMatrix)'] = timeFunction(
+            lambda: scoring.getNmrResidueMatches(queryShifts, shiftMatrix, scoringMethod), minTime=minTime)
+    results['getNmrResidueTopMatches'] = timeFunction(
+            lambda: scoring.getNmrResidueTopMatches(queryShifts, shiftMatrix, scoringMethod, maxMatches,
+                                                    tolerances=tolerances), minTime=minTime)
+
+    for result in results.values():
+        result['throughput'] = size / result['best']
+
+    if size <= MAXALLVSALLSIZE:
+        result = results['getAllNmrResidueMatches'] = timeFunction(
+                lambda: scoring.getAllNmrResidueMatches(shiftMatrix, scoringMethod, maxMatches, tolerances=tolerances),
+                minTime=minTime, maxRepeats=10)
+        result['throughput'] = size * size / result['best']
+
+    return results
+
+
+def runBenchmarks(sizes=DEFAULTSIZES, scoringMethod='averageQScore', compiled=True, tolerances=None, minTime=0.2):
+    """Run all the benchmarks and return the results as a dict
+    """
+    method = scoring.getScoringMethod(scoringMethod)
+    method.useCompiled = compiled
+    if compiled:
+        # compile first, so that only the compiled kernels are timed
+        scoring.warmUpScoring([scoringMethod], background=False)
+
+    results = OrderedDict()
+    results['info'] = OrderedDict((('time', time.strftime('%Y-%m-%d %H:%M:%S')),
+                                   ('python', platform.python_version()),
+                                   ('numpy', np.__version__),
+                                   ('platform', platform.platform()),
+                                   ('scoringMethod', scoringMethod),
+                                   ('compiled', method.isCompiled and compiled),
+                                   ('tolerances', tolerances),
+                                   ))
+    results['functions'] = benchmarkFunctions(minTime=minTime)
+    results['matches'] = OrderedDict((str(size), benchmarkMatches(size, scoringMethod, tolerances=tolerances,
+                                                                  minTime=minTime))
+                                     for size in sizes)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the AnalysisAssign scoring functions')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULTSIZES,
+                        help='numbers of synthetic NmrResidues')
+    parser.add_argument('--method', default='averageQScore', choices=list(scoring.scoringMethods.keys()),
+                        help='scoring method')
+    parser.add_argument('--numpy', action='store_true',
+                        help='use the NumPy kernels instead of the compiled kernels')
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help='CA, CB and C tolerance (ppm) to pre-filter the candidates')
+    parser.add_argument('--minTime', type=float, default=0.2,
+                        help='minimum time (s) to repeat each measurement')
+    parser.add_argument('--output', default=None,
+                        help='json file for the results; default is stdout')
+    args = parser.parse_args(argv)
+
+    tolerances = None if args.tolerance is None else {atomName: args.tolerance for atomName in ('CA', 'CB', 'C')}
+    results = runBenchmarks(args.sizes, args.method, compiled=not args.numpy, tolerances=tolerances,
+                            minTime=args.minTime)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+"""
+Vectorised placement of stretches of NmrResidues in a Chain sequence.
+
+Each Chain is converted once to a SequenceMatrix, the residue-type index of every sequence position.
+A stretch is converted to a matrix of residue-type log-likelihoods, one row per NmrResidue, from the
+BMRB predictions of getNmrResiduePrediction. The likelihood of every offset of the stretch in the
+sequence is then a single gather over a sliding window of the sequence, summed along the stretch.
+
+Scores are likelihood ratios against the residue-type composition of the Chain, so a score > 1
+is a better than random placement; they are not on the scale of the getSpinSystemsLocation scores.
+"""
+#=========================================================================================
+# Licence, Reference and Credits
+#=========================================================================================
+__copyright__ = "Copyright (C) CCPN project (http://www.ccpn.ac.uk) 2014 - 2019"
+__credits__ = ("Ed Brooksbank, Luca Mureddu, Timothy J Ragan & Geerten W Vuister")
+__licence__ = ("CCPN licence. See http://www.ccpn.ac.uk/v3-software/downloads/license")
+__reference__ = ("Skinner, S.P., Fogh, R.H., Boucher, W., Ragan, T.J., Mureddu, L.G., & Vuister, G.W.",
+                 "CcpNmr AnalysisAssign: a flexible platform for integrated NMR analysis",
+                 "J.Biomol.Nmr (2016), 66, 111-124, http://doi.org/10.1007/s10858-016-0060-y")
+#=========================================================================================
+# Last code modification
+#=========================================================================================
+__modifiedBy__ = "$modifiedBy: CCPN $"
+__dateModified__ = "$dateModified: 2017-07-07 16:32:21 +0100 (Fri, July 07, 2017) $"
+__version__ = "$Revision: 3.0.0 $"
+#=========================================================================================
+# Created
+#=========================================================================================
+__author__ = "$Author: CCPN $"
+__date__ = "$Date: 2016-05-23 10:02:47 +0100 (Mon, 23 May 2016) $"
+#=========================================================================================
+# Start of code
+#=========================================================================================
+
+import math
+import typing
+import numpy as np
+from collections import OrderedDict
+from numpy.lib.stride_tricks import as_strided
+from ccpn.core.lib.AssignmentLib import getNmrResiduePrediction
+
+
+MAXPLACEMENTS = 5
+MINPROBABILITY = 1.0e-3  # probability of a residue-type that is not predicted
+MINLIKELIHOODRATIO = 1.0  # placements must be better than a random position of the chain
+MINLOGLIKELIHOODRATIO = math.log(MINLIKELIHOODRATIO)  # scores are compared in log space, the ratios overflow for long stretches
+
+
+class Placement(typing.NamedTuple):
+    """Position of a stretch of nmrResidues in a chain; residues are the Residues matched to the nmrResidues.
+    score is the log-likelihood ratio against a random position of the chain.
+    """
+    score: float
+    residues: list
+    offset: int
+
+    @property
+    def likelihoodRatio(self):
+        """The likelihood ratio of the placement, for display; inf if too large for a float.
+        """
+        try:
+            return math.exp(self.score)
+        except OverflowError:
+            return math.inf
+
+
+class SequenceMatrix(object):
+    """
+    Residue-type index of each position of the sequence of a Chain, calculated once per Chain.
+    """
+
+    __slots__ = ('chain', 'residues', 'residueTypes', 'typeIndex', 'sequence', 'composition')
+
+    def __init__(self, chain):
+        self.chain = chain
+        self.residues = tuple(chain.residues)
+
+        residueTypes = [(residue.residueType or '').upper() for residue in self.residues]
+        self.residueTypes = tuple(OrderedDict.fromkeys(residueTypes))
+        self.typeIndex = {residueType: ii for ii, residueType in enumerate(self.residueTypes)}
+        self.sequence = np.array([self.typeIndex[residueType] for residueType in residueTypes], dtype=np.intp)
+
+        # composition of the chain, the background for the likelihood ratios
+        counts = np.bincount(self.sequence, minlength=len(self.residueTypes)) if len(self.sequence) else np.zeros(0)
+        self.composition = counts / max(1, len(self.sequence))
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def windows(self, length):
+        """Return a read-only (len - length + 1, length) view of the sequence, one row per offset.
+        """
+        count = len(self.sequence) - length + 1
+        stride = self.sequence.strides[0]
+        return as_strided(self.sequence, shape=(count, length), strides=(stride, stride), writeable=False)
+
+
+def getResidueTypeProbabilities(nmrResidue, chemicalShiftList, residueTypes):
+    """Return an array of the probability of each of residueTypes for nmrResidue from its chemicalShifts.
+    Residue-types that are not predicted have MINPROBABILITY, an nmrResidue without predictions is uniform.
+    """
+    probabilities = np.full(len(residueTypes), MINPROBABILITY)
+    typeIndex = {residueType: ii for ii, residueType in enumerate(residueTypes)}
+
+    predicted = False
+    for residueType, probability in getNmrResiduePrediction(nmrResidue, chemicalShiftList):
+        ii = typeIndex.get(residueType.upper())
+        if ii is not None:
+            probabilities[ii] = max(probabilities[ii], float(probability.rstrip(' %')) / 100.0)
+            predicted = True
+
+    if not predicted:
+        probabilities[:] = 1.0
+    return probabilities / probabilities.sum()
+
+
+def getLogLikelihoods(probabilities, sequenceMatrix):
+    """Return the log-likelihood ratios of the (len(stretch), residueTypes) probabilities of a stretch
+    against the residue-type composition of the sequenceMatrix.
+    """
+    # ratio against the chance of matching a random position of the chain
+    background = probabilities @ sequenceMatrix.composition
+    return np.log(probabilities) - np.log(background)[:, np.newaxis]
+
+
+def getScores(probabilities, sequenceMatrix):
+    """Return an array of the log-likelihood ratio of each offset in the sequenceMatrix of a stretch
+    with the (len(stretch), residueTypes) probabilities.
+    The scores are not exponentiated, the likelihood ratios of long stretches overflow.
+    """
+    length = len(probabilities)
+    if not length or length > len(sequenceMatrix):
+        return np.zeros(0)
+
+    logLikelihoods = getLogLikelihoods(probabilities, sequenceMatrix)
+
+    # score[offset] = sum(logLikelihoods[ii, sequence[offset + ii]]) over the stretch
+    windows = sequenceMatrix.windows(length)
+    return logLikelihoods[np.arange(length), windows].sum(axis=1)
+
+
+def getPlacements(probabilities, sequenceMatrix, maxPlacements=MAXPLACEMENTS):
+    """Return the best Placements, with likelihood ratio > MINLIKELIHOODRATIO, of a stretch with the
+    (len(stretch), residueTypes) probabilities in the sequenceMatrix.
+    Only uses the arrays, so can be called from a background thread with probabilities from SequencePlacer.getProbabilities.
+    """
+    scores = getScores(probabilities, sequenceMatrix)
+    if not len(scores):
+        return []
+
+    count = min(maxPlacements, len(scores))
+    best = np.argpartition(-scores, count - 1)[:count]
+    best = best[np.argsort(-scores[best], kind='stable')]
+
+    residues = sequenceMatrix.residues
+    return [Placement(float(scores[offset]), list(residues[offset:offset + len(probabilities)]), int(offset))
+            for offset in best if scores[offset] > MINLOGLIKELIHOODRATIO]
+
+
+class SequencePlacer(object):
+    """
+    Place stretches of nmrResidues in the sequences of Chains.
+    SequenceMatrices are calculated once per Chain and residue-type probabilities once per
+    (nmrResidue, chemicalShiftList); call invalidate() when the chemicalShifts of an nmrResidue change,
+    or clear() when the sequences change.
+    """
+
+    __slots__ = ('_sequenceMatrices', '_probabilities')
+
+    def __init__(self):
+        self._sequenceMatrices = {}
+        self._probabilities = {}  # referenced by (nmrResidue, chemicalShiftList) -> {residueTypes: probabilities}
+
+    def clear(self):
+        self._sequenceMatrices.clear()
+        self._probabilities.clear()
+
+    def clearProbabilities(self):
+        self._probabilities.clear()
+
+    def invalidate(self, nmrResidue=None, chemicalShiftList=None):
+        """Remove the probabilities of nmrResidue in chemicalShiftList;
+        all the nmrResidues of chemicalShiftList if nmrResidue is None.
+        """
+        if nmrResidue is not None:
+            self._probabilities.pop((nmrResidue, chemicalShiftList), None)
+        else:
+            for key in [key for key in self._probabilities if key[1] is chemicalShiftList]:
+                del self._probabilities[key]
+
+    def getSequenceMatrix(self, chain):
+        if chain not in self._sequenceMatrices:
+            self._sequenceMatrices[chain] = SequenceMatrix(chain)
+        return self._sequenceMatrices[chain]
+
+    def getProbabilities(self, nmrResidues, chemicalShiftList, sequenceMatrix):
+        """Return the (len(nmrResidues), residueTypes) matrix of the probabilities of the residue-types
+        of the sequenceMatrix for the nmrResidues.
+        """
+        rows = []
+        for nmrResidue in nmrResidues:
+            cache = self._probabilities.setdefault((nmrResidue, chemicalShiftList), {})
+            probabilities = cache.get(sequenceMatrix.residueTypes)
+            if probabilities is None:
+                probabilities = cache[sequenceMatrix.residueTypes] = getResidueTypeProbabilities(nmrResidue, chemicalShiftList,
+                                                                                                 sequenceMatrix.residueTypes)
+            rows.append(probabilities)
+
+        return np.array(rows).reshape(len(rows), len(sequenceMatrix.residueTypes))
+
+    def getLogLikelihoods(self, nmrResidues, chemicalShiftList, sequenceMatrix):
+        """Return the (len(nmrResidues), residueTypes) matrix of log-likelihood ratios of the residue-types
+        of the sequenceMatrix for the nmrResidues.
+        """
+        return getLogLikelihoods(self.getProbabilities(nmrResidues, chemicalShiftList, sequenceMatrix), sequenceMatrix)
+
+    def getScores(self, nmrResidues, chain, chemicalShiftList):
+        """Return an array of the log-likelihood ratio of each offset of the nmrResidues in the sequence of chain.
+        """
+        sequenceMatrix = self.getSequenceMatrix(chain)
+        if not nmrResidues or len(nmrResidues) > len(sequenceMatrix):
+            return np.zeros(0)
+
+        return getScores(self.getProbabilities(nmrResidues, chemicalShiftList, sequenceMatrix), sequenceMatrix)
+
+    def placeNmrResidues(self, nmrResidues, chain, chemicalShiftList, maxPlacements=MAXPLACEMENTS):
+        """Return the best Placements, with likelihood ratio > MINLIKELIHOODRATIO, of the stretch of nmrResidues in the sequence of chain.
+        """
+        sequenceMatrix = self.getSequenceMatrix(chain)
+        if not nmrResidues or len(nmrResidues) > len(sequenceMatrix):
+            return []
+
+        return getPlacements(self.getProbabilities(nmrResidues, chemicalShiftList, sequenceMatrix), sequenceMatrix,
+                             maxPlacements=maxPlacements)
+
+
+def getStretches(nmrChain, minLength=2):
+    """Return the stretches of sequentially connected mainNmrResidues of nmrChain, of at least minLength.
+    """
+    stretches = []
+    stretch = []
+    for nmrResidue in nmrChain.mainNmrResidues:
+        if stretch and stretch[-1].nextNmrResidue is not nmrResidue:
+            stretches.append(stretch)
+            stretch = []
+        stretch.append(nmrResidue)
+    stretches.append(stretch)
+
+    return [tuple(stretch) for stretch in stretches if len(stretch) >= minLength]
+
+
+def placeProjectStretches(project, chemicalShiftList=None, chains=None, maxPlacements=MAXPLACEMENTS, placer=None):
+    """Place every stretch of connected nmrResidues in project in the chains (default all).
+    Returns a dict of {stretch: {chain: [Placement, ...]}}.
+    """
+    if chemicalShiftList is None:
+        if not project.chemicalShiftLists:
+            raise ValueError('Project %s has no chemicalShiftLists' % project.name)
+        chemicalShiftList = project.chemicalShiftLists[0]
+
+    placer = placer or SequencePlacer()
+    chains = project.chains if chains is None else chains
+
+    placements = OrderedDict()
+    for nmrChain in project.nmrChains:
+        for stretch in getStretches(nmrChain):
+            placements[stretch] = OrderedDict((chain, placer.placeNmrResidues(stretch, chain, chemicalShiftList,
+                                                                              maxPlacements=maxPlacements))
+                                              for chain in chains)
+    return placements
@@ -29,7 +29,7 @@ import typing
 from collections import OrderedDict
 from PyQt5 import QtGui, QtWidgets
 
-from ccpn.AnalysisAssign.lib.scoring import getNmrResidueMatches
+from ccpn.AnalysisAssign.lib.scoring import getNmrResidueTopMatches, ShiftMatrix, MatchCache, MAXMATCHES
 from ccpn.core.ChemicalShift import ChemicalShift
 from ccpn.core.NmrResidue import NmrResidue
 from ccpn.core.NmrChain import NmrChain
@@ -41,7 +41,8 @@ from ccpn.ui.gui.lib.Strip import navigateToNmrResidueInDisplay
 from ccpn.ui.gui.modules.NmrResidueTable import NmrResidueTableModule
 
 from ccpn.ui.gui.widgets.CheckBox import CheckBox
-from ccpn.ui.gui.widgets.CompoundWidgets import ListCompoundWidget, PulldownListCompoundWidget
+from ccpn.ui.gui.widgets.CompoundWidgets import ListCompoundWidget, PulldownListCompoundWidget, \
+    CheckBoxCompoundWidget, DoubleSpinBoxCompoundWidget
 from ccpn.ui.gui.widgets.MessageDialog import showWarning, progressManager, showYesNo
 from ccpn.ui.gui.widgets.PulldownListsForObjects import ChemicalShiftListPulldown
 from ccpn.ui.gui.widgets.Spacer import Spacer
@@ -53,14 +54,17 @@ from ccpn.core.NmrAtom import NmrAtom
 from ccpn.ui.gui.widgets.PlaneToolbar import STRIPLABEL_CONNECTDIR, STRIPLABEL_CONNECTNONE, \
     STRIPCONNECT_LEFT, STRIPCONNECT_RIGHT
 from ccpn.core.lib.ContextManagers import undoBlock
+from ccpn.core.lib.Notifiers import Notifier
+from ccpn.core.lib.Pid import PREFIXSEP, IDSEP
 
 
 ALL = '<all>'
 MINMATCHES = 1
-MAXMATCHES = 7
 DEFAULTMATCHES = 2
 STRIPBACKBONE = 'backboneAssignment'
 MARKCONNECTED = False
+MATCHTOLERANCE = 2.0  # default ppm window to pre-filter match candidates, when enabled
+MATCHTOLERANCEATOMS = ('CA', 'CB', 'C')
 
 
 class BackboneAssignmentModule(NmrResidueTableModule):
@@ -159,7 +163,28 @@ class BackboneAssignmentModule(NmrResidueTableModule):
                                                          fixedWidths=(colWidth0, colWidth0, None),
                                                          callback=self._setupShiftDicts, default=None
                                                          )
+
+        # optional tolerance window to pre-filter the match candidates; off by default
+        row += 1
+        self.matchToleranceCheckBox = CheckBoxCompoundWidget(self.nmrResidueTableSettings,
+                                                             grid=(row, col), vAlign='top', hAlign='left',
+                                                             fixedWidths=(colWidth0, 30),
+                                                             orientation='left',
+                                                             labelText='Pre-filter matches:',
+                                                             checked=False,
+                                                             callback=self._setMatchTolerances
+                                                             )
+        row += 1
+        self.matchToleranceWidget = DoubleSpinBoxCompoundWidget(self.nmrResidueTableSettings,
+                                                                grid=(row, col), vAlign='top', hAlign='left',
+                                                                fixedWidths=(colWidth0, colWidth2),
+                                                                orientation='left',
+                                                                labelText='%s tolerance (ppm):' % '/'.join(MATCHTOLERANCEATOMS),
+                                                                value=MATCHTOLERANCE, range=(0.0, 100.0), step=0.1, decimals=2,
+                                                                callback=self._setMatchTolerances
+                                                                )
         self._setupShiftDicts()
+        self._registerShiftNotifiers()
         self._spacer = Spacer(self.settingsWidget, 5, 5,
                               QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Expanding,
                               grid=(row + 20, 10), gridSpan=(1, 1))
@@ -168,6 +193,7 @@ class BackboneAssignmentModule(NmrResidueTableModule):
         #self.moduleList = self.matchWidget.listWidget
 
         self._stripNotifiers = []  # list to store GuiNotifiers for strips
+        self.matches = []  # list of (score, nmrResidue, {atomName: delta}) displayed in the match module
         self.nmrResidueTable.multiSelect = True
         self.nmrResidueTable.setSelectionMode(self.nmrResidueTable.SingleSelection)
 
@@ -415,17 +441,18 @@ class BackboneAssignmentModule(NmrResidueTableModule):
             matchShifts = self.interShifts
 
         if True:
-            queryShifts = [shift for shift in self.allShifts[nmrResidue]
-                           if shift.nmrAtom.isotopeCode == '13C']
-            assignMatrix = getNmrResidueMatches(queryShifts, self.allShifts, 'averageQScore')
-            print('assignMatrix',assignMatrix)
+            # matches are cached until the shifts change, the cache is filled in the background
+            queryShifts = [shift for shift in self.allShifts.get(nmrResidue, [])
+                           if shift and shift.nmrAtom.isotopeCode == '13C']
+            matches = self._matchCache.getMatches(nmrResidue, queryShifts)
         else:
-            assignMatrix = getNmrResidueMatches(queryShifts, matchShifts, 'averageQScore')
+            matches = getNmrResidueTopMatches(queryShifts, matchShifts, 'averageQScore', MAXMATCHES,
+                                              tolerances=self._getMatchTolerances())
 
-        if not assignMatrix.values():
+        if not matches:
             getLogger().info('No matches found for NmrResidue: %s' % nmrResidue.pid)
             return
-        self._createMatchStrips(assignMatrix)
+        self._createMatchStrips(matches)
 
     def _processDroppedNmrResidrueLabel(self, data, toLabel=None, plusChain=None):
         if toLabel and toLabel.obj:
@@ -689,12 +716,14 @@ class BackboneAssignmentModule(NmrResidueTableModule):
     def _setupShiftDicts(self, *args):
         """
         Creates two ordered dictionaries for the inter residue and intra residue CA and CB shifts for
-        all NmrResidues in the project.
+        all NmrResidues in the project, and the shiftMatrix of all 13C shifts used for matching.
+        These are built once for the selected chemicalShiftList and then kept up-to-date by the
+        shift notifiers.
         """
         self.intraShifts = OrderedDict()
         self.interShifts = OrderedDict()
         self.allShifts = OrderedDict()
-        chemicalShiftList = self.application.project.getByPid(self.shiftListWidget.pulldownList.currentText())
+        self._chemicalShiftList = chemicalShiftList = self.application.project.getByPid(self.shiftListWidget.pulldownList.currentText())
 
         if chemicalShiftList:
             for nmrResidue in self.application.project.nmrResidues:
@@ -706,26 +735,138 @@ class BackboneAssignmentModule(NmrResidueTableModule):
                     self.intraShifts[nmrResidue] = shifts
                 self.allShifts[nmrResidue] = shifts
 
-    def _createMatchStrips(self, assignMatrix: typing.Tuple[typing.Dict[NmrResidue, typing.List[ChemicalShift]], typing.List[float]]):
+        self.shiftMatrix = ShiftMatrix.fromShiftsDict(self.allShifts)
+        self._matchCache = MatchCache(self.shiftMatrix, 'averageQScore', MAXMATCHES, tolerances=self._getMatchTolerances())
+
+    def _getMatchTolerances(self):
+        """Return the dict of {atomName: tolerance} used to pre-filter the match candidates,
+        or None if the pre-filter is not enabled in the settings
+        """
+        if not self.matchToleranceCheckBox.isChecked():
+            return None
+        tolerance = self.matchToleranceWidget.getValue()
+        return {atomName: tolerance for atomName in MATCHTOLERANCEATOMS}
+
+    def _setMatchTolerances(self, *args):
+        """Apply a change to the pre-filter settings; the cached matches are discarded
+        """
+        self._matchCache.tolerances = self._getMatchTolerances()
+        self._matchCache.clear()
+
+    def _registerShiftNotifiers(self):
+        """Register the notifiers that patch the shift dicts for changes to single nmrResidues
+        """
+        self.setNotifier(self.project,
+                         [Notifier.CREATE, Notifier.DELETE, Notifier.CHANGE],
+                         ChemicalShift.className,
+                         self._updateChemicalShift)
+        self.setNotifier(self.project,
+                         [Notifier.CREATE, Notifier.DELETE, Notifier.RENAME],
+                         NmrAtom.className,
+                         self._updateNmrAtom)
+        self.setNotifier(self.project,
+                         [Notifier.CREATE, Notifier.DELETE, Notifier.RENAME],
+                         NmrResidue.className,
+                         self._updateNmrResidue)
+
+    def _updateChemicalShift(self, data):
+        """Update the shifts of the nmrResidue containing the changed chemicalShift
+        """
+        shift = data[Notifier.OBJECT]
+        if self._chemicalShiftList and shift.chemicalShiftList is self._chemicalShiftList:
+            nmrAtom = shift.nmrAtom
+            if nmrAtom is not None:
+                # the delete notifier fires before the shift is deleted, so remove it explicitly
+                deleted = shift if data[Notifier.TRIGGER] == Notifier.DELETE else None
+                self._updateShifts(nmrAtom.nmrResidue, deleted=deleted)
+
+    def _updateNmrAtom(self, data):
+        """Update the shifts of the nmrResidue containing the changed nmrAtom,
+        and of the nmrResidue that contained it before a rename
+        """
+        if not self._chemicalShiftList:
+            return
+
+        nmrAtom = data[Notifier.OBJECT]
+        trigger = data[Notifier.TRIGGER]
+        deleted = nmrAtom if trigger == Notifier.DELETE else None
+        self._updateShifts(nmrAtom.nmrResidue, deleted=deleted)
+
+        if trigger == Notifier.RENAME:
+            oldNmrResidue = self._getOldNmrResidue(data[Notifier.OLDPID])
+            if oldNmrResidue is not nmrAtom.nmrResidue:
+                self._updateShifts(oldNmrResidue)
+
+    def _getOldNmrResidue(self, oldPid):
+        """Return the nmrResidue that contained the nmrAtom with oldPid, or None if it no longer exists
+        """
+        if not oldPid:
+            return None
+
+        # nmrAtom ids are nmrChain.sequenceCode.residueType.name
+        fields = str(oldPid).split(PREFIXSEP, 1)[-1].split(IDSEP)
+        if len(fields) < 4:
+            return None
+        return self.application.project.getByPid(PREFIXSEP.join((NmrResidue.shortClassName, IDSEP.join(fields[:3]))))
+
+    def _updateNmrResidue(self, data):
+        """Update the shifts of the changed nmrResidue
+        """
+        nmrResidue = data[Notifier.OBJECT]
+        if self._chemicalShiftList:
+            self._updateShifts(nmrResidue)
+
+    def _updateShifts(self, nmrResidue, deleted=None):
+        """Patch the shift dicts and the shiftMatrix for a single nmrResidue;
+        deleted is an nmrAtom or chemicalShift that is being deleted, and is ignored.
+        Objects flagged for delete are still returned by the project while the delete notifiers fire, so are skipped.
+        """
+        if nmrResidue is None:
+            return
+
+        if nmrResidue.isDeleted or nmrResidue._flaggedForDelete:
+            for shiftDict in (self.intraShifts, self.interShifts, self.allShifts):
+                shiftDict.pop(nmrResidue, None)
+            self.shiftMatrix.removeNmrResidue(nmrResidue)
+            self._matchCache.invalidate(nmrResidue)
+            return
+
+        chemicalShiftList = self._chemicalShiftList
+        nmrAtoms = [atom for atom in nmrResidue.nmrAtoms
+                    if atom is not deleted and not (atom.isDeleted or atom._flaggedForDelete)]
+        shifts = [chemicalShiftList.getChemicalShift(atom.id) for atom in nmrAtoms]
+        shifts = [None if shift is None or shift is deleted or shift.isDeleted or shift._flaggedForDelete else shift
+                  for shift in shifts]
+
+        # a rename may move the nmrResidue between the intra and inter shifts
+        if nmrResidue.sequenceCode.endswith('-1'):
+            self.intraShifts.pop(nmrResidue, None)
+            self.interShifts[nmrResidue] = shifts
+        else:
+            self.interShifts.pop(nmrResidue, None)
+            self.intraShifts[nmrResidue] = shifts
+        self.allShifts[nmrResidue] = shifts
+        self.shiftMatrix.setShifts(nmrResidue, shifts)
+        self._matchCache.invalidate(nmrResidue)
+
+    def _createMatchStrips(self, matches: typing.List[typing.Tuple[float, NmrResidue, typing.Dict[str, float]]]):
         """
         Creates strips in match module corresponding to the best assignment possibilities
-        in the assignMatrix.
+        in matches.
         """
-        if not assignMatrix:
-            getLogger().warn('No assignment matrix specified')
+        if not matches:
+            getLogger().warn('No assignment matches specified')
             return
 
-        # Assignment score has format {score: nmrResidue} where score is a float
-        # assignMatrix[0] is a dict {score: nmrResidue} assignMatrix[1] is a concurrent list of scores
+        # matches is a list of (score, nmrResidue, {atomName: delta}) in order of increasing score
         # numberOfMatches = int(self.numberOfMatchesWidget.getText())
-        assignmentScores = sorted(list(assignMatrix.keys()))[:MAXMATCHES]
+        matches = matches[:MAXMATCHES]
         nmrAtomPairs = []
         scoreAssignment = []
         scoreLabelling = []
 
         matchDirection = 0
-        for assignmentScore in assignmentScores:
-            matchResidue = assignMatrix[assignmentScore]
+        for assignmentScore, matchResidue, deltas in matches:
             if matchResidue.sequenceCode.endswith('-1'):
                 iNmrResidue = matchResidue.mainNmrResidue
 
@@ -737,7 +878,7 @@ class BackboneAssignmentModule(NmrResidueTableModule):
                 scoreLabelling.append('[ i-1 ]')
                 matchDirection = -1
 
-            scoreAssignment.append('[ %i' % int(100 - min(1000 * assignmentScore, 100)) + '% ]')
+            scoreAssignment.append('[ %i' % int(100 - min(1000 * assignmentScore, 100)) + '% ]  ' + deltasText(deltas))
 
             nmrAtomPairs.append((iNmrResidue.fetchNmrAtom(name='N'), iNmrResidue.fetchNmrAtom(name='H')))
 
@@ -746,6 +887,9 @@ class BackboneAssignmentModule(NmrResidueTableModule):
         else:
             numberOfMatches = int(self.numberOfMinusMatchesWidget.getText())
 
+        # keep the displayed matches, with their per-atom deltas, for inspection
+        self.matches = matches[:numberOfMatches]
+
         nmrAtomPairs = nmrAtomPairs[:numberOfMatches]
         scoreAssignment = scoreAssignment[:numberOfMatches]
         scoreLabelling = scoreLabelling[:numberOfMatches]
@@ -786,8 +930,8 @@ class BackboneAssignmentModule(NmrResidueTableModule):
                 strip.header.handle = STRIPBACKBONE
                 strip.header.headerVisible = True
 
-            # self._centreStripForNmrResidue(assignMatrix[assignmentScores[0]], module.strips[0])
-            self._centreCcpnStripsForNmrResidue(assignMatrix[assignmentScores[0]], module.strips)
+            # self._centreStripForNmrResidue(matches[0][1], module.strips[0])
+            self._centreCcpnStripsForNmrResidue(matches[0][1], module.strips)
             module.setColumnStretches(stretchValue=True)
 
     def _closeModule(self):
@@ -805,6 +949,7 @@ class BackboneAssignmentModule(NmrResidueTableModule):
                 notifier.unRegister()
 
         self._stripNotifiers = []
+        self._matchCache.clear()
         super()._closeModule()
 
 
@@ -846,6 +991,13 @@ def nmrAtomsFromOffsets(nmrResidue):
     return nmrAtoms
 
 
+def deltasText(deltas: typing.Dict[str, float]):
+    """
+    Return the per-atom shift deltas of a match as text, e.g. 'CA +0.12  CB -0.30  C +0.05'
+    """
+    return '  '.join('%s %+.2f' % (atomName, delta) for atomName, delta in deltas.items())
+
+
 def markNmrAtoms(mainWindow, nmrAtoms: typing.List[NmrAtom]):
     # get the display
     # displays = self._getDisplays()
@@ -28,6 +28,8 @@ __date__ = "$Date: 2016-05-23 10:02:47 +0100 (Thu, 26 May 2016) $"
 import json
 import typing
 import numpy as np
+from types import MappingProxyType
+from itertools import count
 from functools import partial
 from PyQt5 import QtGui, QtWidgets, QtCore
 from collections import OrderedDict
@@ -38,6 +40,7 @@ from ccpn.core.NmrAtom import NmrAtom
 from ccpn.core.NmrResidue import NmrResidue
 from ccpn.core.Peak import Peak
 from ccpn.core.Spectrum import Spectrum
+from ccpn.core.ChemicalShift import ChemicalShift
 from ccpn.core.lib.AssignmentLib import getNmrResiduePrediction
 from ccpn.core.lib.Notifiers import Notifier
 from ccpn.core.lib.CallBack import CallBack
@@ -66,6 +69,9 @@ from ccpn.ui.gui.widgets.SettingsWidgets import SequenceGraphSettings
 from ccpn.core.lib.AssignmentLib import getSpinSystemsLocation
 from ccpn.core.lib.ContextManagers import notificationEchoBlocking, catchExceptions, undoBlock
 from ccpnc.clibrary import Clibrary
+from ccpn.AnalysisAssign.lib.indexedList import IndexedList
+from ccpn.AnalysisAssign.lib.sequencePlacement import SequencePlacer, Placement, getPlacements, MINLOGLIKELIHOODRATIO
+from ccpn.AnalysisAssign.lib.pairCounts import PairCounts
 
 
 _getNmrIndex = Clibrary.getNmrResidueIndex
@@ -73,6 +79,94 @@ _getNmrIndex = Clibrary.getNmrResidueIndex
 logger = getLogger()
 ALL = '<all>'
 
+# below this view scale the guiNmrResidueGroups are drawn as glyphs and the assignment lines are bundled
+LEVELOFDETAILSCALE = 0.5
+ZOOMFACTOR = 1.2
+MINZOOM = 0.05
+MAXZOOM = 4.0
+MAXBUNDLEWIDTH = 8.0
+
+# nmrChains longer than this only create the gui items for the visible nmrResidues
+VIRTUALNMRCHAINLENGTH = 100
+VIRTUALMARGIN = 5  # number of nmrResidues created either side of the visible region
+VIRTUALUPDATEDELAY = 50  # ms
+
+# notifier updates are gathered and processed together after this delay
+PENDINGUPDATEDELAY = 0  # ms, process on the next event-loop tick
+
+# nmrChains with more nmrResidues than this are laid out in a background thread
+BACKGROUNDLAYOUTLENGTH = 50
+LAYOUTBATCHSIZE = 20  # guiNmrResidueGroups created per event-loop tick when applying a layout
+SNAPSHOTBATCHSIZE = 50  # nmrResidues (and 4x as many peaks) read per event-loop tick before starting a layout
+
+# maximum number of ghost nmrResidues kept for reuse after removing from the scene
+MAXPOOLEDGHOSTS = 256
+
+
+# QPens shared by all the lines in the scenes, referenced by (colour, width, style)
+_linePens = {}
+
+
+def _getLinePen(colour, width, style=None):
+    """Return the shared cosmetic QPen for the colour/width/style.
+    QPens are implicitly shared, so lines drawn with the same pen do not hold a copy.
+    """
+    key = (colour, width, style)
+    pen = _linePens.get(key)
+    if pen is None:
+        pen = _linePens[key] = QtGui.QPen(QtGui.QColor(colour))
+        pen.setCosmetic(True)
+        pen.setWidthF(width)
+        if style == 'dash':
+            pen.setStyle(QtCore.Qt.DotLine)
+    return pen
+
+
+class LayoutRecord(typing.NamedTuple):
+    """Position of an nmrResidue in a virtualised nmrChain.
+    """
+    nmrResidue: NmrResidue
+    index: int
+    x: float
+
+
+class GhostRecord(typing.NamedTuple):
+    """Gui items of a ghost nmrResidue; signature is the residueType/nmrAtoms that the items were created from.
+    """
+    signature: tuple
+    group: object
+    guiAtoms: dict
+    lines: list
+
+
+def _getDisplayNmrResidues(nmrChain, showAll, currentNmrResidue):
+    """Return the list of mainNmrResidues to display for the nmrChain,
+    either all or the stretch containing currentNmrResidue.
+    """
+    nmrList = nmrChain.mainNmrResidues
+
+    if not showAll:
+
+        # get the connected stretch of mainNmrResidues
+        if currentNmrResidue:
+            mainNmrRes = currentNmrResidue.mainNmrResidue
+            if mainNmrRes in nmrList:
+                indL = indR = nmrList.index(mainNmrRes)
+                while nmrList[indL].previousNmrResidue and indL > 0:
+                    indL -= 1
+                while nmrList[indR].nextNmrResidue and indR < len(nmrList):
+                    indR += 1
+                nmrList = nmrList[indL:indR + 1]
+
+    return nmrList
+
+
+def _getLayoutSlice(count, spacing, left, right, margin=0):
+    """Return the slice of a layout of count nmrResidues, spaced by spacing, that lies between left and right,
+    with margin extra nmrResidues either side.
+    """
+    return slice(max(0, int(left // spacing) - margin), min(count, int(right // spacing) + 1 + margin))
+
 
 #==========================================================================================
 # GuiNmrAtom
@@ -84,9 +178,14 @@ class GuiNmrAtom(QtWidgets.QGraphicsTextItem):
     Can be linked to a Nmr Atom.
     """
 
+    # unique integer ids, used to hold the number of lines between guiNmrAtoms in the PairCounts of the nmrResidueList
+    _atomIds = count()
+
     def __init__(self, mainWindow, text, pos=None, nmrAtom=None):
         super().__init__()
 
+        self.atomId = next(GuiNmrAtom._atomIds)
+
         self.setPlainText(text)
         self.setPos(QtCore.QPointF((pos[0] - self.boundingRect().x()), (pos[1] - self.boundingRect().y())))
 
@@ -96,11 +195,13 @@ class GuiNmrAtom(QtWidgets.QGraphicsTextItem):
         self.current = mainWindow.application.current
         self.nmrAtom = nmrAtom
 
-        self.connectedAtoms = 0
-        self.connectedList = {}  # maintain connectivity between guiNmrAtoms
-        # so that lines do not overlap
+        # the number of lines between guiNmrAtoms, so that lines do not overlap, is held by the nmrResidueList
+
+        # assignmentLines attached to this guiNmrAtom, their end-points are updated when this item moves
+        self.lines = set()
 
         self.setTextInteractionFlags(QtCore.Qt.TextSelectableByMouse)
+        self.setFlag(QtWidgets.QGraphicsItem.ItemSendsGeometryChanges)
 
         # set the highlight colour for dragging to chain
         self.colours = getColours()
@@ -109,6 +210,20 @@ class GuiNmrAtom(QtWidgets.QGraphicsTextItem):
         else:
             self.setDefaultTextColor(QtGui.QColor(self.colours[GUINMRATOM_NOTSELECTED]))
 
+    def itemChange(self, change, value):
+        """CCPN INTERNAL - mark the attached lines for update when the guiNmrAtom moves
+        """
+        if change == QtWidgets.QGraphicsItem.ItemPositionHasChanged:
+            self.setLinesDirty()
+        return super().itemChange(change, value)
+
+    def setLinesDirty(self, connectedAtom=None):
+        """Mark the attached lines for update, only those connected to connectedAtom if specified.
+        """
+        for line in self.lines:
+            if connectedAtom is None or connectedAtom is line.guiAtom1 or connectedAtom is line.guiAtom2:
+                line.setDirty()
+
     def mouseDoubleClickEvent(self, event):
         """CCPN INTERNAL - re-implementation of double click event
         """
@@ -134,47 +249,6 @@ class GuiNmrAtom(QtWidgets.QGraphicsTextItem):
         contextMenu.move(cursor.pos().x(), cursor.pos().y() + 10)
         contextMenu.exec()
 
-    def addConnectedList(self, connectedAtom):
-        """maintain number of links between adjacent nmrAtoms.
-        """
-        keyVal = connectedAtom
-        if keyVal in self.connectedList:
-            self.connectedList[keyVal] += 1
-        else:
-            self.connectedList[keyVal] = 1
-
-    def removeConnectedList(self, connectedAtom):
-        """maintain number of links between adjacent nmrAtoms.
-        """
-        keyVal = connectedAtom
-        if keyVal in self.connectedList:
-            self.connectedList[keyVal] -= 1
-        else:
-            raise RuntimeError('Connection does not exist')
-
-    def getConnectedList(self, connectedAtom):
-        """Retrieve number of links between adjacent nmrAtoms.
-        """
-        keyVal = connectedAtom
-        if keyVal in self.connectedList:
-            return self.connectedList[keyVal]
-        else:
-            return 0
-
-    def clearConnectedList(self):
-        """Clear all connections for this guiNmrAtom but do not delete.
-        """
-        for keyVal in self.connectedList:
-            keyVal.connectedList[self] = 0
-            self.connectedList[keyVal] = 0
-
-    def deleteConnectedList(self):
-        """Delete all connections for this guiNmrAtom.
-        """
-        for keyVal in self.connectedList:
-            del keyVal.connectedList[self]
-        self.connectedList = {}
-
 
 #==========================================================================================
 # GuiNmrResidue
@@ -273,15 +347,8 @@ class AssignmentLine(QtWidgets.QGraphicsLineItem):
                  parent=None, style=None, peak=None, guiAtom1: GuiNmrAtom = None, guiAtom2: GuiNmrAtom = None, displacement=None):
         super().__init__()
 
-        # set the pen colour and style
-        self.pen = QtGui.QPen()
-        self.pen.setColor(QtGui.QColor(colour))
-        self.pen.setCosmetic(True)
-        self.pen.setWidth(width)
-
-        if style == 'dash':
-            self.pen.setStyle(QtCore.Qt.DotLine)
-        self.setPen(self.pen)
+        # set the pen colour and style, shared with all lines of the same type
+        self.setPen(_getLinePen(colour, width, style))
         self.setLine(x1, y1, x2, y2)
         self._parent = parent
 
@@ -289,12 +356,38 @@ class AssignmentLine(QtWidgets.QGraphicsLineItem):
         self._peak = peak
         self.guiAtom1 = guiAtom1
         self.guiAtom2 = guiAtom2
-        self.displacement = displacement
+        self._displacement = displacement
+
+        # end-points are only recalculated when a connected item has moved
+        self._dirty = True
+
+        # the lineList/key that the line is stored under in the nmrResidueList
+        self._lineList = None
+        self._lineKey = None
 
         # enable hovering so the current line can be set
         self.setAcceptedMouseButtons(QtCore.Qt.RightButton)
         self.setAcceptHoverEvents(True)
 
+    @property
+    def displacement(self):
+        """Displacement of the line from the other lines between the same guiNmrAtoms.
+        """
+        return self._displacement
+
+    @displacement.setter
+    def displacement(self, value):
+        if value != self._displacement:
+            self._displacement = value
+            self.setDirty()
+
+    def setDirty(self):
+        """Mark the end-points for update on the next paint.
+        """
+        if not self._dirty:
+            self._dirty = True
+            self.update()
+
     def updateEndPoints(self):
         """Update the endPoints of the line to point. Co-ordinates are relative to the group to
         which the graphicsItem belongs, in this case the guiNmrResidue group. GuiNmrResidue group is the top level relative to the scene.
@@ -325,7 +418,7 @@ class AssignmentLine(QtWidgets.QGraphicsLineItem):
         dy = y2 - y1
         length = 2.0 * pow(dx * dx + dy * dy, 0.5)
         if self.displacement is not None:
-            count = (guiAtom1.connectedList[guiAtom2] - 1) // 2
+            count = (self._parent.getConnectionCount(guiAtom1, guiAtom2) - 1) // 2
             disp = 6.0 * (self.displacement - count) / length
         else:
             disp = 0.0
@@ -347,11 +440,13 @@ class AssignmentLine(QtWidgets.QGraphicsLineItem):
         y2 += yOff2 - ky2 + offsetY
 
         self.setLine(x1, y1, x2, y2)
+        self._dirty = False
 
     def paint(self, painter, option, widget):
-        """Automatically update the end-points of the assignment lines to point to the correct guiNmrAtoms
+        """Update the end-points of the assignment lines to point to the correct guiNmrAtoms if they have moved
         """
-        self.updateEndPoints()
+        if self._dirty:
+            self.updateEndPoints()
         super().paint(painter, option, widget)
 
     def hoverEnterEvent(self, event):
@@ -384,6 +479,7 @@ class GuiNmrResidueGroup(QtWidgets.QGraphicsItemGroup):
         self.current = self.mainWindow.application.current
         self.nmrResidue = nmrResidue
         self._parent = parent
+        self.setFlag(QtWidgets.QGraphicsItem.ItemSendsGeometryChanges)
         self.setPos(QtCore.QPointF(pos, 0.0))
         self.crossChainCount = None
         self.crossChainResidue = None
@@ -391,6 +487,55 @@ class GuiNmrResidueGroup(QtWidgets.QGraphicsItemGroup):
         self.nmrResidueLabel = GuiNmrResidue(parent, nmrResidue, caAtom)
         self.addToGroup(self.nmrResidueLabel)
 
+        # draw as a compact glyph when not detailed
+        self._detailed = True
+        self._glyphRect = None
+
+    def setDetailed(self, detailed):
+        """Show all the items in the group, or hide them and draw a compact glyph for low zoom levels.
+        """
+        if detailed == self._detailed:
+            return
+
+        self._detailed = detailed
+        for item in self.childItems():
+            item.setVisible(detailed)
+        self.update()
+
+    def glyphRect(self):
+        """Return the rectangle covering the backbone atoms, in group co-ordinates.
+        """
+        if self._glyphRect is None:
+            rect = QtCore.QRectF()
+            for item in self.childItems():
+                if isinstance(item, GuiNmrAtom) and item.toPlainText() in ('N', 'CA', 'C'):
+                    rect = rect.united(item.mapRectToParent(item.boundingRect()))
+            self._glyphRect = rect
+        return self._glyphRect
+
+    def glyphCentre(self):
+        """Return the centre of the glyph in scene co-ordinates.
+        """
+        return self.mapToScene(self.glyphRect().center())
+
+    def paint(self, painter, option, widget=None):
+        """Draw the glyph in place of the hidden items.
+        """
+        if not self._detailed:
+            painter.setPen(QtCore.Qt.NoPen)
+            painter.setBrush(QtGui.QColor(self.nmrResidueLabel.colours[GUINMRRESIDUE]))
+            painter.drawRoundedRect(self.glyphRect(), 8.0, 8.0)
+        super().paint(painter, option, widget)
+
+    def itemChange(self, change, value):
+        """CCPN INTERNAL - mark the lines attached to the guiNmrAtoms for update when the group moves
+        """
+        if change == QtWidgets.QGraphicsItem.ItemPositionHasChanged:
+            for item in self.childItems():
+                if isinstance(item, GuiNmrAtom):
+                    item.setLinesDirty()
+        return super().itemChange(change, value)
+
     def mousePressEvent(self, event):
         self.nmrResidueLabel._mousePressEvent(event)
 
@@ -427,6 +572,22 @@ class NmrResidueList(object):
         self._module = module
         self.nmrChain = None
 
+        # level of detail of the scene, see setLevelOfDetail
+        self.detailed = True
+
+        # ghost nmrResidues removed from the scene, kept for reuse by _addGhostResidue
+        self._ghostPool = OrderedDict()  # referenced by nmrResidue -> list(GhostRecord)
+        self._ghostPoolSize = 0
+
+    # attributes initialised in reset() that hold the state of the displayed nmrChain
+    _STATEATTRIBUTES = ('residueCount', 'direction', 'selectedStretch', 'selectedLine',
+                        'nmrChains', 'guiNmrResidues', 'guiNmrAtoms', 'guiGhostNmrResidues',
+                        'guiNmrAtomsFromNmrResidue', 'ghostList', 'ghostRecords',
+                        'connectingLines', 'assignmentLines', 'linesFromPeak', 'linesFromGuiNmrAtom',
+                        'connectionCounts',
+                        'layoutRecords', 'layoutFromNmrResidue',
+                        'nmrChain')
+
     def reset(self):
         self.residueCount = 0
         self.direction = None
@@ -434,7 +595,7 @@ class NmrResidueList(object):
         self.selectedLine = None
 
         # change to an orderedDict so that more nmrChains can be seen in the future
-        self.nmrChains = OrderedDict()  # referenced by nmrChain
+        self.nmrChains = OrderedDict()  # referenced by nmrChain -> IndexedList(nmrResidues)
 
         # store all visible gui items
         self.guiNmrResidues = OrderedDict()  # referenced by nmrResidue
@@ -444,12 +605,51 @@ class NmrResidueList(object):
         self.guiNmrAtomsFromNmrResidue = OrderedDict()  # referenced by nmrResidue -> list(guiNmrAtoms)
 
         self.ghostList = {}
+        self.ghostRecords = []  # GhostRecords of all the ghost nmrResidues in the scene
 
         self.connectingLines = {}  # referenced by peak?
         self.assignmentLines = {}
 
+        # reverse indexes to the lines in connectingLines/assignmentLines, updated as lines are added/removed
+        self.linesFromPeak = {}  # referenced by peak -> list(lines)
+        self.linesFromGuiNmrAtom = {}  # referenced by guiNmrAtom -> list(lines)
+
+        # number of assignment lines between each pair of guiNmrAtoms, used for the displacements of the lines
+        self.connectionCounts = PairCounts()
+
         self.nmrChain = None  # current active nmrChain
 
+        # set of lines visited while refreshing, see _refreshingLines
+        self._refreshedLines = None
+
+        # lines drawn in place of the assignment lines at low zoom, referenced by (guiNmrResidueGroup, guiNmrResidueGroup)
+        self.bundleLines = {}
+
+        # layout of all the nmrResidues in virtualised nmrChains, only the visible nmrResidues are in nmrChains
+        self.layoutRecords = OrderedDict()  # referenced by nmrChainId -> list(LayoutRecord)
+        self.layoutFromNmrResidue = {}  # referenced by nmrResidue -> LayoutRecord
+
+    def saveState(self):
+        """Remove the gui items from the scene and return the current state.
+        The state holds the only references to the gui items, which are restored with restoreState.
+        """
+        self._removeBundleLines()
+        state = {attr: getattr(self, attr) for attr in self._STATEATTRIBUTES}
+        for group in list(self.guiNmrResidues.values()) + [record.group for record in self.ghostRecords]:
+            self._removeItemFromScene(group)
+        self.reset()
+
+        return state
+
+    def restoreState(self, state):
+        """Restore a state returned from saveState and put the gui items back in the scene.
+        """
+        for attr in self._STATEATTRIBUTES:
+            setattr(self, attr, state[attr])
+        for group in list(self.guiNmrResidues.values()) + [record.group for record in self.ghostRecords]:
+            group.setDetailed(self.detailed)
+            self._scene.addItem(group)
+
     def size(self, nmrChainId):
         """return the number of elements in the list nmrChain.
         """
@@ -459,6 +659,7 @@ class NmrResidueList(object):
 
     def getIndexNmrResidue(self, nmrResidue):
         """get the index in the nmrResidueList of the required nmrResidue.
+        Membership is a dict lookup in the IndexedList of each nmrChain, the index is found from its block.
         """
         for id, nmrCh in self.nmrChains.items():
             if nmrResidue in nmrCh:
@@ -490,7 +691,7 @@ class NmrResidueList(object):
         """insert into the list as a tuple (obj, dict).
         """
         if nmrChainId not in self.nmrChains:
-            self.nmrChains[nmrChainId] = [nmrResidue]
+            self.nmrChains[nmrChainId] = IndexedList([nmrResidue])
         else:
             self.nmrChains[nmrChainId].insert(index, nmrResidue)
 
@@ -621,7 +822,6 @@ class NmrResidueList(object):
             self.ghostList[nmrResidueCon0] = ()
 
         nmrResidue = nmrResidueCon1
-        atoms = {}
         if atomSpacing:
             self.atomSpacing = atomSpacing
         nmrAtoms = [nmrAtom.name for nmrAtom in nmrResidue.nmrAtoms]
@@ -630,14 +830,20 @@ class NmrResidueList(object):
         if nmrResidue.residueType == 'GLY':
             del residueAtoms['CB']
 
-        for k, v in residueAtoms.items():
-            if k in nmrAtoms:
-                nmrAtom = nmrResidue.fetchNmrAtom(name=k)
-            else:
-                nmrAtom = None
-            atoms[k] = self._createGhostGuiNmrAtom(k, v, nmrAtom)
+        residueNmrAtoms = OrderedDict((k, nmrResidue.fetchNmrAtom(name=k) if k in nmrAtoms else None)
+                                      for k in residueAtoms.keys())
+        signature = (nmrResidue.residueType, tuple(residueNmrAtoms.items()))
 
-        newGuiResidueGroup = self._assembleGhostResidue(nmrResidue, atoms, lineList=lineList)
+        # reuse the gui items from the pool if the nmrResidue has not changed since they were created
+        record = self._getPooledGhostResidue(nmrResidue, signature, lineList=lineList)
+        if record is None:
+            atoms = {k: self._createGhostGuiNmrAtom(k, v, residueNmrAtoms[k]) for k, v in residueAtoms.items()}
+            newGuiResidueGroup = self._assembleGhostResidue(nmrResidue, atoms, lineList=lineList)
+            lines = [item for item in newGuiResidueGroup.childItems() if isinstance(item, AssignmentLine)]
+            record = GhostRecord(signature, newGuiResidueGroup, atoms, lines)
+
+        self.ghostRecords.append(record)
+        newGuiResidueGroup, atoms = record.group, record.guiAtoms
         newGuiResidueGroup.crossChainCount = count
         newGuiResidueGroup.crossChainResidue = nmrResidueCon0
 
@@ -778,6 +984,11 @@ class NmrResidueList(object):
         for line in lineList[itemKey]:
             if (line.guiAtom1 == guiAtom1 and line.guiAtom2 == guiAtom2 and line._peak == peak) or \
                     (line.guiAtom2 == guiAtom1 and line.guiAtom1 == guiAtom2 and line._peak == peak):
+
+                if self._refreshedLines is not None and line not in self._refreshedLines:
+                    # keep the existing line, with the displacement that a new line would have
+                    self._refreshedLines.add(line)
+                    line.displacement = displacement
                 break
         else:
             # add a newLine only if it doesn't already exists - may cause some gaps in the displacements
@@ -788,10 +999,77 @@ class NmrResidueList(object):
             newLine.setParentItem(group)
 
             lineList[itemKey].append(newLine)
+            self._indexLine(newLine, lineList, itemKey)
+            if self._refreshedLines is not None:
+                self._refreshedLines.add(newLine)
             return newLine
 
         return None
 
+    def _indexLine(self, line, lineList, itemKey):
+        """Add the line to the peak/guiNmrAtom indexes and store the lineList that it belongs to.
+        """
+        line._lineList = lineList
+        line._lineKey = itemKey
+
+        if line._peak is not None:
+            self.linesFromPeak.setdefault(line._peak, []).append(line)
+        self.linesFromGuiNmrAtom.setdefault(line.guiAtom1, []).append(line)
+        if line.guiAtom2 is not line.guiAtom1:
+            self.linesFromGuiNmrAtom.setdefault(line.guiAtom2, []).append(line)
+        line.guiAtom1.lines.add(line)
+        line.guiAtom2.lines.add(line)
+
+    def _unindexLine(self, line):
+        """Remove the line from the peak/guiNmrAtom indexes.
+        """
+        for index, key in ((self.linesFromPeak, line._peak),
+                           (self.linesFromGuiNmrAtom, line.guiAtom1),
+                           (self.linesFromGuiNmrAtom, line.guiAtom2)):
+            lines = index.get(key)
+            if lines and line in lines:
+                lines.remove(line)
+                if not lines:
+                    del index[key]
+        line.guiAtom1.lines.discard(line)
+        line.guiAtom2.lines.discard(line)
+
+    def _unlistLine(self, line):
+        """Remove the line from its lineList and the indexes, but leave in the scene.
+        """
+        lines = line._lineList.get(line._lineKey) if line._lineList is not None else None
+        if lines and line in lines:
+            lines.remove(line)
+        self._unindexLine(line)
+
+    def _removeLine(self, line):
+        """Remove the line from its lineList, the indexes and the scene.
+        """
+        self._unlistLine(line)
+        self._removeItemFromScene(line)
+
+    def _removeItemFromScene(self, item):
+        """Remove the item from the scene if it is currently displayed.
+        item.scene() is held by the item, so this avoids building the list of all the items in the scene.
+        """
+        if item.scene() is self._scene:
+            self._scene.removeItem(item)
+
+    def getLinesFromPeaks(self, peaks, lineList=None):
+        """Return the lines attached to the given peaks, only those in lineList if specified.
+        """
+        return [line for peak in OrderedSet(makeIterableList(peaks))
+                for line in self.linesFromPeak.get(peak, ())
+                if lineList is None or line._lineList is lineList]
+
+    def getLinesFromGuiNmrAtoms(self, guiNmrAtoms, lineList=None):
+        """Return the lines attached to any of the given guiNmrAtoms, only those in lineList if specified.
+        """
+        lines = OrderedSet(line for guiAtom in guiNmrAtoms
+                           for line in self.linesFromGuiNmrAtom.get(guiAtom, ())
+                           if lineList is None or line._lineList is lineList)
+        return list(lines)
+
     def addConnectionsBetweenGroups(self, nmrChainId):
         """Add the connections between the groups.
         """
@@ -799,10 +1077,30 @@ class NmrResidueList(object):
 
         # mainNmrResidues = self.nmrChain.mainNmrResidues
         # get the list of nmrResidues in the required nmrChain referenced by nmrChainId
-        mainNmrResidues = self.nmrChains[nmrChainId] if nmrChainId in self.nmrChains else []  #[resPair[0] for resPair in self.nmrChains[nmrChainId]]
+        mainNmrResidues = list(self.nmrChains[nmrChainId]) if nmrChainId in self.nmrChains else []  #[resPair[0] for resPair in self.nmrChains[nmrChainId]]
 
         # iterate through the adjacent pairs
-        for prevRes, thisRes in zip(mainNmrResidues[:-1], mainNmrResidues[1:]):
+        self._addConnectionsBetweenPairs(zip(mainNmrResidues[:-1], mainNmrResidues[1:]))
+
+    def addConnectionsAroundNmrResidues(self, nmrChainId, nmrResidues):
+        """Add the connections between the nmrResidues and the groups either side of them.
+        """
+        nmrList = self.nmrChains.get(nmrChainId, ())
+        pairs = OrderedSet()
+        for nmrResidue in nmrResidues:
+            if nmrResidue in nmrList:
+                ii = nmrList.index(nmrResidue)
+                if ii > 0:
+                    pairs.add((nmrList[ii - 1], nmrResidue))
+                if ii < len(nmrList) - 1:
+                    pairs.add((nmrResidue, nmrList[ii + 1]))
+
+        self._addConnectionsBetweenPairs(pairs)
+
+    def _addConnectionsBetweenPairs(self, pairs):
+        """Add the connections between the groups of the adjacent (previous, this) nmrResidue pairs.
+        """
+        for prevRes, thisRes in pairs:
 
             # add the connection the minus residue and point to the right - may need to change for +1 residues
             # prevRes, prevGuiAtoms = prev
@@ -837,6 +1135,279 @@ class NmrResidueList(object):
 
     #==========================================================================================
 
+    def updateNmrChain(self, nmrChainId, nmrResidues, peakAssignments=None, maxCreate=None):
+        """Update the nmrResidues displayed for nmrChainId to the new list.
+        GuiNmrResidueGroups that are still valid are kept, only new nmrResidues are created and old ones removed.
+        Connecting/peak assignment lines are refreshed, unchanged lines are left in the scene.
+        peakAssignments are the pairings from _getPeakAssignmentsForNmrResidues if already calculated.
+        If maxCreate is specified, only create that many new guiNmrResidueGroups; the lines are only refreshed
+        when all the nmrResidues exist. Returns True if all the nmrResidues exist.
+        """
+        nmrResidues = list(nmrResidues)
+        required = set(nmrResidues)
+
+        # remove the nmrResidues that are no longer needed
+        for nmrResidue in list(self.guiNmrResidues.keys()):
+            if nmrResidue not in required or nmrResidue.isDeleted or nmrResidue._flaggedForDelete:
+                self._removeGuiNmrResidue(nmrResidue)
+
+        # ghost nmrResidues are recreated with the peak assignments
+        self._removeGhostResidues()
+
+        # add the missing nmrResidues, keeping the existing groups
+        nmrList = self.nmrChains[nmrChainId] = IndexedList()
+        created = 0
+        for ii, nmrResidue in enumerate(nmrResidues):
+            if nmrResidue in self.guiNmrResidues:
+                nmrList.append(nmrResidue)
+            elif maxCreate is None or created < maxCreate:
+                self.addNmrResidue(nmrChainId, nmrResidue, index=ii)
+                created += 1
+
+        if len(nmrList) < len(nmrResidues):
+            return False
+
+        # rebuild the lines, removing those that are no longer required
+        with self._refreshingLines():
+            self.clearAllGuiNmrAtoms()
+            self.addConnectionsBetweenGroups(nmrChainId)
+            self._addAllPeakAssignments(nmrChainId, peakAssignments=peakAssignments)
+
+        return True
+
+    @contextmanager
+    def _refreshingLines(self):
+        """Context manager to remove the connecting/assignment lines that are not visited
+        by _addConnectingLineToGroup within the block; the lines inside each group are kept.
+        """
+        self._refreshedLines = set()
+        try:
+            # pass control to the calling function
+            yield
+
+        finally:
+            refreshed, self._refreshedLines = self._refreshedLines, None
+
+            staleLines = [line for lineDict in (self.connectingLines, self.assignmentLines)
+                          for lineList in lineDict.values()
+                          for line in lineList
+                          if line not in refreshed and
+                          (line._peak is not None or line.guiAtom1.guiNmrResidueGroup is not line.guiAtom2.guiNmrResidueGroup)]
+            for line in staleLines:
+                self._removeLine(line)
+
+    def addConnection(self, guiAtom1, guiAtom2):
+        """Add one to the number of lines between the guiNmrAtoms.
+        """
+        self.connectionCounts.increment(guiAtom1.atomId, guiAtom2.atomId)
+        guiAtom1.setLinesDirty(guiAtom2)
+        guiAtom2.setLinesDirty(guiAtom1)
+
+    def getConnectionCount(self, guiAtom1, guiAtom2):
+        """Return the number of lines between the guiNmrAtoms.
+        """
+        return self.connectionCounts.get(guiAtom1.atomId, guiAtom2.atomId)
+
+    def clearConnections(self, guiAtoms=None):
+        """Clear the number of lines connected to guiAtoms, or to all the guiNmrAtoms, but keep the connections.
+        """
+        self.connectionCounts.clear(None if guiAtoms is None else [guiAtom.atomId for guiAtom in guiAtoms])
+        for guiAtom in (self.guiNmrAtoms.values() if guiAtoms is None else guiAtoms):
+            guiAtom.setLinesDirty()
+
+    def deleteConnections(self, guiAtoms):
+        """Delete all the connections to guiAtoms.
+        """
+        self.connectionCounts.discard([guiAtom.atomId for guiAtom in guiAtoms])
+        for guiAtom in guiAtoms:
+            guiAtom.setLinesDirty()
+
+    def _removeGuiNmrResidue(self, nmrResidue):
+        """Remove the guiNmrResidueGroup, its guiNmrAtoms and attached lines from the scene and the dicts.
+        """
+        guiAtoms = self.guiNmrAtomsFromNmrResidue.pop(nmrResidue, {})
+        for line in self.getLinesFromGuiNmrAtoms(guiAtoms.values()):
+            self._removeLine(line)
+        self.deleteConnections(guiAtoms.values())
+        for guiAtom in guiAtoms.values():
+            if guiAtom.nmrAtom is not None and self.guiNmrAtoms.get(guiAtom.nmrAtom) is guiAtom:
+                del self.guiNmrAtoms[guiAtom.nmrAtom]
+
+        group = self.guiNmrResidues.pop(nmrResidue, None)
+        if group is not None:
+            self._removeItemFromScene(group)
+
+    def _removeGhostResidues(self):
+        """Remove all the ghost nmrResidues and their attached lines from the scene and the dicts.
+        The gui items are kept in the pool to be reused by _addGhostResidue.
+        """
+        ghostAtoms = []
+        for record in self.ghostRecords:
+            guiAtoms = list(record.guiAtoms.values())
+            ghostAtoms.extend(guiAtoms)
+            for line in self.getLinesFromGuiNmrAtoms(guiAtoms):
+                if line in record.lines:
+                    # the internal lines stay in the group
+                    self._unlistLine(line)
+                else:
+                    self._removeLine(line)
+            for guiAtom in guiAtoms:
+                if guiAtom.nmrAtom is not None and self.guiNmrAtoms.get(guiAtom.nmrAtom) is guiAtom:
+                    del self.guiNmrAtoms[guiAtom.nmrAtom]
+            self._removeItemFromScene(record.group)
+
+            nmrResidue = record.group.nmrResidue
+            if not (nmrResidue.isDeleted or nmrResidue._flaggedForDelete):
+                self._ghostPool.setdefault(nmrResidue, []).append(record)
+                self._ghostPool.move_to_end(nmrResidue)
+                self._ghostPoolSize += 1
+
+        # all together, deleteConnections scans all the connections
+        self.deleteConnections(ghostAtoms)
+
+        # only keep the most recently used ghost nmrResidues
+        while self._ghostPoolSize > MAXPOOLEDGHOSTS:
+            _, records = self._ghostPool.popitem(last=False)
+            self._ghostPoolSize -= len(records)
+
+        self.ghostRecords.clear()
+        self.guiGhostNmrResidues.clear()
+        self.ghostList.clear()
+
+    def _getPooledGhostResidue(self, nmrResidue, signature, lineList=None):
+        """Return a GhostRecord from the pool for nmrResidue and put its gui items back in the scene and the dicts.
+        Pooled items created from a different signature are out-of-date and discarded.
+        Returns None if there is no valid pooled ghost nmrResidue.
+        """
+        records = self._ghostPool.get(nmrResidue)
+        record = None
+        while records:
+            pooled = records.pop()
+            self._ghostPoolSize -= 1
+            if pooled.signature == signature:
+                record = pooled
+                break
+        if not records:
+            self._ghostPool.pop(nmrResidue, None)
+        if record is None:
+            return None
+
+        group = record.group
+        self.guiGhostNmrResidues[nmrResidue] = group
+        self._scene.addItem(group)
+        group.setDetailed(self.detailed)
+        group.nmrResidueLabel._update()
+
+        for guiAtom in record.guiAtoms.values():
+            if guiAtom.nmrAtom is not None:
+                self.guiNmrAtoms[guiAtom.nmrAtom] = guiAtom
+
+        # put the internal lines back in the lineList
+        itemKey = id(nmrResidue)
+        lines = lineList.setdefault(itemKey, [])
+        for line in record.lines:
+            lines.append(line)
+            self._indexLine(line, lineList, itemKey)
+            line.setDirty()
+            if self._refreshedLines is not None:
+                self._refreshedLines.add(line)
+
+        return record
+
+    def clearGhostPool(self):
+        """Discard the ghost nmrResidues kept for reuse.
+        """
+        self._ghostPool.clear()
+        self._ghostPoolSize = 0
+
+    def setLayout(self, nmrChainId, nmrResidues):
+        """Set the layout records for all the nmrResidues of a virtualised nmrChain.
+        """
+        self.clearLayout(nmrChainId)
+
+        spacing = self._atomSpacing * 3.0
+        records = self.layoutRecords[nmrChainId] = [LayoutRecord(nmrResidue, ii, ii * spacing)
+                                                    for ii, nmrResidue in enumerate(nmrResidues)]
+        self.layoutFromNmrResidue.update((record.nmrResidue, record) for record in records)
+
+    def clearLayout(self, nmrChainId):
+        """Remove the layout records for the nmrChain.
+        """
+        for record in self.layoutRecords.pop(nmrChainId, ()):
+            self.layoutFromNmrResidue.pop(record.nmrResidue, None)
+
+    def isVirtual(self, nmrChainId):
+        """Return True if the nmrChain only displays the visible nmrResidues.
+        """
+        return nmrChainId in self.layoutRecords
+
+    def getLayoutNmrResidues(self, nmrChainId, left, right, margin=0):
+        """Return the nmrResidues of the virtualised nmrChain that lie between left and right in scene co-ordinates,
+        with margin extra nmrResidues either side.
+        """
+        records = self.layoutRecords.get(nmrChainId, [])
+        layoutSlice = _getLayoutSlice(len(records), self._atomSpacing * 3.0, left, right, margin)
+
+        return [record.nmrResidue for record in records[layoutSlice]]
+
+    def layoutRect(self):
+        """Return the scene rectangle covering the layout of the virtualised nmrChains.
+        """
+        rect = QtCore.QRectF()
+        for records in self.layoutRecords.values():
+            if records:
+                rect = rect.united(QtCore.QRectF(records[0].x, -3.0 * self._atomSpacing,
+                                                 records[-1].x + 3.0 * self._atomSpacing, 3.0 * self._atomSpacing))
+        return rect
+
+    def setLevelOfDetail(self, detailed):
+        """Set the level of detail of the scene.
+        When not detailed, the guiNmrResidueGroups are drawn as compact glyphs and the assignment lines
+        are replaced by a single line between each pair of connected groups.
+        """
+        self.detailed = detailed
+        self.updateLevelOfDetail()
+
+    def updateLevelOfDetail(self):
+        """Update the groups and the bundled lines to the current level of detail.
+        """
+        self._removeBundleLines()
+        for group in list(self.guiNmrResidues.values()) + list(self.guiGhostNmrResidues.values()):
+            group.setDetailed(self.detailed)
+
+        if not self.detailed:
+            self._addBundleLines()
+
+    def _addBundleLines(self):
+        """Add a line for each pair of guiNmrResidueGroups connected by assignment lines,
+        the width increases with the number of assignment lines.
+        """
+        counts = OrderedDict()
+        for lineList in self.assignmentLines.values():
+            for line in lineList:
+                group1 = line.guiAtom1.guiNmrResidueGroup
+                group2 = line.guiAtom2.guiNmrResidueGroup
+                if group1 is not group2:
+                    key = (group1, group2) if id(group1) < id(group2) else (group2, group1)
+                    counts[key] = counts.get(key, 0) + 1
+
+        for (group1, group2), count in counts.items():
+            pos1 = group1.glyphCentre()
+            pos2 = group2.glyphCentre()
+
+            bundleLine = QtWidgets.QGraphicsLineItem(pos1.x(), pos1.y(), pos2.x(), pos2.y())
+            bundleLine.setPen(_getLinePen(self._lineColour, min(1.0 + 0.5 * count, MAXBUNDLEWIDTH)))
+            bundleLine.setZValue(-1)
+            self._scene.addItem(bundleLine)
+            self.bundleLines[(group1, group2)] = bundleLine
+
+    def _removeBundleLines(self):
+        """Remove the bundled lines from the scene.
+        """
+        for bundleLine in self.bundleLines.values():
+            self._removeItemFromScene(bundleLine)
+        self.bundleLines = {}
+
     def updateMainChainPositions(self, nmrChainId):
         """Update the positions of the group in the scene.
         May need to set vertical positions when more groups are allowed
@@ -856,7 +1427,10 @@ class NmrResidueList(object):
 
             if nmrResidue in self.guiNmrResidues:
                 guiItem = self.guiNmrResidues[nmrResidue]
-                guiItem.setPos(QtCore.QPointF(ii * self.atomSpacing * 3.0, 0.0))
+
+                # virtualised nmrChains are positioned from the layout of the whole nmrChain
+                record = self.layoutFromNmrResidue.get(nmrResidue)
+                guiItem.setPos(QtCore.QPointF(record.x if record else ii * self.atomSpacing * 3.0, 0.0))
 
     def updateConnectedChainPositions(self, nmrChainId):
         """Update the positions of the groups in the scene.
@@ -875,37 +1449,30 @@ class NmrResidueList(object):
 
     #==========================================================================================
 
-    def _addAllPeakAssignments(self, nmrChainId):
+    def _addAllPeakAssignments(self, nmrChainId, peakAssignments=None):
         """Add all the peak assignments to the scene.
         """
         if self._SGwidget.checkBoxes['peakAssignments']['checkBox'].isChecked():
 
-            # # create a set of sets ordered by spectra for active lines
-            # self.LOCALinterResidueAtomPairing = OrderedDict((spec, set()) for spec in self._module.magnetisationTransfers.keys())
-            # self.LOCALinterChainAtomPairing = OrderedDict((spec, set()) for spec in self._module.magnetisationTransfers.keys())
-            # self.LOCALcrossChainAtomPairing = OrderedDict((spec, set()) for spec in self._module.magnetisationTransfers.keys())
-
-            # mainNmrResidues = self.nmrChain.mainNmrResidues
             # get the list of nmrResidues in the required nmrChain referenced by nmrChainId
-            mainNmrResidues = self.nmrChains[nmrChainId] if nmrChainId in self.nmrChains else []  #[resPair[0] for resPair in self.nmrChains[nmrChainId]]
-
-            for nmrResidue in mainNmrResidues:
-                # guiRes = self.guiNmrAtomsFromNmrResidue[nmrResidue]
+            mainNmrResidues = self.nmrChains[nmrChainId] if nmrChainId in self.nmrChains else []
 
-                # add the internally connected Lines
-                internalAssignments, interChainAssignments, crossChainAssignments = self._getPeakAssignmentsForResidue(nmrResidue)
+            self._addPeakAssignmentLines(mainNmrResidues, peakAssignments=peakAssignments)
 
-                self._addPeakAssignmentLinesToGroup(internalAssignments, self.assignmentLines)
-                self._addPeakAssignmentLinesToGroup(interChainAssignments, self.assignmentLines)
+    def _addPeakAssignmentLines(self, nmrResidues, nmrAtomIncludeList=None, peakAssignments=None):
+        """Add the peak assignment lines for the nmrResidues, creating ghost nmrResidues if required.
+        peakAssignments are the pairings from _getPeakAssignmentsForNmrResidues if already calculated.
+        """
+        if peakAssignments is None:
+            peakAssignments = self._getPeakAssignmentsForNmrResidues(nmrResidues, nmrAtomIncludeList=nmrAtomIncludeList)
+        internalAssignments, interChainAssignments, crossChainAssignments = peakAssignments
 
-                # add assignment lines and create ghost nmrResidues if required
-                self._addPeakAssignmentLinesToAdjacentGroup(nmrResidue, crossChainAssignments,
-                                                            self.assignmentLines, self.connectingLines)
+        self._addPeakAssignmentLinesToGroup(internalAssignments, self.assignmentLines)
+        self._addPeakAssignmentLinesToGroup(interChainAssignments, self.assignmentLines)
 
-            # self._addPeakAssignmentLinesToGroup(self.LOCALinterResidueAtomPairing, self.assignmentLines)
-            # self._addPeakAssignmentLinesToGroup(self.LOCALinterChainAtomPairing, self.assignmentLines)
-            # self._addPeakAssignmentLinesToAdjacentGroup(self._module.nmrChain, self.LOCALcrossChainAtomPairing,
-            #                                             self.assignmentLines, self.connectingLines)
+        for nmrResidue, assignments in crossChainAssignments.items():
+            self._addPeakAssignmentLinesToAdjacentGroup(nmrResidue, assignments,
+                                                        self.assignmentLines, self.connectingLines)
 
     #==========================================================================================
 
@@ -927,7 +1494,7 @@ class NmrResidueList(object):
                 # get the peak and the spectrum
                 peak = guiNmrAtomPair[2]
                 spectrum = peak.peakList.spectrum
-                displacement = guiNmrAtomPair[0].getConnectedList(guiNmrAtomPair[1])
+                displacement = self.getConnectionCount(guiNmrAtomPair[0], guiNmrAtomPair[1])
 
                 # add the internal line to the guiNmrResidueGroup, should now move when group is moved
                 guiNmrResidue = self.guiNmrResidues[guiNmrAtomPair[0].nmrAtom.nmrResidue]
@@ -940,8 +1507,7 @@ class NmrResidueList(object):
                                                peak=peak, lineList=lineList, lineId=peak)
 
                 # update displacements for both guiNmrAtoms
-                guiNmrAtomPair[0].addConnectedList(guiNmrAtomPair[1])
-                guiNmrAtomPair[1].addConnectedList(guiNmrAtomPair[0])
+                self.addConnection(guiNmrAtomPair[0], guiNmrAtomPair[1])
 
     def _addPeakAssignmentLinesToAdjacentGroup(self, nmrResidue, assignments, peaklineList, connectingLineList):
         """Add the peak assignments to nmrResidues in the same chain.
@@ -978,7 +1544,7 @@ class NmrResidueList(object):
                                       )
 
                     group = self.guiNmrResidues[nmrAtomPair[1].nmrResidue]
-                    displacement = guiNmrAtomPair[1].getConnectedList(guiNmrAtomPair[0])
+                    displacement = self.getConnectionCount(guiNmrAtomPair[1], guiNmrAtomPair[0])
                     self._addConnectingLineToGroup(group,
                                                    guiNmrAtomPair[1],
                                                    guiNmrAtomPair[0],
@@ -1003,7 +1569,7 @@ class NmrResidueList(object):
                                       )
 
                     group = self.guiNmrResidues[nmrAtomPair[0].nmrResidue]
-                    displacement = guiNmrAtomPair[0].getConnectedList(guiNmrAtomPair[1])
+                    displacement = self.getConnectionCount(guiNmrAtomPair[0], guiNmrAtomPair[1])
                     self._addConnectingLineToGroup(group,
                                                    guiNmrAtomPair[0],
                                                    guiNmrAtomPair[1],
@@ -1014,7 +1580,7 @@ class NmrResidueList(object):
                 else:
                     if nmrAtomPair[0].nmrResidue.nmrChain is nmrResidue.nmrChain:
                         group = self.guiNmrResidues[nmrAtomPair[0].nmrResidue]
-                        displacement = guiNmrAtomPair[0].getConnectedList(guiNmrAtomPair[1])
+                        displacement = self.getConnectionCount(guiNmrAtomPair[0], guiNmrAtomPair[1])
                         self._addConnectingLineToGroup(group,
                                                        guiNmrAtomPair[0],
                                                        guiNmrAtomPair[1],
@@ -1024,7 +1590,7 @@ class NmrResidueList(object):
 
                     elif nmrAtomPair[1].nmrResidue.nmrChain is nmrResidue.nmrChain:
                         group = self.guiNmrResidues[nmrAtomPair[1].nmrResidue]
-                        displacement = guiNmrAtomPair[1].getConnectedList(guiNmrAtomPair[0])
+                        displacement = self.getConnectionCount(guiNmrAtomPair[1], guiNmrAtomPair[0])
                         self._addConnectingLineToGroup(group,
                                                        guiNmrAtomPair[1],
                                                        guiNmrAtomPair[0],
@@ -1034,8 +1600,7 @@ class NmrResidueList(object):
                     else:
                         continue
 
-                guiNmrAtomPair[0].addConnectedList(guiNmrAtomPair[1])
-                guiNmrAtomPair[1].addConnectedList(guiNmrAtomPair[0])
+                self.addConnection(guiNmrAtomPair[0], guiNmrAtomPair[1])
 
     def _getPeakAssignmentsForResidue(self, nmrResidue, nmrAtomIncludeList=None):
         """Get the list of peak assignments from the nmrAtoms
@@ -1043,96 +1608,107 @@ class NmrResidueList(object):
         interChainAtomPairing is the linking within the same chain but to different nmrResidues
         crossChainAtomPairing is the linking to different chains
         """
+        interResidueAtomPairing, interChainAtomPairing, crossChainAtomPairing = \
+            self._getPeakAssignmentsForNmrResidues((nmrResidue,), nmrAtomIncludeList=nmrAtomIncludeList)
 
-        # create a set of sets ordered by spectra
-        interResidueAtomPairing = OrderedDict((spec, set()) for spec in self._module.magnetisationTransfers.keys())
-        interChainAtomPairing = OrderedDict((spec, set()) for spec in self._module.magnetisationTransfers.keys())
-        crossChainAtomPairing = OrderedDict((spec, set()) for spec in self._module.magnetisationTransfers.keys())
-        # emptyAtomPairing = OrderedDict((spec, set()) for spec in self._module.magnetisationTransfers.keys())
-
-        nmrChain = nmrResidue.nmrChain
-
-        for nmrAtom in nmrResidue.nmrAtoms:
-
-            if nmrAtom._flaggedForDelete or nmrAtom.isDeleted:
-                continue
-
-            for peak in nmrAtom.assignedPeaks:
+        if nmrResidue in crossChainAtomPairing:
+            return interResidueAtomPairing, interChainAtomPairing, crossChainAtomPairing[nmrResidue]
+        return interResidueAtomPairing, interChainAtomPairing, OrderedDict((spec, set()) for spec in self._module.magnetisationTransfers.keys())
 
-                # ignore peaks that are due for delete (can probably also use the notifier list)
-                if peak._flaggedForDelete or peak.isDeleted:
-                    continue
-
-                spec = peak.peakList.spectrum
-                for assignment in peak.assignments:
-
-                    # find the mainNmrResidue for -1 and +1 connections
-                    newCon = list(assignment)
-                    for conNum in range(len(assignment)):
-
-                        # assignments could be None
-                        if assignment[conNum] and assignment[conNum].nmrResidue.relativeOffset == -1:  # and inCon[conNum].nmrResidue.nmrChain.isConnected:
+    def _getConnectedNmrAtom(self, nmrAtom, nmrAtomsFromName):
+        """Return the nmrAtom of the previous/nextNmrResidue that the -1/+1 offset nmrAtom refers to.
+        Returns None if the offset nmrResidue is not connected, or nmrAtom if there is no matching nmrAtom.
+        nmrAtomsFromName is a dict referenced by nmrResidue -> {name: nmrAtom}, filled as required.
+        """
+        nmrResidue = nmrAtom.nmrResidue
+        offset = nmrResidue.relativeOffset
+        if offset == -1:
+            conNmrResidue = nmrResidue.mainNmrResidue.previousNmrResidue
+        elif offset == +1:
+            conNmrResidue = nmrResidue.mainNmrResidue.nextNmrResidue
+        else:
+            return nmrAtom
 
-                            # this is a minus residue so find connected, have to traverse to the previousNmrResidue
-                            # will it always exist?
-                            conName = assignment[conNum].name
-                            preN = assignment[conNum].nmrResidue.mainNmrResidue.previousNmrResidue
-                            if preN:
-                                newConSwap = [nmrA for nmrA in preN.nmrAtoms if nmrA.name == conName]
-                                if newConSwap:
-                                    newCon[conNum] = newConSwap[0]
-                            else:
-                                newCon[conNum] = None  # not connected so skip
-
-                        elif assignment[conNum] and assignment[conNum].nmrResidue.relativeOffset == +1:  # and inCon[conNum].nmrResidue.nmrChain.isConnected:
-
-                            # this is a plus residue so find connected, have to traverse to the nextNmrResidue
-                            # will it always exist?
-                            conName = assignment[conNum].name
-                            preN = assignment[conNum].nmrResidue.mainNmrResidue.nextNmrResidue
-                            if preN:
-                                newConSwap = [nmrA for nmrA in preN.nmrAtoms if nmrA.name == conName]
-                                if newConSwap:
-                                    newCon[conNum] = newConSwap[0]
-                            else:
-                                newCon[conNum] = None  # not connected so skip
+        if not conNmrResidue:
+            # not connected so skip
+            return None
 
-                    assignment = newCon
+        if conNmrResidue not in nmrAtomsFromName:
+            names = nmrAtomsFromName[conNmrResidue] = {}
+            for nmrA in conNmrResidue.nmrAtoms:
+                names.setdefault(nmrA.name, nmrA)
 
-                    # only get the assignments a-b if a and b are defined in the spectrum magnetisationTransfers list
-                    for mag in self._module.magnetisationTransfers[spec]:
-                        nmrAtom0 = assignment[mag[0] - 1]
-                        nmrAtom1 = assignment[mag[1] - 1]
-                        nmrAtom0 = nmrAtom0 if nmrAtom0 and not (nmrAtom0.isDeleted or nmrAtom0._flaggedForDelete) else None
-                        nmrAtom1 = nmrAtom1 if nmrAtom1 and not (nmrAtom1.isDeleted or nmrAtom1._flaggedForDelete) else None
+        return nmrAtomsFromName[conNmrResidue].get(nmrAtom.name, nmrAtom)
 
-                        if not None in (nmrAtom0, nmrAtom1):
+    def _getPeakAssignmentsForNmrResidues(self, nmrResidues, nmrAtomIncludeList=None, magnetisationTransfers=None):
+        """Get the peak assignments for a list of nmrResidues in a single pass, each peak is only visited once.
+        interResidueAtomPairing is the linking within the same nmrResidue
+        interChainAtomPairing is the linking within the same chain but to different nmrResidues
+        crossChainAtomPairing is the linking to different chains, as a dict referenced by the first nmrResidue
+        containing the peak
+        """
+        if magnetisationTransfers is None:
+            magnetisationTransfers = self._module.magnetisationTransfers
 
-                            # ignore nmrAtoms that are not in the include list (if specified)
-                            if nmrAtomIncludeList is not None and not (nmrAtom0 in nmrAtomIncludeList or nmrAtom1 in nmrAtomIncludeList):
-                                continue
+        snapshot = self._snapshotPeakAssignments(nmrResidues)
+        return _getPeakAssignmentPairings(snapshot, magnetisationTransfers, nmrAtomIncludeList=nmrAtomIncludeList)
 
-                            if (nmrAtom0.nmrResidue is nmrResidue) and (nmrAtom1.nmrResidue is nmrResidue):
+    def _snapshotPeakAssignments(self, nmrResidues):
+        """Read the peak assignments of the nmrResidues from the project into a PeakAssignmentSnapshot.
+        Must be called from the main thread, the snapshot holds no live state and can be paired by a LayoutTask.
+        """
+        for _count, _total, snapshot in self._iterSnapshotPeakAssignments(nmrResidues):
+            if snapshot is not None:
+                return snapshot
+
+    def _iterSnapshotPeakAssignments(self, nmrResidues, batchSize=None):
+        """Generator reading the peak assignments of the nmrResidues into a PeakAssignmentSnapshot in batches,
+        so that the main thread can process events between batches; all in one batch if batchSize is None.
+        Yields (count, total, None) after each batch of batchSize nmrResidues, and 4 * batchSize peaks,
+        and finally (total, total, snapshot).
+        """
+        # find the first nmrResidue that contains each peak
+        peakNmrResidues = OrderedDict()
+        for count, nmrResidue in enumerate(nmrResidues):
+            if batchSize and count and count % batchSize == 0:
+                yield count, len(nmrResidues), None
+            if nmrResidue.isDeleted or nmrResidue._flaggedForDelete:
+                continue
 
-                                # interResidueAtomPairing
-                                if (nmrAtom1, nmrAtom0, peak) not in interResidueAtomPairing[spec]:
-                                    interResidueAtomPairing[spec].add((nmrAtom0, nmrAtom1, peak))
+            for nmrAtom in nmrResidue.nmrAtoms:
+                if nmrAtom._flaggedForDelete or nmrAtom.isDeleted:
+                    continue
 
-                            elif (nmrAtom0.nmrResidue.nmrChain is nmrChain) and (nmrAtom1.nmrResidue.nmrChain is nmrChain):
+                for peak in nmrAtom.assignedPeaks:
+                    # ignore peaks that are due for delete
+                    if peak not in peakNmrResidues and not (peak._flaggedForDelete or peak.isDeleted):
+                        peakNmrResidues[peak] = nmrResidue
+
+        peaks = []
+        nmrAtoms = {}
+        nmrAtomsFromName = {}
+        for count, (peak, nmrResidue) in enumerate(peakNmrResidues.items()):
+            if batchSize and count and count % (4 * batchSize) == 0:
+                yield count, len(peakNmrResidues), None
+            if peak.isDeleted or peak._flaggedForDelete:
+                continue
 
-                                # connections within the same chain
-                                if (nmrAtom1, nmrAtom0, peak) not in interChainAtomPairing[spec]:
-                                    interChainAtomPairing[spec].add((nmrAtom0, nmrAtom1, peak))
+            assignments = tuple(tuple(assignment) for assignment in peak.assignments)
+            peaks.append((peak, nmrResidue, nmrResidue.nmrChain, peak.peakList.spectrum, assignments))
 
-                            # elif (nmrAtom0.nmrResidue.nmrChain is nmrChain) and (nmrAtom1.nmrResidue.nmrChain is not nmrChain):
-                            else:
+            for assignment in assignments:
+                for nmrAtom in assignment:
+                    if not nmrAtom or nmrAtom in nmrAtoms:
+                        continue
 
-                                # connections to a dif
-                                if (nmrAtom1, nmrAtom0, peak) not in crossChainAtomPairing[spec]:
-                                    crossChainAtomPairing[spec].add((nmrAtom0, nmrAtom1, peak))
+                    # replace the -1/+1 nmrAtoms with the nmrAtoms of the connected nmrResidues
+                    conNmrAtom = self._getConnectedNmrAtom(nmrAtom, nmrAtomsFromName)
+                    if not conNmrAtom or conNmrAtom.isDeleted or conNmrAtom._flaggedForDelete:
+                        nmrAtoms[nmrAtom] = None
+                    else:
+                        nmrAtoms[nmrAtom] = (conNmrAtom, conNmrAtom.nmrResidue, conNmrAtom.nmrResidue.nmrChain)
 
-        return interResidueAtomPairing, interChainAtomPairing, crossChainAtomPairing
-        # return emptyAtomPairing, emptyAtomPairing, crossChainAtomPairing
+        yield len(peakNmrResidues), len(peakNmrResidues), PeakAssignmentSnapshot(tuple(peaks), MappingProxyType(nmrAtoms))
 
     #==========================================================================================
     # spectrum update
@@ -1142,8 +1718,8 @@ class NmrResidueList(object):
         """
         for lineList in lineDist.values():
             for line in lineList:
-                if line in self._scene.items():
-                    self._scene.removeItem(line)
+                self._unindexLine(line)
+                self._removeItemFromScene(line)
         lineDist.clear()
 
     def removeAssignmentLinesFromScene(self):
@@ -1159,28 +1735,31 @@ class NmrResidueList(object):
     def clearAllGuiNmrAtoms(self):
         """clear the displacements in the nmrAtoms.
         """
-        # clear the displacement values but keep the dict connections
-        for guiAtom in self.guiNmrAtoms.values():
-            guiAtom.clearConnectedList()
+        # clear the displacement values but keep the connections
+        self.clearConnections()
 
     def rebuildPeakAssignments(self):
         """Rebuild all the peak assignments in the display after changing the number of spectra.
         """
 
-        # remove all previous assignment lines and reset the dict
+        # remove all previous assignment lines and reset the dict, ghost nmrResidues are reused from the pool
+        self._removeGhostResidues()
         self.removeAssignmentLinesFromScene()
         self.clearAllGuiNmrAtoms()
         for nmrChainId in self.nmrChains.keys():
             self._addAllPeakAssignments(nmrChainId)
+            self.updateConnectedChainPositions(nmrChainId)
 
         # update the endpoints
         self.updateEndPoints(self.assignmentLines)
 
     def updateEndPoints(self, lineDict):
-        """Update the end points from the dict.
+        """Update the end points from the dict, only for lines attached to items that have moved.
         """
         for lineList in lineDict.values():
             for line in lineList:
+                if not line._dirty:
+                    continue
                 try:
                     line.updateEndPoints()
                 except Exception as es:
@@ -1215,6 +1794,7 @@ class NmrResidueList(object):
     def getAssignmentLinesFromPeaks(self, peaks):
         """Get the list of assignment lines attached o the given peaks.
         """
+        return self.getLinesFromPeaks(peaks, self.assignmentLines)
 
     def _addAdjacentResiduesToSet(self, nmrResidue, residueSet):
         """Add the adjacent nmrResidues into the set.
@@ -1227,16 +1807,15 @@ class NmrResidueList(object):
         if nmr and nmr.mainNmrResidue:
             residueSet.add(nmr.mainNmrResidue)
 
-    def rebuildPeakLines(self, peaks, rebuildPeakLines=False, makeListFromPeak=False):
+    def rebuildPeakLines(self, peaks, rebuildPeakLines=False, makeListFromPeak=False, updatePositions=True):
         """Clear all lines on the display associated with peak.
+        Set updatePositions to False if the positions are updated by the calling function.
         """
         # find the current lines associated with the notified peak (or list of peaks)
         peaks = makeIterableList(peaks)
 
         # make list of peakLines attached to these peaks
-        peakLines = [peakLine for peakLineList in self.assignmentLines.values()
-                     for peakLine in peakLineList
-                     if peakLine._peak in peaks]
+        peakLines = self.getAssignmentLinesFromPeaks(peaks)
         guiNmrAtomSet = set()
         nmrResidueSet = set()
 
@@ -1261,19 +1840,12 @@ class NmrResidueList(object):
                 guiNmrAtomSet.add(self.guiNmrAtoms[nmrAtom])
                 self._addAdjacentResiduesToSet(nmrAtom.nmrResidue, nmrResidueSet)
 
-        for guiAtom in guiNmrAtomSet:
-            for peakLineList in self.assignmentLines.values():
-                peakLines = [peakLine for peakLine in peakLineList
-                             if peakLine.guiAtom1 is guiAtom or peakLine.guiAtom2 is guiAtom]
-
-                # remove all graphic lines
-                for peakLine in peakLines:
-                    peakLineList.remove(peakLine)
-                    if peakLine in self._scene.items():
-                        self._scene.removeItem(peakLine)
+        # remove all graphic lines
+        for peakLine in self.getLinesFromGuiNmrAtoms(guiNmrAtomSet, self.assignmentLines):
+            self._removeLine(peakLine)
 
-            # clear connectivity list of guiNmrAtoms, but don't delete
-            guiAtom.clearConnectedList()
+        # clear connectivity of guiNmrAtoms, but don't delete
+        self.clearConnections(guiNmrAtomSet)
 
         if rebuildPeakLines:
             # now rebuild for the new peak values
@@ -1289,28 +1861,20 @@ class NmrResidueList(object):
                 # self.LOCALinterChainAtomPairing = OrderedDict((spec, set()) for spec in self._module.magnetisationTransfers.keys())
                 # self.LOCALcrossChainAtomPairing = OrderedDict((spec, set()) for spec in self._module.magnetisationTransfers.keys())
 
-                for nmrResidue in nmrResidueSet:
-
-                    # only process residues in the current visible chain
-                    if nmrResidue.nmrChain is self._module.nmrChain:
-                        # add the internally connected Lines
-                        internalAssignments, interChainAssignments, crossChainAssignments = \
-                            self._getPeakAssignmentsForResidue(nmrResidue,
-                                                               nmrAtomIncludeList=nmrAtomIncludeList)
-
-                        self._addPeakAssignmentLinesToGroup(internalAssignments, self.assignmentLines)
-                        self._addPeakAssignmentLinesToGroup(interChainAssignments, self.assignmentLines)
-                        self._addPeakAssignmentLinesToAdjacentGroup(nmrResidue, crossChainAssignments,
-                                                                    self.assignmentLines, self.connectingLines)
+                # only process residues in the current visible chain
+                chainNmrResidues = [nmrResidue for nmrResidue in nmrResidueSet
+                                    if nmrResidue.nmrChain is self._module.nmrChain]
+                self._addPeakAssignmentLines(chainNmrResidues, nmrAtomIncludeList=nmrAtomIncludeList)
 
                 # self._addPeakAssignmentLinesToGroup(self.LOCALinterResidueAtomPairing, self.assignmentLines)
                 # self._addPeakAssignmentLinesToGroup(self.LOCALinterChainAtomPairing, self.assignmentLines)
                 # self._addPeakAssignmentLinesToAdjacentGroup(self._module.nmrChain, self.LOCALcrossChainAtomPairing,
                 #                                             self.assignmentLines, self.connectingLines)
 
-            first = next(iter(nmrResidueSet or []), None)
-            thisId = first.nmrChain.pid if first else 'noChainId'
-            self.updateGuiResiduePositions(thisId, updateMainChain=True, updateConnectedChains=True)
+            if updatePositions:
+                first = next(iter(nmrResidueSet or []), None)
+                thisId = first.nmrChain.pid if first else 'noChainId'
+                self.updateGuiResiduePositions(thisId, updateMainChain=True, updateConnectedChains=True)
 
     #==========================================================================================
 
@@ -1326,18 +1890,23 @@ class NmrResidueList(object):
         atomNames = [nmrAtom.name for nmrAtom in nmrResidue.nmrAtoms]
         residueAtoms = DEFAULT_RESIDUE_ATOMS.copy()
 
+        existingAtoms = self.guiNmrAtomsFromNmrResidue.get(nmrResidue, {})
         for k, v in residueAtoms.items():
             if k in atomNames:
                 fetchedNmrAtom = nmrResidue.fetchNmrAtom(name=k)
             else:
                 fetchedNmrAtom = None
             if fetchedNmrAtom is nmrAtom:
-                guiAtoms[k] = self._createGuiNmrAtom(k, v, nmrAtom)
+                guiAtom = existingAtoms.get(k)
+                if guiAtom is not None and guiAtom.nmrAtom is None:
+                    # reuse the empty guiNmrAtom, e.g., left by _removeNmrAtomFromGuiResidues
+                    guiAtom.nmrAtom = nmrAtom
+                    self.guiNmrAtoms[nmrAtom] = guiAtom
+                else:
+                    guiAtoms[k] = self._createGuiNmrAtom(k, v, nmrAtom)
 
-        ii = self.getIndexNmrResidue(nmrResidue)
-        if ii is not None:
-            res, oldGuiAtoms = self._getNmrResiduePair(ii)
-            self._setNmrResiduePair(ii, res, oldGuiAtoms.update(guiAtoms))
+        if nmrResidue in self.guiNmrAtomsFromNmrResidue:
+            self.guiNmrAtomsFromNmrResidue[nmrResidue].update(guiAtoms)
 
         if nmrResidue in self.guiNmrResidues:
             guiResidueGroup = self.guiNmrResidues[nmrResidue]
@@ -1347,46 +1916,36 @@ class NmrResidueList(object):
                 guiResidueGroup.addToGroup(item)
                 item.guiNmrResidueGroup = guiResidueGroup
 
-    def createNmrAtoms(self, nmrAtoms):
-        """Create new peak lines associated with the created/undeleted nmrAtoms.
+    def _removeNmrAtomFromGuiResidues(self, nmrAtom):
+        """Clear the guiNmrAtom of a deleted nmrAtom, removing its lines.
+        The guiNmrAtom is left in its guiNmrResidueGroup as an empty guiNmrAtom, as for missing nmrAtoms.
         """
-        nmrAtoms = makeIterableList(nmrAtoms)
-        peaks = [peak for nmrAtom in nmrAtoms for peak in nmrAtom.assignedPeaks]
+        guiAtom = self.guiNmrAtoms.pop(nmrAtom, None)
+        if guiAtom is None:
+            return
 
-        for nmrAtom in nmrAtoms:
-            if nmrAtom not in self.guiNmrAtoms:
-                # add the new nmrAtoms
-                self._addNmrAtomToGuiResidues(nmrAtom)
-        self.rebuildPeakLines(peaks, rebuildPeakLines=True, makeListFromPeak=True)
+        for line in self.getLinesFromGuiNmrAtoms([guiAtom]):
+            self._removeLine(line)
+        self.deleteConnections([guiAtom])
+        guiAtom.nmrAtom = None
 
     def _searchPeakLines(self, nmrAtoms, includeDeleted=False):
         """Return a list of the peakLines containing one of the nmrAtoms in the list.
         """
         peakLines = []
-        for lineList in self.assignmentLines.values():
-            for line in lineList:
-                nmrAtom = line.guiAtom1.nmrAtom if line.guiAtom1 else None
-                if nmrAtom in nmrAtoms and (includeDeleted or not (nmrAtom.isDeleted or nmrAtom._flaggedForDelete)):
-                    peakLines.append(line)
-                nmrAtom = line.guiAtom2.nmrAtom if line.guiAtom2 else None
-                if nmrAtom in nmrAtoms and (includeDeleted or not (nmrAtom.isDeleted or nmrAtom._flaggedForDelete)):
-                    peakLines.append(line)
+        nmrAtoms = set(nmrAtoms)
+        for guiAtom, lines in self.linesFromGuiNmrAtom.items():
+            nmrAtom = guiAtom.nmrAtom if guiAtom else None
+            if nmrAtom in nmrAtoms and (includeDeleted or not (nmrAtom.isDeleted or nmrAtom._flaggedForDelete)):
+                peakLines.extend(line for line in lines if line._lineList is self.assignmentLines)
 
         return peakLines
 
-    def deleteNmrAtoms(self, nmrAtoms):
-        """Delete peak lines associated with the deleted nmrAtoms.
-        """
-        nmrAtoms = makeIterableList(nmrAtoms)
-        peakLines = self._searchPeakLines(nmrAtoms, includeDeleted=True)
-        peaks = [peakLine._peak for peakLine in peakLines]
-
-        self.rebuildPeakLines(peaks, rebuildPeakLines=True)
-
     #==========================================================================================
 
-    def rebuildNmrResidues(self, nmrResidues):
+    def rebuildNmrResidues(self, nmrResidues, updatePositions=True):
         """Rebuild the peaks of a specified nmrResidue.
+        Set updatePositions to False if the positions are updated by the calling function.
         """
         # now rebuild for the new peak values
         # assumes that the peakAssignments have changed - possibly use different notifier
@@ -1396,19 +1955,12 @@ class NmrResidueList(object):
         guiNmrAtomSet = set([self.guiNmrAtoms[nmrAtom] for nmrAtom in nmrAtomIncludeList
                              if nmrAtom in self.guiNmrAtoms])
 
-        for guiAtom in guiNmrAtomSet:
-            for peakLineList in self.assignmentLines.values():
-                peakLines = [peakLine for peakLine in peakLineList
-                             if peakLine.guiAtom1 is guiAtom or peakLine.guiAtom2 is guiAtom]
+        # remove all graphic lines
+        for peakLine in self.getLinesFromGuiNmrAtoms(guiNmrAtomSet, self.assignmentLines):
+            self._removeLine(peakLine)
 
-                # remove all graphic lines
-                for peakLine in peakLines:
-                    peakLineList.remove(peakLine)
-                    if peakLine in self._scene.items():
-                        self._scene.removeItem(peakLine)
-
-            # clear connectivity list of guiNmrAtoms
-            guiAtom.clearConnectedList()
+        # clear connectivity of guiNmrAtoms
+        self.clearConnections(guiNmrAtomSet)
 
         if self._SGwidget.checkBoxes['peakAssignments']['checkBox'].isChecked():
 
@@ -1417,38 +1969,23 @@ class NmrResidueList(object):
             # self.LOCALinterChainAtomPairing = OrderedDict((spec, set()) for spec in self._module.magnetisationTransfers.keys())
             # self.LOCALcrossChainAtomPairing = OrderedDict((spec, set()) for spec in self._module.magnetisationTransfers.keys())
 
+            # only process residues in the current visible chain, and the following nmrResidues
+            rebuildNmrResidues = OrderedSet()
             for nmrResidue in nmrResidues:
-
-                # only process residues in the current visible chain
                 if nmrResidue is nmrResidue.mainNmrResidue and nmrResidue.nmrChain is self._module.nmrChain:
-                    # add the internally connected Lines
-                    internalAssignments, interChainAssignments, crossChainAssignments = self._getPeakAssignmentsForResidue(nmrResidue,
-                                                                                                                           nmrAtomIncludeList=nmrAtomIncludeList)
-
-                    self._addPeakAssignmentLinesToGroup(internalAssignments, self.assignmentLines)
-                    self._addPeakAssignmentLinesToGroup(interChainAssignments, self.assignmentLines)
-                    self._addPeakAssignmentLinesToAdjacentGroup(nmrResidue, crossChainAssignments,
-                                                                self.assignmentLines, self.connectingLines)
-
+                    rebuildNmrResidues.add(nmrResidue)
                 if nmrResidue.nextNmrResidue and nmrResidue.nextNmrResidue.mainNmrResidue:
-                    nextNmrResidue = nmrResidue.nextNmrResidue.mainNmrResidue
-
-                    # only process residues in the current visible chain
-                    # add the internally connected Lines
-                    internalAssignments, interChainAssignments, crossChainAssignments = self._getPeakAssignmentsForResidue(nextNmrResidue,
-                                                                                                                           nmrAtomIncludeList=nmrAtomIncludeList)
+                    rebuildNmrResidues.add(nmrResidue.nextNmrResidue.mainNmrResidue)
 
-                    self._addPeakAssignmentLinesToGroup(internalAssignments, self.assignmentLines)
-                    self._addPeakAssignmentLinesToGroup(interChainAssignments, self.assignmentLines)
-                    self._addPeakAssignmentLinesToAdjacentGroup(nextNmrResidue, crossChainAssignments,
-                                                                self.assignmentLines, self.connectingLines)
+            self._addPeakAssignmentLines(rebuildNmrResidues, nmrAtomIncludeList=nmrAtomIncludeList)
 
             # self._addPeakAssignmentLinesToGroup(self.LOCALinterResidueAtomPairing, self.assignmentLines)
             # self._addPeakAssignmentLinesToGroup(self.LOCALinterChainAtomPairing, self.assignmentLines)
             # self._addPeakAssignmentLinesToAdjacentGroup(self._module.nmrChain, self.LOCALcrossChainAtomPairing,
             #                                             self.assignmentLines, self.connectingLines)
 
-        self.updateGuiResiduePositions(nmrResidues[0].nmrChain.pid, updateMainChain=True, updateConnectedChains=True)
+        if updatePositions:
+            self.updateGuiResiduePositions(nmrResidues[0].nmrChain.pid, updateMainChain=True, updateConnectedChains=True)
 
     #==========================================================================================
     #==========================================================================================
@@ -1460,43 +1997,257 @@ class NmrResidueList(object):
 #==========================================================================================
 
 
-LINKTOPULLDOWNCLASS = 'linkToPulldownClass'
+class SequenceGraphView(QtWidgets.QGraphicsView):
+    """
+    GraphicsView for the sequenceGraph scene; Ctrl+wheel zooms the view.
+    """
+    zoomChanged = QtCore.pyqtSignal(float)
+
+    def wheelEvent(self, event):
+        if event.modifiers() & QtCore.Qt.ControlModifier:
+            factor = ZOOMFACTOR if event.angleDelta().y() > 0 else 1.0 / ZOOMFACTOR
+            if MINZOOM <= self.transform().m11() * factor <= MAXZOOM:
+                self.setTransformationAnchor(QtWidgets.QGraphicsView.AnchorUnderMouse)
+                self.scale(factor, factor)
+                self.zoomChanged.emit(self.transform().m11())
+            event.accept()
+        else:
+            super().wheelEvent(event)
 
 
-class SequenceGraphModule(CcpnModule):
+#==========================================================================================
+# Background layout
+#==========================================================================================
+
+class LayoutPlan(typing.NamedTuple):
+    """Immutable layout of an nmrChain calculated by a LayoutTask, applied to the scene by the main thread.
     """
-    A module for the display of stretches of sequentially linked and assigned stretches of
-    NmrResidues.
+    generation: int
+    nmrChainId: str
+    allNmrResidues: tuple  # all the nmrResidues to display, in order
+    nmrResidues: tuple  # the nmrResidues to create, only the visible region of virtualised nmrChains
+    peakAssignments: typing.Optional[tuple]  # (interResidue, interChain, crossChain) pairings of nmrResidues
+
+
+class PeakAssignmentSnapshot(typing.NamedTuple):
+    """Peak assignments read from the project in the main thread by NmrResidueList._snapshotPeakAssignments.
     """
-    className = 'SequenceGraph'
+    peaks: tuple  # (peak, nmrResidue, nmrChain, spectrum, assignments) for the first nmrResidue containing each peak
+    nmrAtoms: typing.Mapping  # nmrAtom -> (connected nmrAtom, nmrResidue, nmrChain), None if not connected or deleted
 
-    includeSettingsWidget = True
-    maxSettingsState = 2  # states are defined as: 0: invisible, 1: both visible, 2: only settings visible
-    settingsPosition = 'left'
 
-    # consistent with nmrResidueTable - move to generic class later
-    activePulldownClass = NmrChain
+def _getPeakAssignmentPairings(snapshot, magnetisationTransfers, nmrAtomIncludeList=None, task=None):
+    """Return the (interResidue, interChain, crossChain) pairings of a PeakAssignmentSnapshot,
+    see NmrResidueList._getPeakAssignmentsForNmrResidues.
+    Only uses the snapshot, so can be called from a LayoutTask; returns None if the task is cancelled.
+    """
+    specs = magnetisationTransfers.keys()
+    interResidueAtomPairing = OrderedDict((spec, set()) for spec in specs)
+    interChainAtomPairing = OrderedDict((spec, set()) for spec in specs)
+    crossChainAtomPairing = OrderedDict()
+
+    if nmrAtomIncludeList is not None:
+        nmrAtomIncludeList = set(nmrAtomIncludeList)
+
+    nmrAtoms = snapshot.nmrAtoms
+    for count, (peak, nmrResidue, nmrChain, spec, assignments) in enumerate(snapshot.peaks):
+        if task is not None:
+            if task.cancelled:
+                return None
+            task.setProgress(count, len(snapshot.peaks))
+
+        transferIndices = magnetisationTransfers.get(spec, ())
+
+        for assignment in assignments:
+            assignment = [nmrAtoms.get(nmrAtom) if nmrAtom else None for nmrAtom in assignment]
+
+            # only get the assignments a-b if a and b are defined in the spectrum magnetisationTransfers list
+            for index0, index1 in transferIndices:
+                atom0 = assignment[index0]
+                atom1 = assignment[index1]
+                if not atom0 or not atom1:
+                    continue
 
-    def __init__(self, mainWindow=None, name='Sequence Graph', nmrChain=None):
+                nmrAtom0, nmrResidue0, nmrChain0 = atom0
+                nmrAtom1, nmrResidue1, nmrChain1 = atom1
 
-        CcpnModule.__init__(self, mainWindow=mainWindow, name=name)
+                # ignore nmrAtoms that are not in the include list (if specified)
+                if nmrAtomIncludeList is not None and not (nmrAtom0 in nmrAtomIncludeList or nmrAtom1 in nmrAtomIncludeList):
+                    continue
 
-        # Derive application, project, and current from mainWindow
-        self.mainWindow = mainWindow
-        if self.mainWindow:
-            self.application = mainWindow.application
-            self.project = mainWindow.application.project
-            self.current = mainWindow.application.current
-            ###self.setMode('fragment')  # cannot be moved up!
-        else:
-            self.application = None
-            self.project = None
-            self.current = None
+                if (nmrChain0 is nmrChain) and (nmrChain1 is nmrChain):
+                    pairing = interResidueAtomPairing[spec] if nmrResidue0 is nmrResidue1 else interChainAtomPairing[spec]
+                else:
+                    # connections to a different chain
+                    if nmrResidue not in crossChainAtomPairing:
+                        crossChainAtomPairing[nmrResidue] = OrderedDict((spc, set()) for spc in specs)
+                    pairing = crossChainAtomPairing[nmrResidue][spec]
 
-        self.splitter = Splitter(self.mainWidget, horizontal=False)
-        self._sequenceModuleFrame = Frame(None, setLayout=True)
-        # self._SequenceGraphFrame = Frame(self.splitter, setLayout=True)
-        self.mainWidget.getLayout().addWidget(self.splitter, 1, 0)
+                if (nmrAtom1, nmrAtom0, peak) not in pairing:
+                    pairing.add((nmrAtom0, nmrAtom1, peak))
+
+    return interResidueAtomPairing, interChainAtomPairing, crossChainAtomPairing
+
+
+def _freezeAssignments(assignments):
+    """Return read-only copies of the pairings from _getPeakAssignmentsForNmrResidues.
+    """
+    interResidue, interChain, crossChain = assignments
+    freeze = lambda pairings: MappingProxyType(OrderedDict((spec, tuple(pairs)) for spec, pairs in pairings.items()))
+
+    return (freeze(interResidue), freeze(interChain),
+            MappingProxyType(OrderedDict((nmrResidue, freeze(pairings)) for nmrResidue, pairings in crossChain.items())))
+
+
+class _TaskSignals(QtCore.QObject):
+    """Signals emitted by a background task, received in the main thread.
+    """
+    progress = QtCore.pyqtSignal(int, int, int)  # generation, count, total
+    finished = QtCore.pyqtSignal(int, object)  # generation, result or None if failed
+
+
+class LayoutTask(QtCore.QRunnable):
+    """
+    Calculate the peak assignment pairings of the LayoutPlan of an nmrChain in a background thread.
+    The nmrResidues and the PeakAssignmentSnapshot are read from the project in the main thread by
+    SequenceGraphModule._startLayout/_readLayoutSnapshot, in batches between event-loop ticks, as the project
+    is not thread-safe; the task never touches the project.
+    The ghost nmrResidues and the line displacements are created with the gui items when the plan is applied,
+    also in the main thread.
+    """
+
+    def __init__(self, generation, nmrChainId, allNmrResidues, nmrResidues, peakSnapshot, magnetisationTransfers):
+        super().__init__()
+
+        # signals must be created in the main thread
+        self.signals = _TaskSignals()
+        self.generation = generation
+        self.cancelled = False
+        self._lastProgress = None
+
+        self._nmrChainId = nmrChainId
+        self._allNmrResidues = tuple(allNmrResidues)
+        self._nmrResidues = tuple(nmrResidues)
+        self._peakSnapshot = peakSnapshot
+        self._magnetisationTransfers = magnetisationTransfers
+
+    def cancel(self):
+        """Stop the task at the next check, the finished signal is not emitted.
+        """
+        self.cancelled = True
+
+    def setProgress(self, count, total):
+        """Report the progress of the task.
+        Only emitted when the percentage changes, each emit is a queued event in the main thread.
+        """
+        percent = (100 * count) // total if total else 0
+        if percent != self._lastProgress:
+            self._lastProgress = percent
+            self.signals.progress.emit(self.generation, count, total)
+
+    def run(self):
+        try:
+            plan = self._calculateLayoutPlan()
+        except Exception as es:
+            getLogger().warning('SequenceGraph layout failed: %s' % str(es))
+            plan = None
+
+        if not self.cancelled:
+            self.signals.finished.emit(self.generation, plan)
+
+    def _calculateLayoutPlan(self):
+        peakAssignments = None
+        if self._peakSnapshot is not None:
+            assignments = _getPeakAssignmentPairings(self._peakSnapshot, self._magnetisationTransfers, task=self)
+            if assignments is None:
+                return None
+            peakAssignments = _freezeAssignments(assignments)
+
+        return LayoutPlan(self.generation, self._nmrChainId, self._allNmrResidues, self._nmrResidues, peakAssignments)
+
+
+class PredictionTask(QtCore.QRunnable):
+    """
+    Place long stretches of nmrResidues in the sequences of chains in a background thread.
+    placements is a dict of key -> (sequenceMatrix, probabilities), keys are (nmrResidues, chain, chemicalShiftList, version)
+    tuples from SequenceGraphModule._getPredictionKey; the sequenceMatrices and the residue-type probabilities are read
+    from the project by the sequencePlacer in the main thread, so the task only works on the arrays.
+    The finished signal returns a dict of key -> list of Placements; their scores are log-likelihood ratios,
+    not comparable to the getSpinSystemsLocation scores of short stretches, see _showPredictions.
+    """
+
+    def __init__(self, generation, placements):
+        super().__init__()
+
+        # signals must be created in the main thread
+        self.signals = _TaskSignals()
+        self.generation = generation
+        self.cancelled = False
+
+        self._placements = tuple(placements.items())
+
+    def cancel(self):
+        """Stop the task at the next check, the finished signal is not emitted.
+        """
+        self.cancelled = True
+
+    def run(self):
+        results = {}
+        try:
+            for key, (sequenceMatrix, probabilities) in self._placements:
+                if self.cancelled:
+                    return
+                results[key] = getPlacements(probabilities, sequenceMatrix)
+
+        except Exception as es:
+            getLogger().warning('SequenceGraph prediction failed: %s' % str(es))
+            results = None
+
+        if not self.cancelled:
+            self.signals.finished.emit(self.generation, results)
+
+
+LINKTOPULLDOWNCLASS = 'linkToPulldownClass'
+MAXCACHEDNMRCHAINS = 4
+MAXCACHEDPREDICTIONS = 64
+PLACEMENTLENGTH = 20  # stretches of at least this many nmrResidues are placed by the SequencePlacer, with placeLongStretches
+MINLOCATIONSCORE = 1  # minimum getSpinSystemsLocation score to highlight, Placements use MINLOGLIKELIHOODRATIO
+
+
+class SequenceGraphModule(CcpnModule):
+    """
+    A module for the display of stretches of sequentially linked and assigned stretches of
+    NmrResidues.
+    """
+    className = 'SequenceGraph'
+
+    includeSettingsWidget = True
+    maxSettingsState = 2  # states are defined as: 0: invisible, 1: both visible, 2: only settings visible
+    settingsPosition = 'left'
+
+    # consistent with nmrResidueTable - move to generic class later
+    activePulldownClass = NmrChain
+
+    def __init__(self, mainWindow=None, name='Sequence Graph', nmrChain=None):
+
+        CcpnModule.__init__(self, mainWindow=mainWindow, name=name)
+
+        # Derive application, project, and current from mainWindow
+        self.mainWindow = mainWindow
+        if self.mainWindow:
+            self.application = mainWindow.application
+            self.project = mainWindow.application.project
+            self.current = mainWindow.application.current
+            ###self.setMode('fragment')  # cannot be moved up!
+        else:
+            self.application = None
+            self.project = None
+            self.current = None
+
+        self.splitter = Splitter(self.mainWidget, horizontal=False)
+        self._sequenceModuleFrame = Frame(None, setLayout=True)
+        # self._SequenceGraphFrame = Frame(self.splitter, setLayout=True)
+        self.mainWidget.getLayout().addWidget(self.splitter, 1, 0)
 
         self.thisSequenceModule = SequenceModule(moduleParent=self,
                                                  parent=self._sequenceModuleFrame,
@@ -1560,6 +2311,14 @@ class SequenceGraphModule(CcpnModule):
                                                         'checked' : True,
                                                         '_init'   : None,
                                                         }),
+                                    ('placeLongStretches', {'label'   : 'Place long stretches:',
+                                                            'tipText' : 'Place stretches of at least %i nmrResidues in the sequence by residue-type likelihood,\n'
+                                                                        'in the background; otherwise all stretches use the slower location scoring.' % PLACEMENTLENGTH,
+                                                            'callBack': self._togglePlacements,
+                                                            'enabled' : True,
+                                                            'checked' : True,
+                                                            '_init'   : None,
+                                                            }),
                                     ))
         if self.activePulldownClass:
             settingsDict.update(OrderedDict(((LINKTOPULLDOWNCLASS, {'label'   : 'Link to current %s:' % self.activePulldownClass.className,
@@ -1582,6 +2341,9 @@ class SequenceGraphModule(CcpnModule):
                                              self.scene, self)
         self._deleteStore = {}
 
+        # scenes of previously displayed nmrChains, referenced by nmrChain pid
+        self._nmrChainScenes = OrderedDict()
+
         colwidth = 180
         self._MWwidget = Widget(self.mainWidget, setLayout=True,
                                 grid=(0, 0), vAlign='top', hAlign='left')
@@ -1617,6 +2379,23 @@ class SequenceGraphModule(CcpnModule):
                                                           callback=self.showNmrChainFromPulldown,
                                                           grid=(0, 3), gridSpan=(1, 1))
 
+        # progress of the background layout of large nmrChains
+        self._layoutProgress = QtWidgets.QProgressBar()
+        self._layoutProgress.setMaximumWidth(colwidth)
+        self._layoutProgress.hide()
+        self._MWwidget.getLayout().addWidget(self._layoutProgress, 0, 4)
+        self._layoutGeneration = 0
+        self._layoutTask = None
+        self._layoutPending = False
+
+        # sequence position predictions, referenced by (nmrResidues, chain, chemicalShiftList, version)
+        self._predictions = OrderedDict()
+        self._shiftVersions = {}  # referenced by chemicalShiftList or (chemicalShiftList, mainNmrResidue)
+        self._predictionGeneration = 0
+        self._predictionTask = None
+        self._predictionNmrResidues = ()
+        self._sequencePlacer = SequencePlacer()
+
         self._MWwidget.setMinimumWidth(self._MWwidget.sizeHint().width())
         self._MWwidget.setSizePolicy(QtWidgets.QSizePolicy.Minimum, QtWidgets.QSizePolicy.Minimum)
         self.settingsWidget.setSizePolicy(QtWidgets.QSizePolicy.Ignored, QtWidgets.QSizePolicy.Minimum)
@@ -1639,6 +2418,8 @@ class SequenceGraphModule(CcpnModule):
         self.scene.mouseReleaseEvent = self._sceneMouseRelease
 
         # calulate the connections between axes based on experiment types
+        self.magnetisationTransfers = OrderedDict()
+        self._experimentTypes = {}
         self._updateMagnetisationTransfers()
 
         # stop the mainWidget from squishing during a resize
@@ -1647,6 +2428,13 @@ class SequenceGraphModule(CcpnModule):
         # install the event filter to handle maximising from floated dock
         # self.installMaximiseEventHandler(self._maximise, self._closeModule)
 
+        # gather the notifier updates and process them together on the next event-loop tick
+        self._clearPendingUpdates()
+        self._updateTimer = QtCore.QTimer(self)
+        self._updateTimer.setSingleShot(True)
+        self._updateTimer.setInterval(PENDINGUPDATEDELAY)
+        self._updateTimer.timeout.connect(self._processPendingUpdates)
+
         # initialise notifiers
         self._registerNotifiers()
 
@@ -1676,13 +2464,22 @@ class SequenceGraphModule(CcpnModule):
 
     def _updateMagnetisationTransfers(self):
         """Generate the list that defines which couplings there are between the nmrAtoms attached to each peak.
+        Each spectrum is compiled to a tuple of (index0, index1) pairs into the peak assignments,
+        spectra are only recompiled if the experimentType has changed.
         """
+        previousTransfers = self.magnetisationTransfers
         self.magnetisationTransfers = OrderedDict()
         for spec in self.project.spectra:
             if not spec._flaggedForDelete:
-                self.magnetisationTransfers[spec] = {}
-                for mt in spec.magnetisationTransfers:
-                    self.magnetisationTransfers[spec][mt] = set()
+                if spec in previousTransfers and self._experimentTypes.get(spec) == spec.experimentType:
+                    self.magnetisationTransfers[spec] = previousTransfers[spec]
+                else:
+                    self.magnetisationTransfers[spec] = tuple((mt[0] - 1, mt[1] - 1) for mt in spec.magnetisationTransfers)
+                    self._experimentTypes[spec] = spec.experimentType
+
+        # remove the deleted spectra
+        for spec in set(self._experimentTypes) - set(self.magnetisationTransfers):
+            del self._experimentTypes[spec]
 
     def _blockEvents(self):
         """Block all updates/signals/notifiers in the scene.
@@ -1708,20 +2505,39 @@ class SequenceGraphModule(CcpnModule):
             yield
 
         finally:
+            # new items are created with full detail
+            if not self.nmrResidueList.detailed:
+                self.nmrResidueList.updateLevelOfDetail()
+
             self._unblockEvents()
 
             # resize to the new items and spawns a repaint
-            self.scene.setSceneRect(self.scene.itemsBoundingRect().adjusted(-20, -20, 20, 20))
+            rect = self.scene.itemsBoundingRect().united(self.nmrResidueList.layoutRect())
+            self.scene.setSceneRect(rect.adjusted(-20, -20, 20, 20))
+
+    def _updateLevelOfDetail(self, scale=None):
+        """Switch the level of detail of the scene when the zoom crosses LEVELOFDETAILSCALE.
+        """
+        scale = self.scrollContents.transform().m11() if scale is None else scale
+        detailed = scale >= LEVELOFDETAILSCALE
+        if detailed != self.nmrResidueList.detailed:
+            self.nmrResidueList.setLevelOfDetail(detailed)
 
     def _updateSpectra(self, data=None):
         """Update list of current spectra and generate new magnetisationTransfer list
         """
         if data:
             trigger = data[Notifier.TRIGGER]
+            spectrum = data[Notifier.OBJECT]
 
+            # only a change of experimentType affects the magnetisationTransfers
+            if trigger == Notifier.CHANGE and self._experimentTypes.get(spectrum) == spectrum.experimentType:
+                return
+
+            self._clearNmrChainScenes()
             self._updateMagnetisationTransfers()
 
-            if trigger in [Notifier.CREATE, Notifier.DELETE]:
+            if trigger in [Notifier.CREATE, Notifier.DELETE, Notifier.CHANGE]:
                 nmrChainPid = self.nmrChainPulldown.getText()
                 if nmrChainPid:
                     with self.sceneBlocking():
@@ -1777,12 +2593,19 @@ class SequenceGraphModule(CcpnModule):
                                                  self._updateNmrAtoms,
                                                  onceOnly=True)
 
-        # notifier to change the magnetisationTransfer list when new spectrum added
+        # notifier to change the magnetisationTransfer list when new spectrum added, or experimentType changed
         self._spectrumListNotifier = self.setNotifier(self.project,
-                                                      [Notifier.CREATE, Notifier.DELETE],
+                                                      [Notifier.CREATE, Notifier.DELETE, Notifier.CHANGE],
                                                       Spectrum.className,
                                                       self._updateSpectra)
 
+        # predictions in the cached nmrChain scenes depend on the chemicalShifts
+        self._chemicalShiftNotifier = self.setNotifier(self.project,
+                                                       [Notifier.CHANGE, Notifier.CREATE, Notifier.DELETE],
+                                                       ChemicalShift.className,
+                                                       self._updateChemicalShifts,
+                                                       onceOnly=True)
+
         self._currentNmrResidueNotifier = self.setNotifier(self.current,
                                                            [Notifier.CURRENT],
                                                            targetName=NmrResidue._pluralLinkName,
@@ -1850,70 +2673,6 @@ class SequenceGraphModule(CcpnModule):
     #         nmr = nmr.mainNmrResidue
     #         residueSet.add(nmr)
 
-    def _rebuildNmrResidues(self, nmrChainId, nmrResidues):
-        """Rebuild the peaks of a specified nmrResidue.
-        """
-        # now rebuild for the new peak values
-        # assumes that the peakAssignments have changed - possibly use different notifier
-        nmrResidues = makeIterableList(nmrResidues)
-
-        nmrAtomIncludeList = tuple(nmrAtom for nmrResidue in nmrResidues for nmrAtom in nmrResidue.nmrAtoms)
-        guiNmrAtomSet = set([self.nmrResidueList.guiNmrAtoms[nmrAtom] for nmrAtom in nmrAtomIncludeList])
-
-        for guiAtom in guiNmrAtomSet:
-            for peakLineList in self.nmrResidueList.assignmentLines.values():
-                peakLines = [peakLine for peakLine in peakLineList
-                             if peakLine.guiAtom1 is guiAtom or peakLine.guiAtom2 is guiAtom]
-
-                # remove all graphic lines
-                for peakLine in peakLines:
-                    peakLineList.remove(peakLine)
-                    if peakLine in self.scene.items():
-                        self.scene.removeItem(peakLine)
-
-            # clear connectivity list of guiNmrAtoms
-            guiAtom.clearConnectedList()
-
-        if self._SGwidget.checkBoxes['peakAssignments']['checkBox'].isChecked():
-
-            # # create a set of sets ordered by spectra for active lines
-            # self.LOCALinterResidueAtomPairing = OrderedDict((spec, set()) for spec in self._module.magnetisationTransfers.keys())
-            # self.LOCALinterChainAtomPairing = OrderedDict((spec, set()) for spec in self._module.magnetisationTransfers.keys())
-            # self.LOCALcrossChainAtomPairing = OrderedDict((spec, set()) for spec in self._module.magnetisationTransfers.keys())
-
-            for nmrResidue in nmrResidues:
-
-                # only process residues in the current visible chain
-                if nmrResidue is nmrResidue.mainNmrResidue and nmrResidue.nmrChain is self.nmrChain:
-                    # add the internally connected Lines
-                    internalAssignments, interChainAssignments, crossChainAssignments = self.nmrResidueList._getPeakAssignmentsForResidue(nmrResidue,
-                                                                                                                                          nmrAtomIncludeList=nmrAtomIncludeList)
-
-                    self.nmrResidueList._addPeakAssignmentLinesToGroup(internalAssignments, self.nmrResidueList.assignmentLines)
-                    self.nmrResidueList._addPeakAssignmentLinesToGroup(interChainAssignments, self.nmrResidueList.assignmentLines)
-                    self.nmrResidueList._addPeakAssignmentLinesToAdjacentGroup(nmrResidue, crossChainAssignments,
-                                                                               self.nmrResidueList.assignmentLines, self.nmrResidueList.connectingLines)
-
-                if nmrResidue.nextNmrResidue and nmrResidue.nextNmrResidue.mainNmrResidue:
-                    nextNmrResidue = nmrResidue.nextNmrResidue.mainNmrResidue
-
-                    # only process residues in the current visible chain
-                    # add the internally connected Lines
-                    internalAssignments, interChainAssignments, crossChainAssignments = self.nmrResidueList._getPeakAssignmentsForResidue(nextNmrResidue,
-                                                                                                                                          nmrAtomIncludeList=nmrAtomIncludeList)
-
-                    self.nmrResidueList._addPeakAssignmentLinesToGroup(internalAssignments, self.nmrResidueList.assignmentLines)
-                    self.nmrResidueList._addPeakAssignmentLinesToGroup(interChainAssignments, self.nmrResidueList.assignmentLines)
-                    self.nmrResidueList._addPeakAssignmentLinesToAdjacentGroup(nextNmrResidue, crossChainAssignments,
-                                                                               self.nmrResidueList.assignmentLines, self.nmrResidueList.connectingLines)
-
-            # self._addPeakAssignmentLinesToGroup(self.LOCALinterResidueAtomPairing, self.assignmentLines)
-            # self._addPeakAssignmentLinesToGroup(self.LOCALinterChainAtomPairing, self.assignmentLines)
-            # self._addPeakAssignmentLinesToAdjacentGroup(self._module.nmrChain, self.LOCALcrossChainAtomPairing,
-            #                                             self.assignmentLines, self.connectingLines)
-
-        self.nmrResidueList.updateGuiResiduePositions(nmrChainId, updateMainChain=True, updateConnectedChains=True)
-
     # def _rebuildPeakLines(self, peaks, rebuildPeakLines=False, makeListFromPeak=False):
     #     """Clear all lines on the display associated with peak.
     #     """
@@ -1991,21 +2750,137 @@ class SequenceGraphModule(CcpnModule):
     def _updatePeaks(self, data):
         """Update the peaks in the display.
         """
+        self._clearNmrChainScenes()
         peak = data[Notifier.OBJECT]
         trigger = data[Notifier.TRIGGER]
 
+        if trigger == Notifier.DELETE:
+            # rebuild from the existing lines
+            self._pendingPeaks.discard(peak)
+            self._pendingDeletedPeaks.add(peak)
+
+        elif trigger in [Notifier.CREATE, Notifier.CHANGE]:
+            # rebuild from the new assignments
+            self._pendingDeletedPeaks.discard(peak)
+            self._pendingPeaks.add(peak)
+
+        self._updateTimer.start()
+
+    def _clearPendingUpdates(self):
+        """Clear the peaks/nmrResidues/nmrAtoms waiting to be updated in the display.
+        """
+        self._pendingPeaks = OrderedSet()
+        self._pendingDeletedPeaks = OrderedSet()
+        self._pendingNmrResidues = OrderedSet()
+        self._pendingChangedNmrResidues = OrderedSet()
+        self._pendingNmrAtoms = OrderedSet()
+
+    def _processPendingUpdates(self):
+        """Update the display for all the peaks/nmrResidues/nmrAtoms changed since the last update.
+        The guiNmrAtoms of the created/deleted nmrAtoms in the displayed nmrResidues are updated first.
+        The created/deleted/changed nmrResidues are inserted/removed/recreated in the displayed nmrChain together,
+        see _updateDisplayedNmrResidues; if that is not possible the nmrChain is refreshed, which includes all the
+        peak lines. All the changed peak lines are then rebuilt together, followed by a single position update.
+        """
+        peaks, deletedPeaks = self._pendingPeaks, self._pendingDeletedPeaks
+        nmrResidues, changedNmrResidues = self._pendingNmrResidues, self._pendingChangedNmrResidues
+        nmrAtoms = self._pendingNmrAtoms
+        self._clearPendingUpdates()
+
+        if not self.nmrChain or self.nmrChain.isDeleted:
+            return
+
+        if self._layoutPending:
+            # the layout is out-of-date, calculate again
+            self._startLayout(self.nmrChain)
+            return
+
+        nmrResidueList = self.nmrResidueList
+        nmrChainId = self.nmrChain.pid
+        if nmrChainId not in nmrResidueList.nmrChains:
+            return
+
         with self.sceneBlocking():
-            if trigger == Notifier.DELETE:
-                # print('>>>_updatePeaks delete', peak)
-                self.nmrResidueList.rebuildPeakLines(peak, rebuildPeakLines=True)
+            # update the guiNmrAtoms of the displayed nmrResidues first, a refresh keeps the existing guiNmrResidueGroups
+            for nmrAtom in nmrAtoms:
+                if nmrAtom.isDeleted or nmrAtom._flaggedForDelete:
+                    # the lines of the deleted nmrAtoms must be found before the guiNmrAtoms are cleared
+                    deletedPeaks |= [peakLine._peak for peakLine in nmrResidueList._searchPeakLines([nmrAtom], includeDeleted=True)]
+                    nmrResidueList._removeNmrAtomFromGuiResidues(nmrAtom)
+                else:
+                    if nmrAtom not in nmrResidueList.guiNmrAtoms and nmrAtom.nmrResidue in nmrResidueList.guiNmrResidues:
+                        nmrResidueList._addNmrAtomToGuiResidues(nmrAtom)
+                    peaks |= nmrAtom.assignedPeaks
+
+            nmrResidues = [nmrResidue for nmrResidue in nmrResidues
+                           if nmrResidue in nmrResidueList.guiNmrResidues or nmrResidue in nmrResidueList.guiGhostNmrResidues or
+                           (not nmrResidue.isDeleted and nmrResidue.nmrChain is self.nmrChain)]
+            if nmrResidues:
+                try:
+                    if nmrResidueList.isVirtual(nmrChainId) or \
+                            not self._updateDisplayedNmrResidues(nmrChainId, nmrResidues, changedNmrResidues):
+                        # changed nmrResidues are recreated, e.g., after a change of residueType
+                        for nmrResidue in changedNmrResidues:
+                            if nmrResidue in nmrResidueList.guiNmrResidues:
+                                nmrResidueList._removeGuiNmrResidue(nmrResidue)
+
+                        # the refresh rebuilds all the peak lines
+                        self._refreshNmrChain(nmrChainId)
+                        return
+
+                except Exception as es:
+                    # strange error not traced yet, interesting, but not fatal if trapped
+                    getLogger().warning(str(es))
+                    return
 
-            elif trigger == Notifier.CREATE:
-                # print('>>>_updatePeaks create', peak)
-                self.nmrResidueList.rebuildPeakLines(peak, rebuildPeakLines=True, makeListFromPeak=True)
+            # peaks deleted since they were changed can only be rebuilt from the existing lines
+            deletedPeaks |= [peak for peak in peaks if peak.isDeleted]
+            peaks = [peak for peak in peaks if not peak.isDeleted]
+
+            if deletedPeaks:
+                nmrResidueList.rebuildPeakLines(list(deletedPeaks), rebuildPeakLines=True, updatePositions=False)
+            if peaks:
+                nmrResidueList.rebuildPeakLines(peaks, rebuildPeakLines=True, makeListFromPeak=True, updatePositions=False)
+            if nmrResidues or peaks or deletedPeaks:
+                nmrResidueList.updateGuiResiduePositions(nmrChainId, updateMainChain=True, updateConnectedChains=True)
+
+    def _updateDisplayedNmrResidues(self, nmrChainId, nmrResidues, changedNmrResidues):
+        """Remove/insert/recreate the deleted, created and changed nmrResidues in the displayed nmrChain in place,
+        only rebuilding the lines of those nmrResidues and their neighbours; the positions are not updated.
+        Returns False if the nmrResidues cannot be updated in place, and the nmrChain must be refreshed.
+        """
+        nmrResidueList = self.nmrResidueList
+        if any(nmrResidue in nmrResidueList.guiGhostNmrResidues for nmrResidue in nmrResidues):
+            # ghost nmrResidues are placed from the peak assignments of the whole nmrChain
+            return False
+
+        nmrList = nmrResidueList.nmrChains[nmrChainId]
+        removed = [nmrResidue for nmrResidue in nmrResidues
+                   if nmrResidue in nmrList and (nmrResidue.isDeleted or nmrResidue._flaggedForDelete or
+                                                 nmrResidue.nmrChain is not self.nmrChain or
+                                                 nmrResidue is not nmrResidue.mainNmrResidue)]
+        added = [nmrResidue for nmrResidue in nmrResidues
+                 if nmrResidue not in nmrList and not (nmrResidue.isDeleted or nmrResidue._flaggedForDelete) and
+                 nmrResidue.nmrChain is self.nmrChain and nmrResidue is nmrResidue.mainNmrResidue]
+
+        neighbours = self._removeNmrResidues(nmrChainId, removed)
+        if not self._buildNmrResidues(nmrChainId, added):
+            return False
+
+        # changed nmrResidues are recreated in place, e.g., after a change of residueType
+        recreated = [nmrResidue for nmrResidue in changedNmrResidues if nmrResidue in nmrList and nmrResidue not in added]
+        for nmrResidue in recreated:
+            nmrResidueList._removeGuiNmrResidue(nmrResidue)
+            nmrResidueList.addNmrResidue(nmrChainId, nmrResidue, nmrList.index(nmrResidue), _insertNmrRes=False)
+
+        rebuild = [nmrResidue for nmrResidue in OrderedSet(neighbours + added + recreated) if nmrResidue in nmrList]
+        if rebuild:
+            nmrResidueList.addConnectionsAroundNmrResidues(nmrChainId, rebuild)
+            nmrResidueList.rebuildNmrResidues(rebuild, updatePositions=False)
 
-            elif trigger == Notifier.CHANGE:
-                # print('>>>_updatePeaks change', peak)
-                self.nmrResidueList.rebuildPeakLines(peak, rebuildPeakLines=True, makeListFromPeak=True)
+        # update the prediction in the sequenceModule
+        self.predictSequencePosition(list(nmrList))
+        return True
 
     # def _updateNmrChains(self, data):
     #     """Update the nmrChains in the display.
@@ -2041,26 +2916,20 @@ class SequenceGraphModule(CcpnModule):
     def _updateNmrResidues(self, data):
         """Update the nmrResidues in the display.
         """
+        self._clearNmrChainScenes()
         nmrResidue = data[Notifier.OBJECT]
 
         # print('>>>_updateNmrResidues', nmrResidue)
         trigger = data[Notifier.TRIGGER]
 
-        with self.sceneBlocking():
-            if trigger == Notifier.DELETE:
-                # print('>>>delete nmrResidue', nmrResidue)
-                self._deleteNmrResidues(nmrResidue)
-
-            elif trigger == Notifier.CREATE:
-                # print('>>>create nmrResidue', nmrResidue)
-                if not self._createNmrResidues(nmrResidue):
-                    # print('>>>error? redraw list')
-                    # self.setNmrChainDisplay(self.nmrChain)
-                    pass
+        if trigger in [Notifier.CREATE, Notifier.DELETE]:
+            # created/deleted nmrResidues are added/removed with the next update
+            self._pendingNmrResidues.add(nmrResidue)
+            self._updateTimer.start()
 
-            elif trigger == Notifier.RENAME:
-                oldPid = data[Notifier.OLDPID]
-                self._renameNmrResidue(nmrResidue, oldPid)
+        elif trigger == Notifier.RENAME:
+            oldPid = data[Notifier.OLDPID]
+            self._renameNmrResidue(nmrResidue, oldPid)
 
             # elif trigger == Notifier.CHANGE:
             #     print('>>>change nmrResidue - no action', nmrResidue)
@@ -2071,57 +2940,30 @@ class SequenceGraphModule(CcpnModule):
     def _changeNmrResidues(self, data):
         """Update the nmrResidues in the display.
         """
+        self._clearNmrChainScenes()
         nmrResidue = data[Notifier.OBJECT]
 
         # print('>>>_changeNmrResidues', nmrResidue)
-        trigger = data[Notifier.TRIGGER]
-
-        try:
-            with self.sceneBlocking():
-                if nmrResidue in self.nmrChain.nmrResidues and nmrResidue not in self.nmrResidueList.guiNmrResidues:
-                    # print('>>>change nmrResidue - create', nmrResidue)
-                    if not self._createNmrResidues(nmrResidue):
-                        # print('>>>error? redraw list')
-                        # self.setNmrChainDisplay(self.nmrChain)
-                        pass
-
-                elif nmrResidue in self.nmrResidueList.guiNmrResidues and nmrResidue not in self.nmrChain.nmrResidues:
-                    # not in chain, but in residues as other chain
-                    self._deleteGuiNmrResidues(nmrResidue)
-                    # self._deleteNmrResidues(nmrResidue)
 
-                else:
-                    # print('>>>change2 nmrResidue - create **** rename', nmrResidue)
-
-                    # this is the event that fires on a name change
-                    # self._deleteBadNmrResidues(nmrResidue)
-                    self._deleteNmrResidues(nmrResidue)
-                    if not self._createNmrResidues(nmrResidue):
-                        # print('>>>error? redraw list')
-                        # self.setNmrChainDisplay(self.nmrChain)
-                        pass
-
-        except Exception as es:
-            # strange error not traced yet, interesting, but not fatal if trapped - think I've found it
-            getLogger().warning(str(es))
+        # changed nmrResidues are recreated with the next update
+        self._pendingNmrResidues.add(nmrResidue)
+        self._pendingChangedNmrResidues.add(nmrResidue)
+        self._updateTimer.start()
 
     def _updateNmrAtoms(self, data):
         """Update the nmrAtoms in the display.
         """
+        self._clearNmrChainScenes()
 
         # Done
         nmrAtom = data[Notifier.OBJECT]
         trigger = data[Notifier.TRIGGER]
 
         # only mainNmrResidues are shown on the screen
-        with self.sceneBlocking():
-            if trigger == Notifier.DELETE:
-                # print('>>>delete nmrAtom', nmrAtom)
-                self.nmrResidueList.deleteNmrAtoms(nmrAtom)
-
-            elif trigger == Notifier.CREATE:
-                # print('>>>create nmrAtom', nmrAtom)
-                self.nmrResidueList.createNmrAtoms(nmrAtom)
+        if trigger in [Notifier.CREATE, Notifier.DELETE]:
+            # created/deleted nmrAtoms are added/removed with the next update
+            self._pendingNmrAtoms.add(nmrAtom)
+            self._updateTimer.start()
 
     def _renameNmrResidue(self, nmrResidue, oldPid: str):
         """Reset pid for NmrResidue and all offset NmrResidues
@@ -2141,217 +2983,6 @@ class SequenceGraphModule(CcpnModule):
             #             if guiNmrResidueGroup.nmrResidue is nr:
             #                 guiNmrResidueGroup.nmrResidueLabel._update()
 
-    def _createNmrResidues(self, nmrResidues):
-        """Create new nmrResidues in the scene
-        """
-        # print('>>>_createNmrResidues')
-
-        # get the nmrResidue in the current selected chain
-        nmrResidues = makeIterableList(nmrResidues)
-
-        for nmrChainId in self.nmrResidueList.nmrChains.keys():
-            thisResList = [nmrResidue for nmrResidue in nmrResidues if nmrResidue.nmrChain.pid == nmrChainId]
-            if thisResList:
-                self._buildNmrResidues(nmrChainId, thisResList)
-
-        return True
-
-    def _deleteNmrResidues(self, nmrResidues):
-        """Delete the nmrResidue from the scene
-        """
-        # print('>>>_deleteNmrResidues')
-
-        # get the nmrResidue in the current selected chain
-        nmrResidues = makeIterableList(nmrResidues)
-
-        for nmrChainId in self.nmrResidueList.nmrChains.keys():
-            thisResList = [nmrResidue for nmrResidue in nmrResidues if nmrResidue.nmrChain.pid == nmrChainId]
-            if thisResList:
-                self._removeNmrResidues(nmrChainId, thisResList)
-
-        return True
-
-    def _removeNmrResidues(self, nmrChainId, nmrResidues):
-        """Delete the nmrResidue from the scene
-        """
-        # print('>>>  _removeNmrResidues')
-
-        nmrResidues = makeIterableList(nmrResidues)
-
-        for nmrResidue in nmrResidues:
-
-            # this SHOULD never fail
-            if nmrResidue not in self.nmrResidueList.nmrChains[nmrChainId]:
-                continue
-
-            ii = self.nmrResidueList.nmrChains[nmrChainId].index(nmrResidue)
-
-            # take the current nmrList, and remove the deleted nmrResidue
-            # with the mainNmrResidues - should be correct order or empty
-            delResSet = list(OrderedSet(self.nmrResidueList.nmrChains[nmrChainId]) -
-                             OrderedSet([nmrResidue]))
-            # print('>>>    delResSet', delResSet)
-            self.nmrResidueList.nmrChains[nmrChainId] = delResSet
-
-            if ii > 0:
-                # rebuild peak lines, etc, for the previous nmrResidue - may need to check for +1 offsets
-                previousNmrResidue = self.nmrResidueList.nmrChains[nmrChainId][ii - 1]
-                self._rebuildNmrResidues(nmrChainId, previousNmrResidue)
-
-            self._cleanupNmrResidue(nmrResidue)
-
-        # update the prediction in the sequenceModule
-        self.predictSequencePosition(self.nmrResidueList.nmrChains[nmrChainId])
-
-        # # ignore if not in the visible chain
-        # ii = self.nmrResidueList.getIndexNmrResidue(nmrResidue)
-        # if ii is not None:
-        #     self.nmrResidueList.deleteNmrResidueIndex(ii)
-        #
-        #     if ii:
-        #         previousNmrResidue, guiAtom = self.nmrResidueList._getNmrResiduePair(ii - 1)
-        #         self._rebuildNmrResidues(previousNmrResidue)
-
-        # ii = self.predictedStretch.index(nmrResidue)
-        # # nmrResiduesToUpdate = self.predictedStretch[max(0, ii - 1):min(ii + 1, len(self.predictedStretch))]
-        #
-        # # remove from the visible list
-        # self.predictedStretch.pop(ii)
-        # self.guiResiduesShown.pop(ii)
-        #
-        # if ii:
-        #     previousNmrResidue = self.predictedStretch[ii - 1]
-        #     self._rebuildNmrResidues(previousNmrResidue)
-
-        # if nmrResidue.previousNmrResidue:
-        #     previousNmrResidue = nmrResidue.previousNmrResidue.mainNmrResidue
-        #     self._rebuildNmrResidues(previousNmrResidue)
-
-        # guiNmrAtomSet = set([self.nmrResidueList.guiNmrAtoms[nmrAtom] for nmrAtom in nmrResidue.nmrAtoms
-        #                      if nmrAtom in self.nmrResidueList.guiNmrAtoms])
-        #
-        # for guiAtom in guiNmrAtomSet:
-        #     for guiLineList in self.nmrResidueList.assignmentLines.values():
-        #         guiLines = [guiLine for guiLine in guiLineList
-        #                     if guiLine.guiAtom1 is guiAtom or guiLine.guiAtom2 is guiAtom]
-        #
-        #         # remove all graphic lines
-        #         for guiLine in guiLines:
-        #             guiLineList.remove(guiLine)
-        #             if guiLine in self.scene.items():
-        #                 self.scene.removeItem(guiLine)
-        #
-        #     for guiLineList in self.nmrResidueList.connectingLines.values():
-        #         guiLines = [guiLine for guiLine in guiLineList
-        #                     if guiLine.guiAtom1 is guiAtom or guiLine.guiAtom2 is guiAtom]
-        #
-        #         # remove all graphic lines
-        #         for guiLine in guiLines:
-        #             guiLineList.remove(guiLine)
-        #             if guiLine in self.scene.items():
-        #                 self.scene.removeItem(guiLine)
-        #
-        #     # clear connectivity list of guiNmrAtoms
-        #     guiAtom.clearConnectedList()
-        #
-        # self.scene.removeItem(self.nmrResidueList.guiNmrResidues[nmrResidue])
-
-    def _cleanupNmrResidue(self, nmrResidue):
-        """remove guiNmrAtoms and guiNmrResidue from scene
-        Clean up dicts in nmrResidueList
-        """
-        guiNmrAtomSet = set([self.nmrResidueList.guiNmrAtoms[nmrAtom] for nmrAtom in nmrResidue.nmrAtoms
-                             if nmrAtom in self.nmrResidueList.guiNmrAtoms])
-
-        for guiAtom in guiNmrAtomSet:
-            for guiLineList in self.nmrResidueList.assignmentLines.values():
-                guiLines = [guiLine for guiLine in guiLineList
-                            if guiLine.guiAtom1 is guiAtom or guiLine.guiAtom2 is guiAtom]
-
-                # remove all graphic lines
-                for guiLine in guiLines:
-                    guiLineList.remove(guiLine)
-                    if guiLine in self.scene.items():
-                        self.scene.removeItem(guiLine)
-
-            for guiLineList in self.nmrResidueList.connectingLines.values():
-                guiLines = [guiLine for guiLine in guiLineList
-                            if guiLine.guiAtom1 is guiAtom or guiLine.guiAtom2 is guiAtom]
-
-                # remove all graphic lines
-                for guiLine in guiLines:
-                    guiLineList.remove(guiLine)
-                    if guiLine in self.scene.items():
-                        self.scene.removeItem(guiLine)
-
-            # clear connectivity list of guiNmrAtoms
-            guiAtom.clearConnectedList()
-
-        self.scene.removeItem(self.nmrResidueList.guiNmrResidues[nmrResidue])
-
-        del self.nmrResidueList.guiNmrResidues[nmrResidue]
-        for nmrAtom in nmrResidue.nmrAtoms:
-            if nmrAtom in self.nmrResidueList.guiNmrAtoms:
-                del self.nmrResidueList.guiNmrAtoms[nmrAtom]
-
-    def _deleteGuiNmrResidues(self, nmrResidues):
-        """Delete items from an old nmrResidue.
-        """
-        # print('>>>_deleteGuiNmrResidues')
-
-        nmrResidues = makeIterableList(nmrResidues)
-
-        for nmrResidue in nmrResidues:
-            self._cleanupNmrResidue(nmrResidue)
-
-        # nmrChains contain nmrResidue in the wrong place and must be removed before sequence prediction
-        for nmrChainId, nmrList in self.nmrResidueList.nmrChains.items():
-            thisResList = [nmrResidue for nmrResidue in nmrList if nmrResidue.nmrChain.pid == nmrChainId]
-            if thisResList:
-                # update the prediction in the sequenceModule
-                self.predictSequencePosition(thisResList)
-
-            # put all the guiResidueGroups in the correct positions
-            self.nmrResidueList.updateGuiResiduePositions(nmrChainId, updateMainChain=True, updateConnectedChains=True)
-
-            # guiNmrAtomSet = set([self.nmrResidueList.guiNmrAtoms[nmrAtom] for nmrAtom in nmrResidue.nmrAtoms
-            #                      if nmrAtom in self.nmrResidueList.guiNmrAtoms])
-            #
-            # for guiAtom in guiNmrAtomSet:
-            #     for guiLineList in self.nmrResidueList.assignmentLines.values():
-            #         guiLines = [guiLine for guiLine in guiLineList
-            #                     if guiLine.guiAtom1 is guiAtom or guiLine.guiAtom2 is guiAtom]
-            #
-            #         # remove all graphic lines
-            #         for guiLine in guiLines:
-            #             guiLineList.remove(guiLine)
-            #             if guiLine in self.scene.items():
-            #                 self.scene.removeItem(guiLine)
-            #
-            #     for guiLineList in self.nmrResidueList.connectingLines.values():
-            #         guiLines = [guiLine for guiLine in guiLineList
-            #                     if guiLine.guiAtom1 is guiAtom or guiLine.guiAtom2 is guiAtom]
-            #
-            #         # remove all graphic lines
-            #         for guiLine in guiLines:
-            #             guiLineList.remove(guiLine)
-            #             if guiLine in self.scene.items():
-            #                 self.scene.removeItem(guiLine)
-            #
-            #     # clear connectivity list of guiNmrAtoms
-            #     guiAtom.clearConnectedList()
-            #
-            # self.scene.removeItem(self.nmrResidueList.guiNmrResidues[nmrResidue])
-
-            # oldInd = self.nmrResidueList.getIndexNmrResidue(nmrResidue)
-            # ii = self.nmrChain.mainNmrResidues
-            # self._storeIndex(nmrResidue, oldInd)
-
-            # self.nmrResidueList.deleteNmrResidue(nmrResidue)
-            # del self.nmrResidueList.guiNmrResidues[nmrResidue]
-            # for nmrAtom in nmrResidue.nmrAtoms:
-            #     del self.nmrResidueList.guiNmrAtoms[nmrAtom]
-
     # def _storeIndex(self, nmrResidue, index):
     #     """Store the index for the undo.
     #     """
@@ -2480,109 +3111,54 @@ class SequenceGraphModule(CcpnModule):
                 except Exception as es:
                     pass
 
-    def _buildNmrResidues(self, nmrChainId, nmrResidueList):
-        """Build the new residues in the list, inserting into the predicted stretch at the correct index.
-        """
-        # print('>>>  _buildNmrResidues')
-
-        # this SHOULD be a list of only one item but use like this just to be sure
-        for nmrResidue in nmrResidueList:
-            if nmrResidue is nmrResidue.mainNmrResidue:
-
-                # take the current nmrList, and the new nmrResidue, and get intersection
-                # with the mainNmrResidues - should be correct order or empty
-                newResSet = list((OrderedSet(self.nmrResidueList.nmrChains[nmrChainId]) |
-                                  OrderedSet([nmrResidue])) & \
-                                 OrderedSet(nmrResidue.nmrChain.mainNmrResidues))  # keeps the ordering of the second set
-                # print('>>>    newResSet', newResSet)
-
-                # if not showing all nmrResidues then get the connected stretch from the current nmrResidue
-                if not self.nmrResiduesCheckBox.isChecked():
-                    # get the connected stretch of mainNmrResidues
-                    if self.current.nmrResidue:
-                        mainNmrRes = self.current.nmrResidue.mainNmrResidue
-                        if mainNmrRes in newResSet:
-                            indL = indR = newResSet.index(mainNmrRes)
-                            while newResSet[indL].previousNmrResidue and indL > 0:
-                                indL -= 1
-                            while newResSet[indR].nextNmrResidue and indR < len(newResSet):
-                                indR += 1
-                            newResSet = newResSet[indL:indR + 1]
-
-                if not newResSet:
-                    return
-
-                # update to the new list
-                self.nmrResidueList.nmrChains[nmrChainId] = newResSet
-
-                # iterate through and and add new residues that don't already exists
-                for ii, nmrRes in enumerate(newResSet):
-                    # do not _insertNmrRes as the list is built
-                    self.nmrResidueList.addNmrResidue(nmrChainId, nmrRes, ii, _insertNmrRes=False)
-
-        # add the connecting lines
-        # guiNmrResidues = [self.guiNmrResidues[nmrResidue] for nmrResidue in nmrResidueList if nmrResidue is nmrResidue.mainNmrResidue]
+    def _removeNmrResidues(self, nmrChainId, nmrResidues):
+        """Remove the nmrResidues and their gui items from the displayed nmrChain.
+        Returns the displayed nmrResidues that were either side of them, whose lines must be rebuilt.
+        """
+        nmrList = self.nmrResidueList.nmrChains[nmrChainId]
+        neighbours = OrderedSet()
+        for nmrResidue in nmrResidues:
+            if nmrResidue not in nmrList:
+                continue
 
-        # add the connecting lines
-        # self.nmrResidueList.addConnectionsBetweenGroups()
+            ii = nmrList.index(nmrResidue)
+            for jj in (ii - 1, ii + 1):
+                if 0 <= jj < len(nmrList):
+                    neighbours.add(nmrList[jj])
+            nmrList.remove(nmrResidue)
+            self.nmrResidueList._removeGuiNmrResidue(nmrResidue)
 
-        # for ii, res in enumerate(guiNmrResidues):
-        #     if not self.nmrResiduesCheckBox.isChecked() or ii in connectingLinesNeeded:
-        #         self._addConnectingLineToGroup(tuple(self.guiNmrResidues.values())[ii],
-        #                                        res['C'], self.guiResiduesShown[ii + 1]['N'],
-        #                                        self._lineColour, 1.0, lineList=self.connectingLines, lineId=res)
+        return [nmrResidue for nmrResidue in neighbours if nmrResidue in nmrList]
 
-        # # add connecting lines
-        # newList = OrderedSet()
-        # connectsNeeded = self._module.nmrResiduesCheckBox.isChecked()
-        #
-        # for nmr in nmrResidueList:
-        #     newList.add(nmr)
-        #     if nmr.nextNmrResidue and nmr.nextNmrResidue.mainNmrResidue:
-        #         newList.add(nmr.nextNmrResidue.mainNmrResidue)
-        #
-        #         nextNmr = nmr.nextNmrResidue.mainNmrResidue
-        #
-        #         indThis = self.nmrResidueList.getIndexNmrResidue(nmr)
-        #         indNext = self.nmrResidueList.getIndexNmrResidue(nextNmr)
-        #
-        #         if indThis is not None and indNext is not None:
-        #             # add connecting line
-        #
-        #             prev = self.nmrResidueList._getNmrResiduePair(indThis)
-        #             this = self.nmrResidueList._getNmrResiduePair(indNext)
-        #
-        #             # add the connection the minus residue and point to the right - may need to change for +1 residues
-        #             prevRes, prevGuiAtoms = prev
-        #             thisRes, thisGuiAtoms = this
-        #
-        #             if (prevRes.nextNmrResidue and prevRes.nextNmrResidue is thisRes) and connectsNeeded:
-        #                 # connect from this 'N' to the previous 'C'
-        #                 self._addConnectingLineToGroup(self.guiNmrResidues[prevRes],
-        #                                                prevGuiAtoms['C'], thisGuiAtoms['N'],
-        #                                                self._lineColour, 1.0, lineList=self.connectingLines,
-        #                                                lineId=thisRes)
+    def _buildNmrResidues(self, nmrChainId, nmrResidues):
+        """Insert the new nmrResidues into the displayed nmrChain, next to a connected nmrResidue that is already displayed.
+        Returns False if an nmrResidue has no displayed neighbour, and the nmrChain must be refreshed.
+        """
+        nmrList = self.nmrResidueList.nmrChains[nmrChainId]
+        pending = [nmrResidue for nmrResidue in nmrResidues if nmrResidue not in nmrList]
+
+        # nmrResidues may be connected to each other, so repeat until no more can be inserted
+        while pending:
+            remaining = []
+            for nmrResidue in pending:
+                previousNmrResidue = nmrResidue.previousNmrResidue.mainNmrResidue if nmrResidue.previousNmrResidue else None
+                nextNmrResidue = nmrResidue.nextNmrResidue.mainNmrResidue if nmrResidue.nextNmrResidue else None
+                if previousNmrResidue is not None and previousNmrResidue in nmrList:
+                    index = nmrList.index(previousNmrResidue) + 1
+                elif nextNmrResidue is not None and nextNmrResidue in nmrList:
+                    index = nmrList.index(nextNmrResidue)
+                else:
+                    remaining.append(nmrResidue)
+                    continue
 
-        self.nmrResidueList.rebuildNmrResidues(nmrResidueList)
+                self.nmrResidueList.addNmrResidue(nmrChainId, nmrResidue, index)
 
-        # update the prediction in the sequenceModule
-        self.predictSequencePosition(self.nmrResidueList.nmrChains[nmrChainId])
+            if len(remaining) == len(pending):
+                return False
+            pending = remaining
 
         return True
 
-        # # add the peakAssignments
-        # if self._SGwidget.checkBoxes['peakAssignments']['checkBox'].isChecked():
-        #     for nmrResidue in nmrResidueList:
-        #         if nmrResidue is nmrResidue.mainNmrResidue:
-        #             # add the internally connected Lines
-        #             internalAssignments, interChainAssignments, crossChainAssignments = self._getPeakAssignmentsForResidue(nmrResidue)
-        #             self._addPeakAssignmentLinesToGroup(internalAssignments, self.assignmentLines)
-        #             self._addPeakAssignmentLinesToGroup(interChainAssignments, self.assignmentLines)
-        #             self._addPeakAssignmentLinesToAdjacentGroup(nmrResidue, crossChainAssignments,
-        #                                                         self.assignmentLines, self.connectingLines)
-        #
-        # self._updateGuiResiduePositions(updateMainChain=True, updateConnectedChains=True)
-
     def removeNmrChainNotifiers(self):
         """Remove notifiers that are set on nmrChains.
         """
@@ -2602,6 +3178,8 @@ class SequenceGraphModule(CcpnModule):
     def resetScene(self):
         """Reset all gui items and data in the scene.
         """
+        # keep the ghost nmrResidues for reuse, clearing the scene deletes the items
+        self.nmrResidueList._removeGhostResidues()
         self.nmrResidueList.reset()
         self.scene.clear()
         self.scene.setSceneRect(self.scene.itemsBoundingRect())
@@ -2610,6 +3188,35 @@ class SequenceGraphModule(CcpnModule):
     def setNmrChain(self, nmrChain):
         self.nmrResidueList.nmrChain = nmrChain
 
+    def _cacheNmrChainScene(self):
+        """Remove the items of the displayed nmrChain from the scene and store for a quick redisplay.
+        """
+        nmrChain = self.nmrResidueList.nmrChain
+        if nmrChain and not (nmrChain.isDeleted or nmrChain._flaggedForDelete):
+            peakAssignments = self._SGwidget.checkBoxes['peakAssignments']['checkBox'].isChecked()
+            self._nmrChainScenes.pop(nmrChain.pid, None)
+            self._nmrChainScenes[nmrChain.pid] = (peakAssignments, self.nmrResidueList.saveState())
+
+            # only keep the most recent nmrChains
+            while len(self._nmrChainScenes) > MAXCACHEDNMRCHAINS:
+                self._nmrChainScenes.popitem(last=False)
+
+    def _restoreNmrChainScene(self, nmrChain):
+        """Restore the items of a previously displayed nmrChain to the scene.
+        Return True if the scene has been restored with the same settings.
+        """
+        if nmrChain.pid not in self._nmrChainScenes:
+            return False
+
+        peakAssignments, state = self._nmrChainScenes.pop(nmrChain.pid)
+        self.nmrResidueList.restoreState(state)
+        return peakAssignments == self._SGwidget.checkBoxes['peakAssignments']['checkBox'].isChecked()
+
+    def _clearNmrChainScenes(self, data=None):
+        """Clear the scenes of the nmrChains that are not displayed, these do not respond to notifiers.
+        """
+        self._nmrChainScenes.clear()
+
     def setNmrChainDisplay(self, nmrChainOrPid):
 
         # print('>>>setNmrChainDisplay')
@@ -2631,49 +3238,233 @@ class SequenceGraphModule(CcpnModule):
         self.nmrChain = nmrChain
         thisChainId = nmrChain.pid
 
+        # any layout still being calculated is out-of-date
+        self._cancelLayout()
+
         with notificationEchoBlocking():
 
             # currently only handles one visible nmrChain at a time - but changing to a dict
-            self.resetScene()
+            # keep the existing items if the nmrChain has not changed, otherwise use the cached scene if available
+            if self.nmrResidueList.nmrChain is not nmrChain:
+                self._cacheNmrChainScene()
+                self.resetScene()
+                restored = self._restoreNmrChainScene(nmrChain)
+            else:
+                restored = False
+                self.thisSequenceModule._initialiseChainLabels()
             self.setNmrChain(nmrChain)
 
             # self.removeNmrChainNotifiers()
             # self.addNmrChainNotifiers()
 
-            nmrList = nmrChain.mainNmrResidues
+            if not restored and len(nmrChain.nmrResidues) > BACKGROUNDLAYOUTLENGTH:
+                # calculate the layout in a background thread, the scene is updated by _applyLayoutPlan
+                self._startLayout(nmrChain)
+                return
 
-            if self.nmrResiduesCheckBox.isChecked():
-                nmrList = nmrChain.mainNmrResidues
+            nmrList = self._getDisplayNmrResidues(nmrChain)
+            allNmrResidues = nmrList
 
-            if not self.nmrResiduesCheckBox.isChecked():
+            # long nmrChains only create the items for the visible nmrResidues
+            if len(nmrList) > VIRTUALNMRCHAINLENGTH:
+                self.nmrResidueList.setLayout(thisChainId, nmrList)
+                nmrList = self._getVisibleNmrResidues(thisChainId)
+            else:
+                self.nmrResidueList.clearLayout(thisChainId)
 
-                # get the connected stretch of mainNmrResidues
-                if self.current.nmrResidue:
-                    mainNmrRes = self.current.nmrResidue.mainNmrResidue
-                    if mainNmrRes in nmrList:
-                        indL = indR = nmrList.index(mainNmrRes)
-                        while nmrList[indL].previousNmrResidue and indL > 0:
-                            indL -= 1
-                        while nmrList[indR].nextNmrResidue and indR < len(nmrList):
-                            indR += 1
-                        nmrList = nmrList[indL:indR + 1]
+            if not (restored and self.nmrResidueList.nmrChains.get(thisChainId) == list(nmrList)):
+                # add/remove the changed nmrResidues, connecting lines and peakAssignment lines
+                self.nmrResidueList.updateNmrChain(thisChainId, nmrList)
 
-            # add the nmrResidues to the scene
-            for ii, nmrRes in enumerate(nmrList):
-                self.nmrResidueList.addNmrResidue(thisChainId, nmrRes, index=ii)
+                # put all the guiResidueGroups in the correct positions
+                self.nmrResidueList.updateGuiResiduePositions(thisChainId, updateMainChain=True, updateConnectedChains=True)
 
-            # add the connecting lines
-            self.nmrResidueList.addConnectionsBetweenGroups(thisChainId)
+            # update the prediction in the sequenceModule
+            if thisChainId in self.nmrResidueList.nmrChains:
+                self.predictSequencePosition(list(allNmrResidues))
 
-            # add the peakAssignment lines
-            self.nmrResidueList._addAllPeakAssignments(thisChainId)
+    def _getDisplayNmrResidues(self, nmrChain):
+        """Return the list of mainNmrResidues to display for the nmrChain,
+        either all or the stretch containing current.nmrResidue.
+        """
+        return _getDisplayNmrResidues(nmrChain, self.nmrResiduesCheckBox.isChecked(), self.current.nmrResidue)
 
-            # put all the guiResidueGroups in the correct positions
-            self.nmrResidueList.updateGuiResiduePositions(thisChainId, updateMainChain=True, updateConnectedChains=True)
+    def _startLayout(self, nmrChain):
+        """Start the layout of the nmrChain, cancelling any previous layout.
+        The peak assignments are read from the project in the main thread by _readLayoutSnapshot, in batches, and
+        then paired by a LayoutTask in the global thread pool.
+        """
+        self._cancelLayout()
 
-            # update the prediction in the sequenceModule
-            if thisChainId in self.nmrResidueList.nmrChains:
-                self.predictSequencePosition(self.nmrResidueList.nmrChains[thisChainId])
+        # read everything the task needs from the project in the main thread, the task only works on the copies
+        allNmrResidues = tuple(self._getDisplayNmrResidues(nmrChain))
+
+        # only the visible region of long nmrChains is created
+        nmrResidues = allNmrResidues
+        if len(allNmrResidues) > VIRTUALNMRCHAINLENGTH:
+            view = self.scrollContents
+            rect = view.mapToScene(view.viewport().rect()).boundingRect()
+            nmrResidues = allNmrResidues[_getLayoutSlice(len(allNmrResidues), self.nmrResidueList._atomSpacing * 3.0,
+                                                         rect.left(), rect.right(), margin=VIRTUALMARGIN)]
+
+        snapshotReader = None
+        if self._SGwidget.checkBoxes['peakAssignments']['checkBox'].isChecked():
+            snapshotReader = self.nmrResidueList._iterSnapshotPeakAssignments(nmrResidues, batchSize=SNAPSHOTBATCHSIZE)
+
+        self._layoutPending = True
+        self._setLayoutProgress(0, 0)
+        self._readLayoutSnapshot(self._layoutGeneration, nmrChain, allNmrResidues, nmrResidues, snapshotReader)
+
+    def _readLayoutSnapshot(self, generation, nmrChain, allNmrResidues, nmrResidues, snapshotReader):
+        """Read the next batch of peak assignments for the layout, one batch per event-loop tick,
+        and start the LayoutTask when the PeakAssignmentSnapshot is complete.
+        The project is not thread-safe, so it is only read here, in the main thread; a change to the project
+        between batches starts a new layout from _processPendingUpdates.
+        """
+        if generation != self._layoutGeneration:
+            # superseded by a newer layout
+            return
+
+        peakSnapshot = None
+        if snapshotReader is not None:
+            try:
+                count, total, peakSnapshot = next(snapshotReader)
+            except Exception as es:
+                getLogger().warning('SequenceGraph layout failed: %s' % str(es))
+                self._cancelLayout()
+                if self.nmrChain and not self.nmrChain.isDeleted:
+                    with self.sceneBlocking():
+                        self._refreshNmrChain(self.nmrChain.pid)
+                return
+
+            if peakSnapshot is None:
+                self._setLayoutProgress(count, total)
+                QtCore.QTimer.singleShot(0, partial(self._readLayoutSnapshot, generation, nmrChain,
+                                                    allNmrResidues, nmrResidues, snapshotReader))
+                return
+
+        task = LayoutTask(generation, nmrChain.pid, allNmrResidues, nmrResidues,
+                          peakSnapshot=peakSnapshot,
+                          magnetisationTransfers=OrderedDict(self.magnetisationTransfers))
+        task.signals.progress.connect(self._layoutTaskProgress)
+        task.signals.finished.connect(self._layoutTaskFinished)
+
+        self._layoutTask = task
+        self._setLayoutProgress(0, 0)
+        QtCore.QThreadPool.globalInstance().start(task)
+
+    def _cancelLayout(self):
+        """Cancel the layout being calculated/applied, the generation identifies the current layout.
+        """
+        self._layoutGeneration += 1
+        if self._layoutTask is not None:
+            self._layoutTask.cancel()
+            self._layoutTask = None
+        self._layoutPending = False
+        self._setLayoutProgress(None)
+
+    def _setLayoutProgress(self, count, total=0):
+        """Show the progress of the layout, hide if count is None.
+        """
+        if count is None:
+            self._layoutProgress.hide()
+        else:
+            self._layoutProgress.setRange(0, total)
+            self._layoutProgress.setValue(count)
+            self._layoutProgress.show()
+
+    def _layoutTaskProgress(self, generation, count, total):
+        """Respond to progress from the LayoutTask.
+        """
+        if generation == self._layoutGeneration:
+            self._setLayoutProgress(count, total)
+
+    def _layoutTaskFinished(self, generation, plan):
+        """Respond to the LayoutTask finishing, apply the plan if it is still current.
+        """
+        if generation != self._layoutGeneration:
+            return
+
+        self._layoutTask = None
+        nmrChain = self.project.getByPid(plan.nmrChainId) if plan else None
+        if nmrChain is None or nmrChain is not self.nmrChain:
+            self._cancelLayout()
+            if plan is None and self.nmrChain and not self.nmrChain.isDeleted:
+                # the layout failed, update in the main thread
+                with self.sceneBlocking():
+                    self._refreshNmrChain(self.nmrChain.pid)
+            return
+
+        if len(plan.allNmrResidues) > VIRTUALNMRCHAINLENGTH:
+            self.nmrResidueList.setLayout(plan.nmrChainId, plan.allNmrResidues)
+        else:
+            self.nmrResidueList.clearLayout(plan.nmrChainId)
+        self._applyLayoutPlan(plan)
+
+    def _applyLayoutPlan(self, plan):
+        """Create the guiNmrResidueGroups of the plan in batches of LAYOUTBATCHSIZE per event-loop tick,
+        then add the lines when all have been created.
+        """
+        if plan.generation != self._layoutGeneration:
+            # superseded by a newer layout
+            return
+
+        with notificationEchoBlocking():
+            with self.sceneBlocking():
+                complete = self.nmrResidueList.updateNmrChain(plan.nmrChainId, plan.nmrResidues,
+                                                              peakAssignments=plan.peakAssignments, maxCreate=LAYOUTBATCHSIZE)
+                self.nmrResidueList.updateGuiResiduePositions(plan.nmrChainId, updateMainChain=True, updateConnectedChains=complete)
+
+        if not complete:
+            self._setLayoutProgress(len(self.nmrResidueList.nmrChains[plan.nmrChainId]), len(plan.nmrResidues))
+            QtCore.QTimer.singleShot(0, partial(self._applyLayoutPlan, plan))
+            return
+
+        self._layoutPending = False
+        self._setLayoutProgress(None)
+        self.predictSequencePosition(list(plan.allNmrResidues))
+
+        # the view may have scrolled while the layout was calculated
+        self._virtualTimer.start()
+
+    def _getVisibleNmrResidues(self, nmrChainId):
+        """Return the nmrResidues of a virtualised nmrChain in the visible region of the view.
+        """
+        view = self.scrollContents
+        rect = view.mapToScene(view.viewport().rect()).boundingRect()
+        return self.nmrResidueList.getLayoutNmrResidues(nmrChainId, rect.left(), rect.right(), margin=VIRTUALMARGIN)
+
+    def _updateVirtualNmrResidues(self):
+        """Create/remove the gui items of a virtualised nmrChain as the visible region changes.
+        """
+        nmrChainId = self.nmrChain.pid if self.nmrChain else None
+        if self._layoutPending or not self.nmrResidueList.isVirtual(nmrChainId):
+            # the visible region is updated when the layout has been applied
+            return
+
+        nmrList = self._getVisibleNmrResidues(nmrChainId)
+        if nmrList != self.nmrResidueList.nmrChains.get(nmrChainId):
+            with self.sceneBlocking():
+                self.nmrResidueList.updateNmrChain(nmrChainId, nmrList)
+                self.nmrResidueList.updateGuiResiduePositions(nmrChainId, updateMainChain=True, updateConnectedChains=True)
+
+    def _refreshNmrChain(self, nmrChainId):
+        """Update the displayed nmrResidues of the nmrChain after nmrResidues have been created/deleted/moved.
+        Existing guiNmrResidueGroups are kept, long nmrChains are virtualised.
+        """
+        nmrChain = self.project.getByPid(nmrChainId)
+        if nmrChain:
+            allNmrResidues = self._getDisplayNmrResidues(nmrChain)
+            if len(allNmrResidues) > VIRTUALNMRCHAINLENGTH:
+                self.nmrResidueList.setLayout(nmrChainId, allNmrResidues)
+                nmrList = self._getVisibleNmrResidues(nmrChainId)
+            else:
+                self.nmrResidueList.clearLayout(nmrChainId)
+                nmrList = allNmrResidues
+
+            self.nmrResidueList.updateNmrChain(nmrChainId, nmrList)
+            self.nmrResidueList.updateGuiResiduePositions(nmrChainId, updateMainChain=True, updateConnectedChains=True)
+            self.predictSequencePosition(list(allNmrResidues))
 
     def showNmrChainFromPulldown(self, data=None):
         """Clear and redraw the nmrChain selected from the pulldown.
@@ -2719,6 +3510,12 @@ class SequenceGraphModule(CcpnModule):
         """CCPN-INTERNAL: used to close the module
         """
         # self._unRegisterNotifiers()
+        self._cancelLayout()
+        self._cancelPrediction()
+        self._updateTimer.stop()
+        self._clearPendingUpdates()
+        self._clearNmrChainScenes()
+        self.nmrResidueList.clearGhostPool()
         self.thisSequenceModule.close()
         super()._closeModule()
 
@@ -2851,7 +3648,17 @@ class SequenceGraphModule(CcpnModule):
         """
         # Only needed to be done the first time, scene is resized at the end of setNmrChainDisplay
         self.scene = QtWidgets.QGraphicsScene(self)
-        self.scrollContents = QtWidgets.QGraphicsView(self.scene, self)
+        self.scrollContents = SequenceGraphView(self.scene, self)
+        self.scrollContents.zoomChanged.connect(self._updateLevelOfDetail)
+
+        # update the visible nmrResidues of virtualised nmrChains after scrolling/zooming
+        self._virtualTimer = QtCore.QTimer(self)
+        self._virtualTimer.setSingleShot(True)
+        self._virtualTimer.setInterval(VIRTUALUPDATEDELAY)
+        self._virtualTimer.timeout.connect(self._updateVirtualNmrResidues)
+        self.scrollContents.zoomChanged.connect(self._virtualTimer.start)
+        self.scrollContents.horizontalScrollBar().valueChanged.connect(self._virtualTimer.start)
+        self.scrollContents.horizontalScrollBar().rangeChanged.connect(self._virtualTimer.start)
         self.scrollContents.setRenderHints(QtGui.QPainter.Antialiasing)
         self.scrollContents.setInteractive(True)
         self.scrollContents.setGeometry(QtCore.QRect(0, 0, 300, 400))
@@ -3096,40 +3903,153 @@ class SequenceGraphModule(CcpnModule):
         """
         Predicts sequence position for Nmr residues displayed in the Assigner and highlights appropriate
         positions in the Sequence Module if it is displayed.
+        Predictions are cached by stretch, chain and chemicalShiftList, and only recalculated when the chemicalShifts
+        of the stretch have changed.
+
+        With the placeLongStretches setting, stretches of at least PLACEMENTLENGTH nmrResidues are placed by the
+        SequencePlacer in a background thread and highlighted above MINLOGLIKELIHOODRATIO; shorter stretches, or all
+        stretches without the setting, are scored by getSpinSystemsLocation and highlighted above MINLOCATIONSCORE.
+        The two scores are on different scales, so the highlighted positions can change when a stretch grows past
+        PLACEMENTLENGTH.
+        getSpinSystemsLocation reads the project, so it runs in the main thread once per chain and chemicalShiftList
+        for each stretch that is not cached; it is only quick for short stretches.
         """
+        self._cancelPrediction()
+        self._predictionNmrResidues = tuple(nmrResidueList)
+
         if len(nmrResidueList) < 3:
             self.thisSequenceModule._initialiseChainLabels()
             return
 
         if self.project.chains and self.project.chemicalShiftLists:
 
-            nmrResidues = nmrResidueList  # [item[0] for item in nmrResidueList]
+            nmrResidues = tuple(nmrResidueList)  # [item[0] for item in nmrResidueList]
+
+            keysDict = OrderedDict((chainNum, [self._getPredictionKey(nmrResidues, chain, chemList)
+                                               for chemList in self.project.chemicalShiftLists])
+                                   for chainNum, chain in enumerate(self.project.chains))
+
+            missing = [key for keys in keysDict.values() for key in keys if key not in self._predictions]
+            placeLongStretches = self._SGwidget.checkBoxes['placeLongStretches']['checkBox'].isChecked()
+            placements = OrderedDict()
+            for key in missing:
+                stretch, chain, chemList, _version = key
+                if placeLongStretches and len(stretch) >= PLACEMENTLENGTH:
+                    # read the probabilities here, only the changed nmrResidues are recalculated
+                    sequenceMatrix = self._sequencePlacer.getSequenceMatrix(chain)
+                    placements[key] = (sequenceMatrix, self._sequencePlacer.getProbabilities(stretch, chemList, sequenceMatrix))
+                else:
+                    # getSpinSystemsLocation reads the project so cannot be threaded
+                    self._predictions[key] = getSpinSystemsLocation(self.project, list(stretch), chain, chemList)
+
+            if placements:
+                # place in the background, the sequenceModule is updated by _predictionTaskFinished
+                task = PredictionTask(self._predictionGeneration, placements)
+                task.signals.finished.connect(partial(self._predictionTaskFinished, nmrResidues, keysDict))
+                self._predictionTask = task
+                QtCore.QThreadPool.globalInstance().start(task)
+            else:
+                self._showPredictions(nmrResidues, keysDict)
+                self._trimPredictions()
+
+    def _togglePlacements(self, data=None):
+        """Recalculate the predictions of the displayed nmrResidues with the new scoring.
+        """
+        # the cached predictions do not record how they were scored
+        self._cancelPrediction()
+        self._predictions.clear()
+        self.predictSequencePosition(list(self._predictionNmrResidues))
+
+    def _getPredictionKey(self, nmrResidues, chain, chemList):
+        """Return the key of the prediction cache, the version changes when the chemicalShifts of the nmrResidues change.
+        """
+        version = (self._shiftVersions.get(chemList, 0),) + \
+                  tuple(self._shiftVersions.get((chemList, nmrResidue), 0) for nmrResidue in nmrResidues)
+        return (nmrResidues, chain, chemList, version)
+
+    def _updateChemicalShifts(self, data):
+        """Update the versions of the changed chemicalShifts, and clear the cached nmrChain scenes.
+        """
+        self._clearNmrChainScenes()
+
+        chemicalShift = data[Notifier.OBJECT]
+        chemList = chemicalShift.chemicalShiftList
+        nmrAtom = chemicalShift.nmrAtom
+        if nmrAtom is not None and nmrAtom.nmrResidue is not None:
+            key = (chemList, nmrAtom.nmrResidue.mainNmrResidue)
+            self._sequencePlacer.invalidate(nmrAtom.nmrResidue, chemList)
+            self._sequencePlacer.invalidate(nmrAtom.nmrResidue.mainNmrResidue, chemList)
+        else:
+            # cannot tell which nmrResidue has changed, so invalidate the whole chemicalShiftList
+            key = chemList
+            self._sequencePlacer.invalidate(chemicalShiftList=chemList)
+        self._shiftVersions[key] = self._shiftVersions.get(key, 0) + 1
+
+    def _cancelPrediction(self):
+        """Cancel the prediction being calculated.
+        """
+        self._predictionGeneration += 1
+        if self._predictionTask is not None:
+            self._predictionTask.cancel()
+            self._predictionTask = None
+
+    def _predictionTaskFinished(self, nmrResidues, keysDict, generation, results):
+        """Store the results from the PredictionTask, and update the sequenceModule if still current.
+        """
+        if results is None:
+            return
+
+        # ignore the placements of chemicalShifts that have changed since the task was started
+        self._predictions.update((key, placements) for key, placements in results.items()
+                                 if key == self._getPredictionKey(*key[:3]))
+        if generation == self._predictionGeneration:
+            self._predictionTask = None
+            self._showPredictions(nmrResidues, keysDict)
+
+        self._trimPredictions()
+
+    def _trimPredictions(self):
+        """Remove the least recently used predictions from the cache.
+        """
+        while len(self._predictions) > MAXCACHEDPREDICTIONS:
+            self._predictions.popitem(last=False)
+
+    def _showPredictions(self, nmrResidues, keysDict):
+        """Highlight the cached predictions in the sequenceModule.
+        """
+        matchesDict = {}
+        for chainNum, keys in keysDict.items():
+            matchesDict[chainNum] = []
+            for key in keys:
+                # skip the predictions discarded because the chemicalShifts changed while calculating
+                if key not in self._predictions:
+                    continue
 
-            matchesDict = {}
-            for chainNum, chain in enumerate(self.project.chains):
-                matchesDict[chainNum] = []
-                for chemList in self.project.chemicalShiftLists:
-                    match = getSpinSystemsLocation(self.project, nmrResidues,
-                                                   chain, chemList)
-                    if match:
-                        matchesDict[chainNum].append(match)
+                # move to the end of the cache so recent predictions are kept
+                self._predictions.move_to_end(key)
+                match = self._predictions[key]
+                if match:
+                    matchesDict[chainNum].append(match)
 
-            for chainNum in matchesDict.keys():
+        for chainNum in matchesDict.keys():
 
-                # possibleMatches = getSpinSystemsLocation(self.project, nmrResidues,
-                #                   self.project.chains[0], self.project.chemicalShiftLists[0])
+            # possibleMatches = getSpinSystemsLocation(self.project, nmrResidues,
+            #                   self.project.chains[0], self.project.chemicalShiftLists[0])
 
-                self.thisSequenceModule._clearStretches(chainNum)
-                possibleMatches = matchesDict[chainNum]
+            self.thisSequenceModule._clearStretches(chainNum)
+            possibleMatches = matchesDict[chainNum]
 
-                if possibleMatches:
-                    for chemList in possibleMatches:
-                        for possibleMatch in chemList:
-                            if possibleMatch[0] > 1 and not len(possibleMatch[1]) < len(nmrResidues):
-                                # if hasattr(self.application, 'sequenceModule'):
-                                # self.application.sequenceModule._highlightPossibleStretches(possibleMatch[1])
+            if possibleMatches:
+                for chemList in possibleMatches:
+                    for possibleMatch in chemList:
+                        # Placement scores are log-likelihood ratios against a random position of the chain and
+                        # getSpinSystemsLocation scores are on a different scale, so each has its own threshold
+                        minScore = MINLOGLIKELIHOODRATIO if isinstance(possibleMatch, Placement) else MINLOCATIONSCORE
+                        if possibleMatch[0] > minScore and not len(possibleMatch[1]) < len(nmrResidues):
+                            # if hasattr(self.application, 'sequenceModule'):
+                            # self.application.sequenceModule._highlightPossibleStretches(possibleMatch[1])
 
-                                self.thisSequenceModule._highlightPossibleStretches(chainNum, possibleMatch[1])
+                            self.thisSequenceModule._highlightPossibleStretches(chainNum, possibleMatch[1])
 
     def _toggleSequence(self):
         if not self.sequenceCheckBox.isChecked():